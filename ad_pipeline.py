@@ -1,9 +1,8 @@
 """
 Main pipeline - WITH PROMPT TESTING MODE
-OPTIMIZED: Forces cleanup of temp files
+OPTIMIZED: Each request merges in its own workspace, removed when done
 """
 import json
-import os
 import shutil
 from config import (
     DEFAULT_TOTAL_DURATION, 
@@ -16,6 +15,7 @@ from gcs_utils import GCSManager
 from prompt_generator_for_video import VeoPromptGenerator
 from video_generator import VeoVideoGenerator
 from video_merger import VideoMerger
+from progress_events import noop_progress
 
 
 def generate_product_video(
@@ -24,14 +24,18 @@ def generate_product_video(
     brand_guidelines="", 
     total_duration=DEFAULT_TOTAL_DURATION,
     segment_duration=DEFAULT_SEGMENT_DURATION,
-    prompt_only=PROMPT_ONLY_MODE
+    prompt_only=PROMPT_ONLY_MODE,
+    on_progress=None
 ):
     """
     Generate professional E-Commerce product video
     
     Args:
         prompt_only: If True, only generate prompts (skip video generation)
+        on_progress: Optional fn(stage, **data) receiving stage events (see progress_events)
     """
+    on_progress = on_progress or noop_progress
+    
     # Validation
     if not image_paths or len(image_paths) == 0:
         return {"success": False, "error": "No images provided"}
@@ -53,6 +57,8 @@ def generate_product_video(
     
     print("=" * 70)
     
+    video_merger = None
+    
     try:
         # STEP 1: Generate prompts
         print("\n" + "=" * 70)
@@ -60,6 +66,7 @@ def generate_product_video(
         print("=" * 70)
         
         prompt_generator = VeoPromptGenerator()
+        on_progress("planning_started", images=len(image_paths))
         
         simple_prompts = prompt_generator.generate_simple_prompts(
             image_paths=image_paths,
@@ -71,6 +78,7 @@ def generate_product_video(
 
         if not simple_prompts:
             return {"success": False, "error": "Prompt generation failed"}
+        on_progress("planning_done", prompts=len(simple_prompts))
 
         # Check if we should stop after prompt generation
         if prompt_only:
@@ -87,8 +95,8 @@ def generate_product_video(
         
         # Initialize managers
         gcs_manager = GCSManager()
-        video_generator = VeoVideoGenerator(gcs_manager=gcs_manager)
-        video_merger = VideoMerger(gcs_manager=gcs_manager)
+        video_generator = VeoVideoGenerator(gcs_manager=gcs_manager, on_progress=on_progress)
+        video_merger = VideoMerger(gcs_manager=gcs_manager, on_progress=on_progress)
         
         # STEP 2: Upload images
         print("\n" + "=" * 70)
@@ -96,6 +104,7 @@ def generate_product_video(
         print("=" * 70)
         
         image_gcs_uris = [gcs_manager.upload_image(img) for img in image_paths]
+        on_progress("images_uploaded", count=len(image_gcs_uris))
         
         # ===== EXTENSION MODE FORK =====
         from config import ENABLE_VIDEO_EXTENSION, EXTENSION_BASE_DURATION, EXTENSION_COUNT, EXTENSION_INCREMENT
@@ -163,9 +172,6 @@ def generate_product_video(
         
         # ===== END FORK =====
         
-        # CRITICAL: Force cleanup of any remaining temp files
-        _force_cleanup_temp_files()
-
         print("\n" + "=" * 70)
         print("🎉 VIDEO GENERATION COMPLETE")
         print("=" * 70)
@@ -197,62 +203,13 @@ def generate_product_video(
         import traceback
         traceback.print_exc()
         
-        # Ensure cleanup even on error
-        _force_cleanup_temp_files()
-        
         return {"success": False, "error": str(e)}
-
-
-def _force_cleanup_temp_files():
-    """
-    Delete temporary files, respecting TESTING_MODE for final videos.
-    ALWAYS deletes: temp segments, temp audio
-    CONDITIONALLY deletes: final merged videos (only in production)
-    NEVER deletes: prompt logs (.txt, .json)
-    """
-    from config import TESTING_MODE
-    import glob
     
-    # Always delete these (intermediate files)
-    always_delete_patterns = [
-        'temp_segment_*.mp4',
-        'temp_single_*.mp4',
-        'temp_audio*.m4a',
-    ]
-    
-    # Only delete in production
-    conditional_delete_patterns = [
-        'final_product_video_*.mp4'
-    ]
-    
-    deleted = []
-    
-    # Always delete temp files
-    for pattern in always_delete_patterns:
-        for file in glob.glob(pattern):
-            try:
-                os.remove(file)
-                deleted.append(file)
-            except:
-                pass
-    
-    # Conditionally delete final videos
-    if not TESTING_MODE:
-        for pattern in conditional_delete_patterns:
-            for file in glob.glob(pattern):
-                try:
-                    os.remove(file)
-                    deleted.append(file)
-                except:
-                    pass
-    
-    if deleted:
-        print(f"\n🗑️ Force cleanup: Deleted {len(deleted)} temp file(s)")
-    
-    if TESTING_MODE:
-        kept_finals = glob.glob('final_product_video_*.mp4')
-        if kept_finals:
-            print(f"🧪 TESTING_MODE: Kept {len(kept_finals)} final video(s) locally")
+    finally:
+        # CRITICAL: Remove this request's workspace (never other jobs' files)
+        if video_merger:
+            video_merger.cleanup()
+
 
 if __name__ == "__main__":
     test_image_paths = [r"E:\product-image-backend\test_images\faucet_plantex.png"]
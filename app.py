@@ -2,20 +2,40 @@
 import os
 import json
 from dotenv import load_dotenv
-from flask import Flask, jsonify, request, send_file
+from flask import Flask, Response, jsonify, request, send_file
 from flask_cors import CORS
+from werkzeug.exceptions import RequestEntityTooLarge
 import google.generativeai as genai
 import cloudinary
 from pathlib import Path
+import shutil
 import tempfile
 
 # Import pipelines
-from image_pipeline import generate_images
+from image_pipeline import generate_images, iter_generated_images, JOB_TYPES
+from image_ingest import prepare_images
 from ad_pipeline import generate_product_video
-from config import ENABLE_PROMPT_VIEW, PROMPT_DISPLAY_FILE
+from config import (
+    ENABLE_PROMPT_VIEW, PROMPT_DISPLAY_FILE, EDIT_PLANNING_MODES, EDIT_DEFAULT_PLANNING_MODE,
+    UPLOAD_MAX_FILE_MB, UPLOAD_MAX_REQUEST_MB, ADMISSION_RETRY_AFTER_SECONDS
+)
+from job_queue import JobQueue, JobQueueFull, ACTIVE_STATES, JOB_FAILED
+from operation_poller import get_operation_poller
+from client_pool import get_client_pool
+from rate_limiter import get_rate_limiter
+from hedging import get_hedge_stats
+from retry_policy import get_retry_stats
+from circuit_breaker import get_admission_controller, get_breaker_stats, Overloaded
+from image_edit_pipeline import get_edit_cache
+from result_cache import get_planner_cache
+from upload_ingest import SpoolingRequest, UploadTooLarge, ingest_uploads, MB
+from progress_events import get_event_bus, stream_events
+from local_engines import ENGINES, local_engine_for, get_local_engine_stats, check_logo
 
 load_dotenv()
 app = Flask(__name__)
+app.request_class = SpoolingRequest  # Large uploads spool to disk instead of RAM
+app.config["MAX_CONTENT_LENGTH"] = UPLOAD_MAX_REQUEST_MB * MB
 CORS(app)
 
 # --- Configuration ---
@@ -27,6 +47,30 @@ cloudinary.config(
 genai.configure(api_key=os.getenv("GEMINI_API_KEY"))
 
 Port = os.getenv("PORT")
+
+# Sheds requests (503 + Retry-After) while Gemini/Veo breakers are open or too much is in flight
+admission = get_admission_controller()
+
+
+@app.errorhandler(RequestEntityTooLarge)
+@app.errorhandler(UploadTooLarge)
+def upload_too_large(e):
+    """413 for a request over UPLOAD_MAX_REQUEST_MB or a file over UPLOAD_MAX_FILE_MB"""
+    print(f"⚠️ Upload rejected: {e}")
+    return jsonify({
+        "error": "Upload too large.",
+        "max_file_mb": UPLOAD_MAX_FILE_MB,
+        "max_request_mb": UPLOAD_MAX_REQUEST_MB
+    }), 413
+
+@app.errorhandler(Overloaded)
+def service_overloaded(e):
+    """503 + Retry-After when an upstream's breaker is open or too much work is in flight"""
+    print(f"⚠️ Request shed: {e}")
+    response = jsonify({"error": f"{e}. Try again later.", "retry_after": e.retry_after})
+    response.headers["Retry-After"] = str(e.retry_after)
+    return response, 503
+
 @app.route('/api/generate', methods=['POST'])
 def generate_images_endpoint():
     """
@@ -36,20 +80,21 @@ def generate_images_endpoint():
     product_type = request.form.get('product_type', 'default_product')
     guidelines = request.form.get('guidelines', '')
     marketing_copy = request.form.get('marketing_copy', '')
+    force_replan = request.form.get('force_replan', '').strip().lower() in ('1', 'true', 'yes')
 
     if not image_files:
         return jsonify({"error": "At least one product image is required."}), 400
 
     try:
-        user_images_bytes_list = [img.read() for img in image_files]
-        
-        # Call image pipeline
-        result = generate_images(
-            product_type=product_type,
-            guidelines=guidelines,
-            marketing_copy=marketing_copy,
-            user_images_bytes_list=user_images_bytes_list
-        )
+        # Spooled uploads are decoded straight from disk (mmap), not copied with .read()
+        with admission.admit("gemini"), ingest_uploads(image_files) as uploads:
+            result = generate_images(
+                product_type=product_type,
+                guidelines=guidelines,
+                marketing_copy=marketing_copy,
+                user_images_bytes_list=uploads.views(),
+                force_replan=force_replan
+            )
         
         if result["success"]:
             return jsonify({
@@ -60,16 +105,125 @@ def generate_images_endpoint():
         else:
             return jsonify({"error": "Image generation failed"}), 500
 
+    except Overloaded as e:
+        return service_overloaded(e)
+
+    except UploadTooLarge as e:
+        return upload_too_large(e)
+
     except Exception as e:
         print(f"Error in image generation endpoint: {e}")
         return jsonify({"error": "An internal server error occurred."}), 500
 
 
+def prepared_generation_request():
+    """
+    Form fields and uploads of a generate request, with the images decoded once
+    (the uploads themselves are released before the pipelines start)
+    
+    Returns:
+        dict of iter_generated_images kwargs, or None when no images were sent
+    """
+    image_files = request.files.getlist('images')
+    if not image_files:
+        return None
+    
+    with ingest_uploads(image_files) as uploads:
+        user_images = prepare_images(uploads.views())
+    
+    return {
+        "product_type": request.form.get('product_type', 'default_product'),
+        "guidelines": request.form.get('guidelines', ''),
+        "marketing_copy": request.form.get('marketing_copy', ''),
+        "user_images": user_images,
+        "force_replan": request.form.get('force_replan', '').strip().lower() in ('1', 'true', 'yes')
+    }
+
+
+@app.route('/api/generate/stream', methods=['POST'])
+def generate_images_stream_endpoint():
+    """
+    Streaming image generation - one JSON line (NDJSON) per image as its pipeline finishes
+    Lines: {"type": "started"}, then {"type": "image", "job_type", "index", "sequence", "url", ...}
+    per pipeline, then {"type": "done", "generated_image_urls"}
+    """
+    try:
+        inputs = prepared_generation_request()
+    except UploadTooLarge as e:
+        return upload_too_large(e)
+    except Exception as e:
+        print(f"Could not read uploaded images: {e}")
+        return jsonify({"error": f"Could not read uploaded images: {e}"}), 400
+    
+    if inputs is None:
+        return jsonify({"error": "At least one product image is required."}), 400
+    
+    admission.enter("gemini")  # Slot is released when the stream closes
+    
+    def lines():
+        yield json.dumps({"type": "started", "job_types": list(JOB_TYPES), "total": len(JOB_TYPES)}) + "\n"
+        generated_urls = []
+        for result in iter_generated_images(**inputs):
+            if result["success"]:
+                generated_urls.append(result["url"])
+            yield json.dumps({"type": "image", **result}) + "\n"
+        yield json.dumps({
+            "type": "done",
+            "success": len(generated_urls) > 0,
+            "generated_image_urls": generated_urls
+        }) + "\n"
+    
+    response = Response(
+        lines(),
+        mimetype='application/x-ndjson',
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+    response.call_on_close(admission.leave)
+    return response
+
+
+@app.route('/api/generate/jobs', methods=['POST'])
+def generate_images_job_endpoint():
+    """
+    Job-based image generation - returns a job id immediately
+    Finished images show up in /api/jobs/<job_id>/result (partial_results) and
+    /api/jobs/<job_id>/events while the other pipelines are still running
+    """
+    admission.check("gemini")
+    try:
+        inputs = prepared_generation_request()
+        if inputs is None:
+            return jsonify({"error": "At least one product image is required."}), 400
+        
+        job_id = job_queue.submit("images", inputs)
+        
+        return jsonify({
+            "status": "queued",
+            "job_id": job_id,
+            "status_url": f"/api/jobs/{job_id}",
+            "events_url": f"/api/jobs/{job_id}/events",
+            "result_url": f"/api/jobs/{job_id}/result"
+        }), 202
+    
+    except JobQueueFull as e:
+        print(f"⚠️ Image job rejected: {e}")
+        return service_overloaded(Overloaded("Too many jobs in progress", ADMISSION_RETRY_AFTER_SECONDS))
+    
+    except UploadTooLarge as e:
+        return upload_too_large(e)
+    
+    except Exception as e:
+        print(f"Error in image job endpoint: {e}")
+        return jsonify({"error": f"Could not read uploaded images: {e}"}), 400
+
+
 @app.route('/api/generate-video', methods=['POST'])
 def generate_video_endpoint():
     """
-    Video generation endpoint - calls ad_pipeline module
+    Video generation endpoint - queues an ad_pipeline job and returns its id
+    Poll /api/jobs/<job_id> for state and /api/jobs/<job_id>/result for the video
     """
+    admission.check("gemini", "veo")
     temp_dir = None
     try:
         # Get uploaded images
@@ -84,41 +238,40 @@ def generate_video_endpoint():
         if not product_overview:
             return jsonify({"error": "Product overview is required."}), 400
         
-        # Save uploaded images temporarily
-        import tempfile
-        temp_dir = tempfile.mkdtemp(prefix='product_images_')
-        image_paths = []
-        
-        for i, img_file in enumerate(image_files):
-            temp_path = os.path.join(temp_dir, f"product_image_{i}.png")
-            img_file.save(temp_path)
-            image_paths.append(temp_path)
+        # Save uploaded images temporarily (the job removes this directory when done)
+        with ingest_uploads(image_files) as uploads:  # Enforces the per-file limit
+            temp_dir = tempfile.mkdtemp(prefix='product_images_')
+            image_paths = []
+            
+            for i, upload in enumerate(uploads):
+                temp_path = os.path.join(temp_dir, f"product_image_{i}.png")
+                upload.save(temp_path)
+                image_paths.append(temp_path)
         
         print(f"Saved {len(image_paths)} images to temporary directory: {temp_dir}")
         
-        # Call video generation pipeline
-        result = generate_product_video(
-            image_paths=image_paths,
-            product_overview=product_overview,
-            brand_guidelines=brand_guidelines
-        )
+        job_id = job_queue.submit("video", {
+            "temp_dir": temp_dir,
+            "image_paths": image_paths,
+            "product_overview": product_overview,
+            "brand_guidelines": brand_guidelines
+        })
+        temp_dir = None  # Ownership passed to the job
         
-        if result["success"]:
-            response_data = {
-                "status": "success",
-                "video_url": result.get("final_video_url"),
-                "request_id": result.get("request_id"),
-                "duration": result.get("duration"),
-                "segment_count": result.get("segment_count")
-            }
-            
-            # Include prompt data if available
-            if ENABLE_PROMPT_VIEW and result.get("mode") != "prompt_only":
-                response_data["prompt_available"] = True
-            
-            return jsonify(response_data)
-        else:
-            return jsonify({"error": result.get("error", "Video generation failed")}), 500
+        return jsonify({
+            "status": "queued",
+            "job_id": job_id,
+            "status_url": f"/api/jobs/{job_id}",
+            "events_url": f"/api/jobs/{job_id}/events",
+            "result_url": f"/api/jobs/{job_id}/result"
+        }), 202
+    
+    except JobQueueFull as e:
+        print(f"⚠️ Video job rejected: {e}")
+        return service_overloaded(Overloaded("Too many video jobs in progress", ADMISSION_RETRY_AFTER_SECONDS))
+    
+    except (UploadTooLarge, RequestEntityTooLarge) as e:
+        return upload_too_large(e)
             
     except Exception as e:
         print(f"Error in video generation endpoint: {e}")
@@ -127,12 +280,147 @@ def generate_video_endpoint():
         return jsonify({"error": str(e)}), 500
     
     finally:
-        # CRITICAL: Always cleanup temp directory
+        # Only cleans up here if the job was never queued
         if temp_dir and os.path.exists(temp_dir):
-            import shutil
             shutil.rmtree(temp_dir, ignore_errors=True)
             print(f"🗑️ Cleaned up temp directory: {temp_dir}")
 
+
+def run_video_job(payload, progress):
+    """Job handler: run the video pipeline, then ALWAYS cleanup uploaded images"""
+    try:
+        return generate_product_video(
+            image_paths=payload["image_paths"],
+            product_overview=payload["product_overview"],
+            brand_guidelines=payload["brand_guidelines"],
+            on_progress=progress
+        )
+    finally:
+        temp_dir = payload["temp_dir"]
+        if os.path.exists(temp_dir):
+            shutil.rmtree(temp_dir, ignore_errors=True)
+            print(f"🗑️ Cleaned up temp directory: {temp_dir}")
+
+
+def run_images_job(payload, progress):
+    """Job handler: run the image pipelines, publishing each image as it finishes"""
+    images = []
+    for result in iter_generated_images(**payload):
+        images.append(result)
+        progress.partial("image_done", **result)
+    
+    generated_urls = [image["url"] for image in images if image["success"]]
+    return {
+        "success": len(generated_urls) > 0,
+        "generated_image_urls": generated_urls,
+        "images": sorted(images, key=lambda image: image["index"]),
+        "message": f"Successfully generated {len(generated_urls)} images."
+    }
+
+
+def images_result_response(result):
+    """Shape a run_images_job result like the /api/generate response"""
+    return {
+        "status": "success",
+        "message": result.get("message"),
+        "generated_image_urls": result.get("generated_image_urls", []),
+        "images": result.get("images", [])
+    }
+
+
+def video_result_response(result):
+    """Shape a generate_product_video result the way the frontend expects"""
+    response_data = {
+        "status": "success",
+        "video_url": result.get("final_video_url"),
+        "request_id": result.get("request_id"),
+        "duration": result.get("duration"),
+        "segment_count": result.get("segment_count")
+    }
+    
+    # Include prompt data if available
+    if ENABLE_PROMPT_VIEW and result.get("mode") != "prompt_only":
+        response_data["prompt_available"] = True
+    
+    return response_data
+
+
+job_queue = JobQueue()
+job_queue.register("video", run_video_job)
+job_queue.register("images", run_images_job)
+JOB_RESULT_BUILDERS = {
+    "video": video_result_response,
+    "images": images_result_response,
+}
+
+
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+def job_status_endpoint(job_id):
+    """Report the state of a queued job"""
+    job = job_queue.get(job_id)
+    if job is None:
+        return jsonify({"error": f"Unknown job_id: {job_id}"}), 404
+    
+    return jsonify({
+        "job_id": job["job_id"],
+        "job_type": job["job_type"],
+        "status": job["status"],
+        "created_at": job["created_at"],
+        "started_at": job["started_at"],
+        "finished_at": job["finished_at"],
+        "error": job["error"]
+    })
+
+
+@app.route('/api/jobs/<job_id>/result', methods=['GET'])
+def job_result_endpoint(job_id):
+    """Return the final result of a job (202 while it is still running)"""
+    job = job_queue.get(job_id)
+    if job is None:
+        return jsonify({"error": f"Unknown job_id: {job_id}"}), 404
+    
+    if job["status"] in ACTIVE_STATES:
+        response_data = {"job_id": job_id, "status": job["status"]}
+        # Pieces the job has already finished (e.g. the first generated images)
+        if job["result"] and "partial" in job["result"]:
+            response_data["partial_results"] = job["result"]["partial"]
+        return jsonify(response_data), 202
+    
+    if job["status"] == JOB_FAILED:
+        return jsonify({
+            "job_id": job_id,
+            "status": job["status"],
+            "error": job["error"] or "Job failed"
+        }), 500
+    
+    response_data = JOB_RESULT_BUILDERS[job["job_type"]](job["result"])
+    response_data["job_id"] = job_id
+    return jsonify(response_data)
+
+
+@app.route('/api/jobs/<job_id>/events', methods=['GET'])
+def job_events_endpoint(job_id):
+    """
+    Server-Sent Events stream of a job's stage events
+    Reconnects resume after the Last-Event-ID header (or ?last_event_id=)
+    """
+    job = job_queue.get(job_id)
+    if job is None:
+        return jsonify({"error": f"Unknown job_id: {job_id}"}), 404
+
+    last_event_id = request.headers.get('Last-Event-ID') or request.args.get('last_event_id', '0')
+    try:
+        last_event_id = int(last_event_id)
+    except ValueError:
+        return jsonify({"error": f"Invalid Last-Event-ID: {last_event_id}"}), 400
+
+    snapshot = {"job_id": job_id, "status": job["status"], "error": job["error"]}
+    return Response(
+        stream_events(get_event_bus(), job_id, last_event_id, snapshot=snapshot),
+        mimetype='text/event-stream',
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
 @app.route('/api/edit-image', methods=['POST'])
 def edit_image_endpoint():
     """
@@ -185,6 +473,27 @@ def edit_image_endpoint():
         # Get optional operation details
         operation_details = request.form.get('operation_details', '').strip()
         
+        # Batch planning: one planner call per image, or one shared instruction
+        planning_mode = request.form.get('planning_mode', EDIT_DEFAULT_PLANNING_MODE).strip()
+        if planning_mode not in EDIT_PLANNING_MODES:
+            return jsonify({
+                "error": f"Invalid planning_mode: {planning_mode}. Must be one of {', '.join(EDIT_PLANNING_MODES)}."
+            }), 400
+        
+        # Optional logo for Watermark / Branding Overlay (composited locally, once per batch)
+        logo = None
+        logo_file = request.files.get('logo')
+        if logo_file and logo_file.filename != '':
+            logo = logo_file.read()
+            try:
+                check_logo(logo)
+            except ValueError as e:
+                return jsonify({"error": str(e)}), 400
+        
+        # Force a fresh edit even if this exact image + operation was edited before
+        bypass_cache = request.form.get('bypass_cache', '').strip().lower() in ('1', 'true', 'yes')
+        force_replan = request.form.get('force_replan', '').strip().lower() in ('1', 'true', 'yes')
+        
         print(f"\n{'='*70}")
         print(f"📥 EDIT IMAGE REQUEST")
         print(f"{'='*70}")
@@ -192,36 +501,50 @@ def edit_image_endpoint():
         print(f"📸 Images: {len(valid_images)}")
         if operation_details:
             print(f"📝 User Details: {operation_details[:100]}...")
+        if logo:
+            print(f"🏷️ Logo: {logo_file.filename} ({len(logo) // 1024} KB)")
+        print(f"🧠 Planning: {planning_mode}")
         print(f"{'='*70}\n")
         
         # Import edit pipeline
-        from image_edit_pipeline import edit_product_image
+        from image_edit_pipeline import edit_product_images
         
-        # Process images
-        edited_urls = []
-        operation_name = None
+        # Local engines that never decline don't touch Gemini, so its breaker doesn't gate them;
+        # one that may decline falls back to Gemini and has to pass its admission check
+        engine = local_engine_for(operation_id, operation_details)
+        upstreams = () if engine and not ENGINES[engine].declines else ("gemini",)
         
-        for idx, image_file in enumerate(valid_images):
-            print(f"\n🖼️ Processing image {idx + 1}/{len(valid_images)}: {image_file.filename}")
-            
-            # Read image bytes
-            image_bytes = image_file.read()
-            
-            # Process single image
-            result = edit_product_image(
-                image_bytes=image_bytes,
+        # Process images concurrently (results come back in input order)
+        with admission.admit(*upstreams), ingest_uploads(valid_images) as uploads:
+            batch = edit_product_images(
+                images_bytes=uploads.views(),
                 operation_id=operation_id,
-                operation_details=operation_details if operation_details else None
+                operation_details=operation_details if operation_details else None,
+                planning_mode=planning_mode,
+                bypass_cache=bypass_cache,
+                force_replan=force_replan,
+                logo=logo
             )
-            
+        results = batch["results"]
+        
+        edited_urls = []
+        failed_images = []
+        operation_name = None
+        
+        for idx, (image_file, result) in enumerate(zip(valid_images, results)):
             if result["success"]:
                 edited_urls.append(result["edited_image_url"])
                 if operation_name is None:
                     operation_name = result["operation_name"]
-                print(f"   ✅ Edited: {result['edited_image_url']}")
+                print(f"   ✅ Image {idx + 1} ({image_file.filename}): {result['edited_image_url']}")
             else:
-                print(f"   ❌ Failed: {result.get('error', 'Unknown error')}")
-                # Continue with other images even if one fails
+                # Other images still count even if one fails
+                failed_images.append({
+                    "index": idx,
+                    "filename": image_file.filename,
+                    "error": result.get("error", "Unknown error")
+                })
+                print(f"   ❌ Image {idx + 1} ({image_file.filename}): {result.get('error', 'Unknown error')}")
         
         # Check if at least one succeeded
         if len(edited_urls) > 0:
@@ -229,8 +552,13 @@ def edit_image_endpoint():
                 "status": "success",
                 "operation_name": operation_name,
                 "total_images": len(valid_images),
-                "successful_edits": len(edited_urls)
+                "successful_edits": len(edited_urls),
+                "planning_mode": batch["planning_mode"],
+                "planner_calls_saved": batch["planner_calls_saved"],
+                "cache_hits": batch["cache_hits"]
             }
+            if failed_images:
+                response_data["failed_images"] = failed_images
             
             # Return single URL or array based on count
             if len(edited_urls) == 1:
@@ -241,21 +569,46 @@ def edit_image_endpoint():
             
             print(f"\n✅ Edit successful!")
             print(f"   Operation: {operation_name}")
-            print(f"   Images processed: {len(edited_urls)}/{len(valid_images)}\n")
+            print(f"   Images processed: {len(edited_urls)}/{len(valid_images)}")
+            print(f"   Planner calls saved: {batch['planner_calls_saved']}\n")
             
             return jsonify(response_data)
         else:
             return jsonify({
                 "error": "All image edits failed",
-                "total_attempted": len(valid_images)
+                "total_attempted": len(valid_images),
+                "failed_images": failed_images
             }), 500
     
+    except Overloaded as e:
+        return service_overloaded(e)
+    
+    except (UploadTooLarge, RequestEntityTooLarge) as e:
+        return upload_too_large(e)
+    
     except Exception as e:
         print(f"\n❌ Error in edit endpoint: {e}")
         import traceback
         traceback.print_exc()
         return jsonify({"error": str(e)}), 500
 
+@app.route('/api/metrics', methods=['GET'])
+def metrics_endpoint():
+    """Runtime counters for capacity monitoring"""
+    return jsonify({
+        "veo_poller": get_operation_poller().get_stats(),
+        "client_pool": get_client_pool().get_stats(),
+        "rate_limits": get_rate_limiter().get_stats(),
+        "hedging": get_hedge_stats(),
+        "local_engines": get_local_engine_stats(),
+        "retries": get_retry_stats(),
+        "circuit_breakers": get_breaker_stats(),
+        "admission": admission.get_stats(),
+        "edit_cache": get_edit_cache().get_stats(),
+        "planner_cache": get_planner_cache().get_stats(),
+        "progress_events": get_event_bus().get_stats()
+    })
+
 @app.route('/health', methods=['GET'])
 def health_check():
     """Health check endpoint for deployment monitoring"""
@@ -0,0 +1,388 @@
+"""
+Circuit breakers and admission control for the model upstreams
+One breaker per upstream ("gemini", "veo") watches recent call outcomes.
+When most of them failed transiently it opens: calls fail immediately with
+CircuitOpenError instead of holding a worker for minutes, and after
+CIRCUIT_OPEN_SECONDS a single half-open probe decides whether to close again.
+
+AdmissionController sits in front of the endpoints: it sheds requests with
+503 + Retry-After while a breaker they need is open, or when too many
+synchronous requests are already in flight.
+"""
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+from config import (
+    CIRCUIT_BREAKER_ENABLED,
+    CIRCUIT_FAILURE_RATE,
+    CIRCUIT_MIN_CALLS,
+    CIRCUIT_WINDOW,
+    CIRCUIT_OPEN_SECONDS,
+    CIRCUIT_HALF_OPEN_PROBES,
+    ADMISSION_MAX_IN_FLIGHT,
+    ADMISSION_RETRY_AFTER_SECONDS
+)
+from retry_policy import is_retryable
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling an upstream whose breaker is open (not retried)"""
+
+    def __init__(self, upstream, retry_after):
+        super().__init__(f"{upstream} circuit open, retry in {retry_after}s")
+        self.upstream = upstream
+        self.retry_after = retry_after
+
+
+class Overloaded(Exception):
+    """Request shed by admission control; app.py turns it into 503 + Retry-After"""
+
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    """Closed / open / half-open state machine for one upstream"""
+
+    def __init__(self, name, enabled=CIRCUIT_BREAKER_ENABLED, failure_rate=CIRCUIT_FAILURE_RATE,
+                 min_calls=CIRCUIT_MIN_CALLS, window=CIRCUIT_WINDOW, open_seconds=CIRCUIT_OPEN_SECONDS,
+                 half_open_probes=CIRCUIT_HALF_OPEN_PROBES, is_failure=is_retryable):
+        self.name = name
+        self.enabled = enabled
+        self.failure_rate = failure_rate
+        self.min_calls = min_calls
+        self.open_seconds = open_seconds
+        self.half_open_probes = half_open_probes
+        self.is_failure = is_failure  # Only upstream trouble counts - a 400 means the upstream is fine
+        self._outcomes = deque(maxlen=window)  # True = failure
+        self._state = CLOSED
+        self._opened_at = 0.0
+        self._probes = 0
+        self._lock = threading.Lock()
+        self._stats = {"calls": 0, "failures": 0, "rejected": 0, "opened": 0}
+
+    @property
+    def state(self):
+        with self._lock:
+            return self._current_state()
+
+    def retry_after(self):
+        """Whole seconds until the next probe is allowed (0 unless open)"""
+        with self._lock:
+            if self._current_state() != OPEN:
+                return 0
+            return max(1, int(self._opened_at + self.open_seconds - time.monotonic() + 0.999))
+
+    def rejecting(self):
+        """Would a call right now be refused?"""
+        with self._lock:
+            state = self._current_state()
+            return self.enabled and (state == OPEN or (state == HALF_OPEN and self._probes >= self.half_open_probes))
+
+    def before_call(self):
+        """
+        Admit one call or raise CircuitOpenError; pair with record()
+
+        Use call() where possible - this split exists for work that is
+        accepted now and finishes later (see accepted()).
+        """
+        if not self.enabled:
+            return
+        with self._lock:
+            state = self._current_state()
+            if state == HALF_OPEN and self._probes < self.half_open_probes:
+                self._probes += 1
+                print(f"🧪 {self.name} circuit half-open: sending a probe call")
+                return
+            if state == CLOSED:
+                return
+            self._stats["rejected"] += 1
+        raise CircuitOpenError(self.name, self.retry_after())
+
+    def record(self, error=None):
+        """Feed one call outcome (error=None for success) into the breaker"""
+        self._record(error, probe=True)
+
+    def accepted(self):
+        """
+        Resolve a before_call() whose work was accepted but finishes later
+
+        A Veo submit is accepted in seconds while the operation runs for
+        minutes; holding the half-open probe that long would shed every
+        request meanwhile. Acceptance closes a half-open breaker, and the
+        operation's own outcome goes to record_outcome().
+        """
+        if not self.enabled:
+            return
+        with self._lock:
+            if self._current_state() == HALF_OPEN:
+                self._probes = max(0, self._probes - 1)
+                self._close("probe accepted")
+
+    def record_outcome(self, error=None):
+        """Feed the outcome of accepted() work into the failure window (never a probe)"""
+        self._record(error, probe=False)
+
+    def record_rejected(self):
+        """Count a request shed up front (AdmissionController) because this breaker refused calls"""
+        with self._lock:
+            self._stats["rejected"] += 1
+
+    def _record(self, error, probe):
+        if not self.enabled or isinstance(error, CircuitOpenError):
+            return
+        failed = error is not None and self.is_failure(error)
+        with self._lock:
+            self._stats["calls"] += 1
+            self._stats["failures"] += failed
+            state = self._current_state()
+
+            if state == HALF_OPEN:
+                if probe:
+                    self._probes = max(0, self._probes - 1)
+                if failed:
+                    self._open("probe failed" if probe else "operation failed while half-open")
+                elif probe:
+                    self._close("probe succeeded")
+                return
+
+            self._outcomes.append(failed)
+            failures = sum(self._outcomes)
+            if (state == CLOSED and len(self._outcomes) >= self.min_calls
+                    and failures / len(self._outcomes) >= self.failure_rate):
+                self._open(f"{failures}/{len(self._outcomes)} recent calls failed")
+
+    def call(self, fn, *args, **kwargs):
+        """Run fn(*args, **kwargs) through the breaker"""
+        self.before_call()
+        try:
+            result = fn(*args, **kwargs)
+        except Exception as e:
+            self.record(e)
+            raise
+        self.record()
+        return result
+
+    def get_stats(self):
+        """Counters for /api/metrics"""
+        with self._lock:
+            stats = dict(self._stats)
+            stats["state"] = self._current_state()
+            stats["recent_failure_rate"] = (
+                round(sum(self._outcomes) / len(self._outcomes), 3) if self._outcomes else None
+            )
+        return stats
+
+    def _current_state(self):
+        """State with the open -> half-open timeout applied (caller holds the lock)"""
+        if self._state == OPEN and time.monotonic() - self._opened_at >= self.open_seconds:
+            self._state = HALF_OPEN
+            self._probes = 0
+        return self._state
+
+    def _close(self, reason):
+        print(f"✅ {self.name} circuit closed: {reason}")
+        self._state = CLOSED
+        self._outcomes.clear()
+
+    def _open(self, reason):
+        print(f"🔌 {self.name} circuit OPEN ({reason}) - failing fast for {self.open_seconds}s")
+        self._state = OPEN
+        self._opened_at = time.monotonic()
+        self._outcomes.clear()
+        self._stats["opened"] += 1
+
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+def get_circuit_breaker(upstream):
+    """Process-wide breaker for "gemini" or "veo" """
+    with _breakers_lock:
+        if upstream not in _breakers:
+            _breakers[upstream] = CircuitBreaker(upstream)
+        return _breakers[upstream]
+
+
+def get_breaker_stats():
+    """Stats of every breaker in use, keyed by upstream"""
+    with _breakers_lock:
+        breakers = dict(_breakers)
+    return {upstream: breaker.get_stats() for upstream, breaker in breakers.items()}
+
+
+class AdmissionController:
+    """Sheds requests up front instead of letting them pile up on a sick upstream"""
+
+    def __init__(self, max_in_flight=ADMISSION_MAX_IN_FLIGHT, breakers=get_circuit_breaker):
+        self.max_in_flight = max_in_flight
+        self._breakers = breakers
+        self._in_flight = 0
+        self._lock = threading.Lock()
+        self._stats = {"admitted": 0, "shed_circuit_open": 0, "shed_overloaded": 0}
+
+    def check(self, *upstreams):
+        """Raise Overloaded if a breaker for one of the upstreams is refusing calls"""
+        for upstream in upstreams:
+            breaker = self._breakers(upstream)
+            if breaker.rejecting():
+                self._count("shed_circuit_open")
+                breaker.record_rejected()
+                raise Overloaded(f"{upstream} is unavailable right now", max(1, breaker.retry_after()))
+
+    def enter(self, *upstreams):
+        """Take an in-flight slot (after check()); release it with leave()"""
+        self.check(*upstreams)
+        with self._lock:
+            if self._in_flight >= self.max_in_flight:
+                self._stats["shed_overloaded"] += 1
+                raise Overloaded(f"{self._in_flight} requests already in progress", ADMISSION_RETRY_AFTER_SECONDS)
+            self._in_flight += 1
+            self._stats["admitted"] += 1
+
+    def leave(self):
+        with self._lock:
+            self._in_flight -= 1
+
+    @contextmanager
+    def admit(self, *upstreams):
+        """Hold an in-flight slot for the duration of a synchronous request"""
+        self.enter(*upstreams)
+        try:
+            yield
+        finally:
+            self.leave()
+
+    def get_stats(self):
+        """Counters for /api/metrics"""
+        with self._lock:
+            return {**self._stats, "in_flight": self._in_flight, "max_in_flight": self.max_in_flight}
+
+    def _count(self, name):
+        with self._lock:
+            self._stats[name] += 1
+
+
+_admission = None
+_admission_lock = threading.Lock()
+
+
+def get_admission_controller():
+    """Process-wide admission controller used by app.py"""
+    global _admission
+    with _admission_lock:
+        if _admission is None:
+            _admission = AdmissionController()
+        return _admission
+
+
+if __name__ == "__main__":
+    # Fault injection: a fake upstream that hangs then 503s for 3s, hit by 8 clients
+    import contextlib
+    import io
+    from concurrent.futures import ThreadPoolExecutor
+
+    from retry_policy import UpstreamError
+
+    CLIENTS = 8
+    RUN_SECONDS = 5.0
+    OUTAGE = (1.0, 4.0)  # Upstream degraded between these offsets
+    HEALTHY_LATENCY = 0.02
+    DEGRADED_LATENCY = 0.5  # A sick upstream is slow *and* failing
+
+    class FakeUpstream:
+        def __init__(self):
+            self.start = time.monotonic()
+            self.calls_during_outage = 0
+            self.lock = threading.Lock()
+
+        def degraded(self):
+            return OUTAGE[0] <= time.monotonic() - self.start < OUTAGE[1]
+
+        def __call__(self):
+            if self.degraded():
+                with self.lock:
+                    self.calls_during_outage += 1
+                time.sleep(DEGRADED_LATENCY)
+                raise UpstreamError("Service unavailable", status_code=503)
+            time.sleep(HEALTHY_LATENCY)
+            return "ok"
+
+    def run(breaker):
+        upstream = FakeUpstream()
+        admission = AdmissionController(max_in_flight=CLIENTS, breakers=lambda _: breaker)
+        outcomes = []  # (offset, status, seconds)
+        lock = threading.Lock()
+
+        def client(_):
+            while time.monotonic() - upstream.start < RUN_SECONDS:
+                begin = time.monotonic()
+                try:
+                    with admission.admit("fake"):
+                        breaker.call(upstream)
+                    status = 200
+                except (Overloaded, CircuitOpenError):
+                    status = 503
+                except UpstreamError:
+                    status = 500
+                with lock:
+                    outcomes.append((begin - upstream.start, status, time.monotonic() - begin))
+                if status == 503:
+                    time.sleep(0.05)  # Client honours a (scaled down) Retry-After
+
+        with ThreadPoolExecutor(max_workers=CLIENTS) as pool, contextlib.redirect_stdout(io.StringIO()):
+            list(pool.map(client, range(CLIENTS)))
+
+        outage = [o for o in outcomes if OUTAGE[0] <= o[0] < OUTAGE[1]]
+        worker_seconds = sum(seconds for _, _, seconds in outage)
+        recovered_at = min((o[0] for o in outcomes if o[0] >= OUTAGE[1] and o[1] == 200), default=None)
+        return {
+            "upstream_calls": upstream.calls_during_outage,
+            "fast_503": sum(status == 503 for _, status, _ in outage),
+            "slow_500": sum(status == 500 for _, status, _ in outage),
+            "worker_seconds": worker_seconds,
+            "recovery": None if recovered_at is None else recovered_at - OUTAGE[1],
+            "stats": breaker.get_stats(),
+        }
+
+    no_breaker = run(CircuitBreaker("fake", enabled=False))
+    breaker = run(CircuitBreaker("fake", min_calls=8, window=10, open_seconds=1.0))
+
+    print(f"\n{'=' * 70}")
+    print(f"📊 {CLIENTS} clients, upstream hangs {DEGRADED_LATENCY * 1000:.0f} ms then 503s "
+          f"for {OUTAGE[1] - OUTAGE[0]:.0f}s")
+    for label, result in (("No breaker", no_breaker), ("Breaker (1s open)", breaker)):
+        recovery = "n/a" if result["recovery"] is None else f"{result['recovery'] * 1000:.0f} ms"
+        print(f"   {label}: {result['upstream_calls']} upstream calls during the outage, "
+              f"{result['slow_500']} slow failures, {result['fast_503']} fast 503s")
+        print(f"      server time spent on requests during the outage: {result['worker_seconds']:.1f}s, "
+              f"first success after recovery: {recovery}")
+    print(f"   Breaker stats: {breaker['stats']}")
+    print(f"{'=' * 70}")
+    assert breaker["upstream_calls"] < no_breaker["upstream_calls"], "breaker did not shed load"
+    assert breaker["stats"]["state"] == CLOSED, "breaker did not close after recovery"
+    assert breaker["stats"]["rejected"] >= breaker["fast_503"], "admission sheds missing from breaker stats"
+
+    # Veo-style split: the half-open probe resolves when the submit is accepted,
+    # not minutes later when the operation finishes
+    veo = CircuitBreaker("veo-fake", min_calls=2, window=2, open_seconds=0.05)
+    with contextlib.redirect_stdout(io.StringIO()):
+        for _ in range(2):
+            veo.record(UpstreamError("Service unavailable", status_code=503))
+        assert veo.rejecting()
+        time.sleep(0.06)
+        veo.before_call()  # The probe: submit a long operation
+        assert veo.rejecting(), "a second call should wait for the probe"
+        veo.accepted()
+        assert veo.state == CLOSED and not veo.rejecting(), "probe still held after the submit was accepted"
+        veo.record_outcome()  # The operation finishes later
+    assert veo.state == CLOSED and veo.get_stats()["calls"] == 3
+    print("   Veo probe resolved on submit acceptance: OK")
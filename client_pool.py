@@ -0,0 +1,173 @@
+"""
+Process-wide registry of Gemini/Veo SDK clients
+Building a genai.Client per request re-resolves credentials and opens a
+fresh HTTP connection pool every time. Clients here are created once per
+distinct option set (see MODEL_CLIENT_OPTIONS) and shared by all pipelines;
+both SDKs' clients are safe to use from several threads at once.
+"""
+import json
+import os
+import threading
+
+from google import genai
+from google.genai import types
+import google.generativeai as legacy_genai
+
+from config import MODEL_CLIENT_OPTIONS, GENERATIVE_MODEL_OPTIONS
+
+
+class ClientPool:
+    """Creates SDK clients lazily and hands out the same instance thereafter"""
+
+    def __init__(self, client_factory=None, model_factory=None):
+        """
+        Args:
+            client_factory: fn(http_options) -> genai.Client (default: real client)
+            model_factory: fn(model_name, **kwargs) -> GenerativeModel
+        """
+        self._client_factory = client_factory or _default_client_factory
+        self._model_factory = model_factory or legacy_genai.GenerativeModel
+        self._clients = {}
+        self._models = {}
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+
+        # Counters
+        self._clients_created = 0
+        self._models_created = 0
+        self._hits = 0
+
+    def get_client(self, model=None):
+        """
+        Shared google-genai Client configured for a model
+
+        Args:
+            model: Model name used to look up MODEL_CLIENT_OPTIONS (None = defaults)
+
+        Returns:
+            genai.Client - models with identical options share one instance
+        """
+        options = MODEL_CLIENT_OPTIONS.get(model, {})
+        key = json.dumps(options, sort_keys=True)
+
+        with self._lock:
+            self._reset_after_fork()
+            client = self._clients.get(key)
+            if client is None:
+                client = self._client_factory(options)
+                self._clients[key] = client
+                self._clients_created += 1
+                print(f"🔌 genai client created ({model or 'default'}, {len(self._clients)} pooled)")
+            else:
+                self._hits += 1
+            return client
+
+    def get_generative_model(self, model_name):
+        """Shared google-generativeai GenerativeModel for a model name"""
+        with self._lock:
+            self._reset_after_fork()
+            model = self._models.get(model_name)
+            if model is None:
+                model = self._model_factory(model_name, **GENERATIVE_MODEL_OPTIONS.get(model_name, {}))
+                self._models[model_name] = model
+                self._models_created += 1
+            else:
+                self._hits += 1
+            return model
+
+    def get_stats(self):
+        """Counters for /api/metrics"""
+        with self._lock:
+            return {
+                "genai_clients": len(self._clients),
+                "generative_models": len(self._models),
+                "clients_created": self._clients_created,
+                "models_created": self._models_created,
+                "reuse_hits": self._hits,
+            }
+
+    def _reset_after_fork(self):
+        # Connection pools must not be shared between forked workers (gunicorn preload)
+        if os.getpid() != self._pid:
+            self._clients.clear()
+            self._models.clear()
+            self._pid = os.getpid()
+
+
+def _default_client_factory(options):
+    if not options:
+        return genai.Client()
+    return genai.Client(http_options=types.HttpOptions(**options))
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_client_pool():
+    """Process-wide pool shared by every pipeline"""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ClientPool()
+        return _pool
+
+
+def get_client(model=None):
+    """Shortcut for get_client_pool().get_client(model)"""
+    return get_client_pool().get_client(model)
+
+
+def get_generative_model(model_name):
+    """Shortcut for get_client_pool().get_generative_model(model_name)"""
+    return get_client_pool().get_generative_model(model_name)
+
+
+if __name__ == "__main__":
+    # Benchmark: per-request client construction vs pooled client, over a stub transport
+    import time
+    import httpx
+
+    REQUESTS = 200
+    HANDSHAKE_MS = 40  # Simulated TCP+TLS setup paid on each new connection
+
+    class StubTransport(httpx.BaseTransport):
+        """Answers generateContent locally; first request per transport pays the handshake"""
+
+        def __init__(self):
+            self.connected = False
+
+        def handle_request(self, request):
+            if not self.connected:
+                time.sleep(HANDSHAKE_MS / 1000)
+                self.connected = True
+            body = {"candidates": [{"content": {"role": "model", "parts": [{"text": "ok"}]}}]}
+            return httpx.Response(200, json=body)
+
+    def stub_client(options=None):
+        return genai.Client(
+            api_key="benchmark",
+            http_options=types.HttpOptions(client_args={"transport": StubTransport()})
+        )
+
+    def one_request(client):
+        return client.models.generate_content(model="gemini-2.5-pro", contents="ping").text
+
+    start = time.perf_counter()
+    for _ in range(REQUESTS):
+        one_request(stub_client())
+    per_request_seconds = time.perf_counter() - start
+
+    pool = ClientPool(client_factory=stub_client)
+    start = time.perf_counter()
+    for _ in range(REQUESTS):
+        one_request(pool.get_client("gemini-2.5-pro"))
+    pooled_seconds = time.perf_counter() - start
+
+    print(f"\n{'=' * 70}")
+    print(f"📊 {REQUESTS} requests over a stub transport ({HANDSHAKE_MS} ms simulated handshake)")
+    print(f"   New client per request: {per_request_seconds * 1000 / REQUESTS:.2f} ms/request")
+    print(f"   Pooled client:          {pooled_seconds * 1000 / REQUESTS:.2f} ms/request")
+    print(f"   Setup overhead saved:   {(per_request_seconds - pooled_seconds) * 1000 / REQUESTS:.2f} ms/request")
+    print(f"   Pool: {pool.get_stats()}")
+    print(f"{'=' * 70}")
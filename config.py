@@ -3,6 +3,7 @@ Configuration file for product video generation pipeline
 UPDATED: Testing flags and cost controls
 """
 import os
+import tempfile
 from dotenv import load_dotenv
 
 # Load environment variables
@@ -40,6 +41,17 @@ USE_UNSPLASH_FALLBACK = True
 # ===========================
 GCS_BUCKET_NAME = os.getenv("GCS_BUCKET_NAME")
 GCS_OUTPUT_PREFIX = "veo-product-videos"
+GCS_EMULATOR_ROOT = os.getenv("GCS_EMULATOR_ROOT")  # Local directory stand-in for GCS (offline dev/benchmarks)
+
+# Segment downloads
+GCS_DOWNLOAD_MAX_WORKERS = 4  # Download threads shared by all requests (whole files and byte ranges)
+GCS_RANGED_DOWNLOAD_THRESHOLD_MB = 32  # Blobs above this are fetched as parallel ranges
+GCS_DOWNLOAD_CHUNK_MB = 8  # Range size for large blobs
+
+# Server-side assembly (fragmented MP4 via GCS compose - no local merge/upload)
+VIDEO_COMPOSE_ASSEMBLY = False  # Opt-in: falls back to local merge when segments aren't eligible
+GCS_COMPOSE_MAX_SOURCES = 32  # GCS limit per compose call
+GCS_COMPOSE_HEADER_PROBE_BYTES = 256 * 1024  # First read when locating a segment's moov/mdat
 
 # ===========================
 # Model Configuration
@@ -47,6 +59,101 @@ GCS_OUTPUT_PREFIX = "veo-product-videos"
 TEXT_MODEL = "gemini-2.5-pro"
 VIDEO_MODEL = "veo-3.1-generate-preview"
 
+# Shared SDK clients (client_pool.py) - one per distinct option set, reused by every request
+# Per-model HttpOptions overrides for google-genai clients, e.g. {VIDEO_MODEL: {"timeout": 60000}}
+MODEL_CLIENT_OPTIONS = {}
+# Per-model GenerativeModel kwargs (google-generativeai), e.g. {"gemini-2.5-pro": {"generation_config": {...}}}
+GENERATIVE_MODEL_OPTIONS = {}
+
+# Per-model quota (rate_limiter.py) - calls only wait when the budget is nearly spent
+MODEL_RATE_LIMITS = {
+    "gemini-2.5-pro": {"rpm": int(os.getenv("GEMINI_PRO_RPM", "150")), "tpm": int(os.getenv("GEMINI_PRO_TPM", "2000000"))},
+    "gemini-2.5-flash-image": {"rpm": int(os.getenv("GEMINI_IMAGE_RPM", "100")), "tpm": int(os.getenv("GEMINI_IMAGE_TPM", "1000000"))},
+}  # Models not listed are not throttled
+RATE_LIMIT_BURST_SECONDS = 10  # Bucket size: this many seconds of budget can be spent at once
+
+# Hedged image calls (hedging.py) - duplicate a straggler after the model's observed p90 latency
+HEDGE_ENABLED = os.getenv("HEDGE_ENABLED", "False") == "True"  # Opt-in: a hedge is a second billed call
+HEDGE_DELAY_QUANTILE = 0.9  # Hedge once a call outlives this quantile of recent latencies
+HEDGE_MIN_DELAY_SECONDS = 2.0  # Never hedge sooner than this
+HEDGE_MIN_SAMPLES = 20  # No hedging until this many latencies are known
+HEDGE_BUDGET_RATIO = float(os.getenv("HEDGE_BUDGET_RATIO", "0.05"))  # Max hedges per call (5% extra cost)
+HEDGE_BUDGET_BURST = 3  # Hedges that may be spent at once
+HEDGE_LATENCY_WINDOW = 500  # Recent latencies kept per model
+HEDGE_MAX_WORKERS = 16  # Threads running hedged calls (shared by all models)
+
+# Upload limits and spooling (upload_ingest.py) - large files stay on disk, not in worker memory
+UPLOAD_MAX_FILE_MB = int(os.getenv("UPLOAD_MAX_FILE_MB", "25"))  # Per file (413 above)
+UPLOAD_MAX_REQUEST_MB = int(os.getenv("UPLOAD_MAX_REQUEST_MB", "250"))  # Whole request (413 above)
+UPLOAD_SPOOL_THRESHOLD_KB = 512  # Files above this are spooled to a temp file and read via mmap
+UPLOAD_SPOOL_DIR = os.getenv("UPLOAD_SPOOL_DIR")  # None = system temp dir (keep off tmpfs)
+
+# Image ingest (image_ingest.py): uploads are decoded, oriented and downsized once per request
+IMAGE_INGEST_MAX_DIMENSION = int(os.getenv("IMAGE_INGEST_MAX_DIMENSION", "1536"))  # Longest edge sent to models
+IMAGE_INGEST_JPEG_QUALITY = 90
+IMAGE_INGEST_ALPHA_FORMAT = "WEBP"  # For images with real transparency (JPEG has no alpha)
+
+# Batch image edits (/api/edit-image with several images)
+EDIT_POOL_MAX_WORKERS = int(os.getenv("EDIT_POOL_MAX_WORKERS", "8"))  # Shared by all requests
+EDIT_BATCH_MAX_CONCURRENCY = int(os.getenv("EDIT_BATCH_MAX_CONCURRENCY", "4"))  # Per request, so one batch can't take the whole pool
+
+# Batch planning: "per_image" (one planner call per image), "shared" (plan once on the
+# first image) or "shared_montage" (plan once on a grid of the batch). Per-request override: planning_mode
+EDIT_PLANNING_MODES = ("per_image", "shared", "shared_montage")
+EDIT_DEFAULT_PLANNING_MODE = "per_image"
+EDIT_MONTAGE_MAX_IMAGES = 4  # Images tiled into the planning montage
+EDIT_MONTAGE_TILE_PX = 512  # Tile edge length in the montage
+
+# Edit result cache (result_cache.py): identical image + operation -> stored Cloudinary URL
+RESULT_CACHE_ENABLED = os.getenv("RESULT_CACHE_ENABLED", "True") == "True"
+RESULT_CACHE_BACKEND = os.getenv("RESULT_CACHE_BACKEND", "sqlite")  # "sqlite" (single node) or "memory"
+RESULT_CACHE_DB_PATH = os.getenv(
+    "RESULT_CACHE_DB_PATH",
+    os.path.join(tempfile.gettempdir(), "product_creative_cache.sqlite3")
+)
+RESULT_CACHE_TTL_SECONDS = int(os.getenv("RESULT_CACHE_TTL_SECONDS", str(7 * 24 * 3600)))
+RESULT_CACHE_MAX_ENTRIES = int(os.getenv("RESULT_CACHE_MAX_ENTRIES", "10000"))  # LRU bound
+
+# Planner output cache: same template + inputs + (perceptually) same photo -> reuse the planned prompt.
+# Off by default: the planner prompts carry intentionally unique Request-ID lines.
+PLANNER_CACHE_ENABLED = os.getenv("PLANNER_CACHE_ENABLED", "False") == "True"
+PLANNER_CACHE_BACKEND = os.getenv("PLANNER_CACHE_BACKEND", "memory")  # "memory" or "sqlite"
+PLANNER_CACHE_DB_PATH = os.getenv(
+    "PLANNER_CACHE_DB_PATH",
+    os.path.join(tempfile.gettempdir(), "product_creative_planner_cache.sqlite3")
+)
+PLANNER_CACHE_TTL_SECONDS = int(os.getenv("PLANNER_CACHE_TTL_SECONDS", str(24 * 3600)))
+PLANNER_CACHE_MAX_ENTRIES = int(os.getenv("PLANNER_CACHE_MAX_ENTRIES", "2000"))
+PLANNER_CACHE_HASH_DISTANCE = 6  # dHash bits (of 64) a re-encoded/resized copy may differ by and still hit
+
+# Local edit engines (local_engines.py): pixel operations run in-process, no model calls.
+# Operations opt in via "local_engine" in operations_config.OPERATIONS.
+LOCAL_ENGINES_ENABLED = os.getenv("LOCAL_ENGINES_ENABLED", "True") == "True"
+LOCAL_ENGINE_REMOTE_FALLBACK = True  # Details the engine can't parse ("match Toro red") go to the models
+LOCAL_ENGINE_JPEG_QUALITY = 95  # Output for opaque images (PNG when there is alpha)
+LOCAL_ENGINE_MAX_DIMENSION = 6144  # Engines work on the upload itself, downsized only past this (float engines: ~12 bytes/pixel)
+BACKGROUND_REMOVAL_MIN_CONFIDENCE = 0.6  # Below this (busy or product-coloured backdrop) the models do the cut-out
+BACKGROUND_REMOVAL_EDGE_PX = 2  # Half-width of the soft matte band around the product outline
+# Tiled engines (denoise, upscale) render tile by tile in worker processes; 0 processes = in the request thread.
+# Each web worker starts its own pool, so keep this small (the pool is per process, not per machine)
+LOCAL_ENGINE_PROCESSES = int(os.getenv("LOCAL_ENGINE_PROCESSES", "2"))
+LOCAL_ENGINE_TILE_PX = 512  # Output tile edge: bounds the float working set per tile
+LOCAL_ENGINE_TILES_IN_FLIGHT = 2 * max(LOCAL_ENGINE_PROCESSES, 1)  # Submitted but not yet written back
+DENOISE_DEFAULT_STRENGTH = 0.6  # Operation 26 default ("60% on smooth areas")
+UPSCALE_DEFAULT_SIZE = (3840, 2160)  # Operation 27 default: fit within 4K, aspect ratio kept
+UPSCALE_MAX_PIXELS = 36_000_000  # Output cap (about 6000x6000)
+UPSCALE_SHARPEN = 0.3  # Unsharp amount after the Lanczos resample when none is asked for
+WATERMARK_DEFAULT_WIDTH = 0.09  # Logo width as a fraction of the image width (operation 38 default: 8-10%)
+WATERMARK_TEXT_WIDTH = 0.25  # Same for a text mark, which is much wider than tall
+WATERMARK_DEFAULT_OPACITY = 0.55  # Operation 38 default: 50-60%
+WATERMARK_TILE_OPACITY = 0.2  # Tiled marks cover the product, so they default lighter
+WATERMARK_MARGIN = 0.04  # Safe margin from the edges, fraction of the shorter side
+WATERMARK_SHADOW_OPACITY = 0.25
+WATERMARK_CACHE_ENTRIES = 32  # Rasterised logos/texts kept (each holds a few sized copies)
+PERSPECTIVE_MIN_CONFIDENCE = 0.5  # Below this (too few straight lines, or they disagree) the models correct it
+PERSPECTIVE_MAX_TILT = 20.0  # Degrees: lines closer than this to vertical/horizontal are taken as meant to be
+PERSPECTIVE_WORKING_PX = 800  # Line detection runs on a copy downsized to this longest edge
+
 # ===========================
 # TESTING & COST CONTROL FLAGS for video
 # ===========================
@@ -79,6 +186,70 @@ MAX_IMAGES = 3
 MIN_SEGMENT_DURATION = 6
 MAX_SEGMENT_DURATION = 10
 
+# ===========================
+# Veo Concurrency
+# ===========================
+VEO_CONCURRENT_SEGMENTS = True  # Submit all segments up front instead of one by one
+VEO_MAX_IN_FLIGHT = int(os.getenv("VEO_MAX_IN_FLIGHT", "3"))  # Respect Veo quota
+VEO_SEGMENT_MAX_RETRIES = 3  # Attempts per segment
+
+# ===========================
+# Veo Operation Polling (operation_poller.py)
+# ===========================
+# One shared poller thread for all operations: fast early polls, exponential later, jittered
+VEO_POLL_INITIAL_INTERVAL = 5  # Seconds before the first poll
+VEO_POLL_MAX_INTERVAL = 30  # Cap on the backed-off interval
+VEO_POLL_BACKOFF = 1.5  # Interval multiplier after each unfinished poll
+VEO_POLL_JITTER = 0.2  # +/- fraction applied to every interval
+VEO_OPERATION_TIMEOUT = 900  # Deadline per operation (seconds)
+
+# ===========================
+# Retries (retry_policy.py)
+# ===========================
+# Exponential backoff with full jitter; only transient errors (429, 5xx, timeouts,
+# connection resets) are retried. deadline = seconds for all attempts of one call.
+RETRY_POLICIES = {
+    "gemini": {"max_attempts": 4, "base_delay": 2.0, "max_delay": 30.0, "deadline": 180},
+    "veo": {"max_attempts": VEO_SEGMENT_MAX_RETRIES, "base_delay": 10.0, "max_delay": 60.0, "deadline": None},
+    "gcs": {"max_attempts": 4, "base_delay": 0.5, "max_delay": 8.0, "deadline": 300},
+    "cloudinary": {"max_attempts": 4, "base_delay": 1.0, "max_delay": 10.0, "deadline": 60},
+}
+RETRY_BUDGET_RATIO = 0.2  # Retries may add at most 20% to an upstream's traffic...
+RETRY_BUDGET_BURST = 10  # ...beyond this many banked retries
+
+# ===========================
+# Circuit Breakers & Load Shedding (circuit_breaker.py)
+# ===========================
+# A breaker opens when most recent calls to an upstream failed transiently
+# (5xx, 429, timeouts); new requests then get 503 + Retry-After right away
+CIRCUIT_BREAKER_ENABLED = os.getenv("CIRCUIT_BREAKER_ENABLED", "True") == "True"
+CIRCUIT_FAILURE_RATE = 0.5  # Open above this failure rate...
+CIRCUIT_MIN_CALLS = 10  # ...once the window holds this many outcomes
+CIRCUIT_WINDOW = 20  # Recent outcomes considered
+CIRCUIT_OPEN_SECONDS = 30  # Wait before a half-open probe call
+CIRCUIT_HALF_OPEN_PROBES = 1  # Probe calls allowed while half-open
+ADMISSION_MAX_IN_FLIGHT = int(os.getenv("ADMISSION_MAX_IN_FLIGHT", "16"))  # Sync generate/edit requests at once
+ADMISSION_RETRY_AFTER_SECONDS = 5  # Retry-After when shedding for load (not an open breaker)
+
+# ===========================
+# Background Job Queue
+# ===========================
+# Long-running pipelines (video generation) run on a bounded worker pool
+# and report state through /api/jobs/<id> instead of holding a request open.
+JOB_QUEUE_DB_PATH = os.getenv(
+    "JOB_QUEUE_DB_PATH",
+    os.path.join(tempfile.gettempdir(), "product_creative_jobs.sqlite3")
+)
+JOB_MAX_WORKERS = int(os.getenv("JOB_MAX_WORKERS", "2"))  # Concurrent pipelines per process
+JOB_MAX_PENDING = int(os.getenv("JOB_MAX_PENDING", "50"))  # Queued + running jobs before rejecting
+
+# Progress events (progress_events.py) - SSE stream at /api/jobs/<id>/events
+PROGRESS_EVENT_HISTORY = 500  # Events kept per job for Last-Event-ID replay
+PROGRESS_EVENT_RETENTION_SECONDS = 600  # Finished jobs' events stay replayable this long
+SSE_MAX_STREAM_SECONDS = int(os.getenv("SSE_MAX_STREAM_SECONDS", "60"))  # Then the client reconnects
+SSE_KEEPALIVE_SECONDS = 15  # Comment frames so proxies don't drop idle streams
+SSE_RETRY_MS = 2000  # Reconnect delay advertised to EventSource
+
 # ===========================
 # Video Quality Settings
 # ===========================
@@ -87,6 +258,13 @@ VIDEO_RESOLUTION = "720p" if USE_LOWER_RESOLUTION else "1080p"  # Dynamic based
 VIDEO_FPS = 24
 VIDEO_CODEC = "libx264"
 VIDEO_PRESET = "medium"
+VIDEO_STREAM_COPY_MERGE = True  # Concat identical segments without re-encoding (MoviePy fallback)
+
+# Per-request scratch directories for merging (isolated so merges can run concurrently)
+VIDEO_WORKSPACE_ROOT = os.getenv("VIDEO_WORKSPACE_ROOT")  # None = auto (tmpfs, then system temp)
+VIDEO_WORKSPACE_USE_TMPFS = True  # Prefer /dev/shm when it has room
+VIDEO_WORKSPACE_TMPFS_MIN_FREE_MB = 512  # Fall back to disk below this
+VIDEO_WORKSPACE_STALE_SECONDS = 3600  # Age before a dead process's workspace is swept
 
 # ===========================
 # E-Commerce Video Rules
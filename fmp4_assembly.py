@@ -0,0 +1,655 @@
+"""
+Server-side final video assembly with GCS compose
+Builds a fragmented MP4 whose sample payloads are the untouched segment
+objects already sitting in the bucket:
+
+    final = compose([init, prefix_1, segment_1, prefix_2, segment_2, ...])
+
+    init     = ftyp + moov (sample descriptions only, mvex) + sidx index
+    prefix_i = moof describing segment_i's samples + a 'skip' box header
+               that hides segment_i's own ftyp/moov, leaving its mdat as
+               the payload the moof points into
+
+Only segment headers (ftyp/moov) are read and only these small pieces are
+uploaded - the worker never holds the video payload. Requires every
+segment to store its mdat last (moov first, i.e. "faststart") and to share
+sample descriptions; otherwise the caller falls back to a local merge.
+"""
+import struct
+
+from config import GCS_COMPOSE_HEADER_PROBE_BYTES
+
+SAMPLE_FLAGS_SYNC = 0x02000000      # sample_depends_on = 2 (I-frame)
+SAMPLE_FLAGS_NON_SYNC = 0x01010000  # sample_depends_on = 1, is_non_sync_sample
+TFHD_DEFAULT_BASE_IS_MOOF = 0x020000
+TRUN_DATA_OFFSET = 0x000001
+TRUN_DURATION = 0x000100
+TRUN_SIZE = 0x000200
+TRUN_FLAGS = 0x000400
+TRUN_CTO = 0x000800
+SKIP_HEADER_SIZE = 8
+SAMPLE_ENTRY_CHILDREN = {b"vide": 86, b"soun": 36}  # Offset of the child boxes in a (v0) sample entry
+
+
+class AssemblyNotPossible(Exception):
+    """Segments can't be composed server-side (layout or codec mismatch)"""
+
+
+# ===========================
+# Box helpers
+# ===========================
+
+def _box(box_type, payload):
+    return struct.pack(">I4s", 8 + len(payload), box_type) + payload
+
+
+def _full_box(box_type, version, flags, payload):
+    return _box(box_type, struct.pack(">I", (version << 24) | flags) + payload)
+
+
+def _children(data, start, end):
+    """Yield (type, box_start, payload_start, box_end) for boxes in data[start:end]"""
+    pos = start
+    while pos + 8 <= end:
+        size, box_type = struct.unpack_from(">I4s", data, pos)
+        header = 8
+        if size == 1:
+            size = struct.unpack_from(">Q", data, pos + 8)[0]
+            header = 16
+        elif size == 0:
+            size = end - pos
+        if size < header or pos + size > end:
+            raise AssemblyNotPossible(f"Malformed '{box_type.decode(errors='replace')}' box")
+        yield box_type, pos, pos + header, pos + size
+        pos += size
+
+
+def _child(data, start, end, box_type):
+    for found_type, box_start, payload_start, box_end in _children(data, start, end):
+        if found_type == box_type:
+            return box_start, payload_start, box_end
+    return None
+
+
+def _require(data, start, end, box_type):
+    found = _child(data, start, end, box_type)
+    if not found:
+        raise AssemblyNotPossible(f"Missing '{box_type.decode()}' box")
+    return found
+
+
+# ===========================
+# Segment parsing
+# ===========================
+
+class _Track:
+    """One trak's description boxes plus its expanded sample table"""
+
+    def __init__(self):
+        self.track_id = None
+        self.handler = None
+        self.timescale = None
+        self.tkhd = None
+        self.mdhd = None
+        self.hdlr = None
+        self.minf_boxes = []  # vmhd/smhd/dinf etc. (everything except stbl)
+        self.stsd = None
+        self.runs = []        # [(chunk_offset, [(size, duration, cto, is_sync), ...])]
+        self.duration = 0
+        self.has_cto = False
+        self.negative_cto = False
+        self.media_time = 0   # Edit list start (B-frame delay, AAC priming), in track timescale
+
+
+class SegmentLayout:
+    """Top-level layout and parsed moov of one segment object"""
+
+    def __init__(self, gcs_uri, size, mdat_offset, header):
+        self.gcs_uri = gcs_uri
+        self.size = size
+        self.mdat_offset = mdat_offset
+        self.movie_timescale = None
+        self.mvhd = None
+        self.tracks = []
+        self._parse_moov(header)
+
+    def _parse_moov(self, data):
+        moov = _require(data, 0, len(data), b"moov")
+        _, moov_payload, moov_end = moov
+
+        mvhd_start, mvhd_payload, mvhd_end = _require(data, moov_payload, moov_end, b"mvhd")
+        self.mvhd = data[mvhd_start:mvhd_end]
+        version = data[mvhd_payload]
+        self.movie_timescale = struct.unpack_from(
+            ">I", data, mvhd_payload + (20 if version == 1 else 12)
+        )[0]
+
+        for box_type, _, payload_start, box_end in _children(data, moov_payload, moov_end):
+            if box_type == b"trak":
+                self.tracks.append(_parse_track(data, payload_start, box_end))
+
+        if not self.tracks:
+            raise AssemblyNotPossible("Segment has no tracks")
+
+
+def _parse_track(data, start, end):
+    track = _Track()
+
+    tkhd_start, tkhd_payload, tkhd_end = _require(data, start, end, b"tkhd")
+    track.tkhd = data[tkhd_start:tkhd_end]
+    track.track_id = struct.unpack_from(
+        ">I", data, tkhd_payload + (20 if data[tkhd_payload] == 1 else 12)
+    )[0]
+
+    edts = _child(data, start, end, b"edts")
+    if edts:
+        track.media_time = _edit_media_time(data, edts[1], edts[2])
+
+    _, mdia_payload, mdia_end = _require(data, start, end, b"mdia")
+
+    mdhd_start, mdhd_payload, mdhd_end = _require(data, mdia_payload, mdia_end, b"mdhd")
+    track.mdhd = data[mdhd_start:mdhd_end]
+    track.timescale = struct.unpack_from(
+        ">I", data, mdhd_payload + (20 if data[mdhd_payload] == 1 else 12)
+    )[0]
+
+    hdlr_start, hdlr_payload, hdlr_end = _require(data, mdia_payload, mdia_end, b"hdlr")
+    track.hdlr = data[hdlr_start:hdlr_end]
+    track.handler = data[hdlr_payload + 8:hdlr_payload + 12]
+
+    _, minf_payload, minf_end = _require(data, mdia_payload, mdia_end, b"minf")
+    stbl = None
+    for box_type, box_start, payload_start, box_end in _children(data, minf_payload, minf_end):
+        if box_type == b"stbl":
+            stbl = (payload_start, box_end)
+        else:
+            track.minf_boxes.append(data[box_start:box_end])
+    if not stbl:
+        raise AssemblyNotPossible("Missing 'stbl' box")
+
+    _parse_sample_table(data, stbl[0], stbl[1], track)
+    return track
+
+
+def _edit_media_time(data, start, end):
+    """Media time the presentation starts at: a single edit, optionally after an empty one at 0"""
+    _, p, _ = _require(data, start, end, b"elst")
+    version = data[p]
+    count = struct.unpack_from(">I", data, p + 4)[0]
+    entry_format = ">Qq" if version == 1 else ">Ii"
+    entries = [struct.unpack_from(entry_format, data, p + 8 + i * struct.calcsize(entry_format))
+               for i in range(count)]
+    edits = [media_time for _, media_time in entries if media_time != -1]
+    empty = [duration for duration, media_time in entries if media_time == -1]
+    if len(edits) != 1 or any(empty):
+        raise AssemblyNotPossible("Unsupported edit list")
+    return edits[0]
+
+
+def _parse_sample_table(data, start, end, track):
+    boxes = {
+        box_type: (box_start, payload_start, box_end)
+        for box_type, box_start, payload_start, box_end in _children(data, start, end)
+    }
+
+    stsd_start, _, stsd_end = boxes.get(b"stsd") or _require(data, start, end, b"stsd")
+    track.stsd = data[stsd_start:stsd_end]
+
+    # Sample sizes
+    _, p, _ = boxes.get(b"stsz") or _require(data, start, end, b"stsz")
+    uniform_size, sample_count = struct.unpack_from(">II", data, p + 4)
+    if uniform_size:
+        sizes = [uniform_size] * sample_count
+    else:
+        sizes = list(struct.unpack_from(f">{sample_count}I", data, p + 12))
+
+    # Chunk offsets
+    if b"stco" in boxes:
+        p = boxes[b"stco"][1]
+        count = struct.unpack_from(">I", data, p + 4)[0]
+        chunk_offsets = struct.unpack_from(f">{count}I", data, p + 8)
+    elif b"co64" in boxes:
+        p = boxes[b"co64"][1]
+        count = struct.unpack_from(">I", data, p + 4)[0]
+        chunk_offsets = struct.unpack_from(f">{count}Q", data, p + 8)
+    else:
+        raise AssemblyNotPossible("Missing chunk offset box")
+
+    # Samples per chunk
+    _, p, _ = boxes.get(b"stsc") or _require(data, start, end, b"stsc")
+    count = struct.unpack_from(">I", data, p + 4)[0]
+    stsc = [struct.unpack_from(">III", data, p + 8 + i * 12) for i in range(count)]
+    if any(entry[2] != 1 for entry in stsc):
+        raise AssemblyNotPossible("Multiple sample descriptions per track")
+    samples_per_chunk = []
+    for i, (first_chunk, per_chunk, _) in enumerate(stsc):
+        last_chunk = stsc[i + 1][0] - 1 if i + 1 < len(stsc) else len(chunk_offsets)
+        samples_per_chunk.extend([per_chunk] * (last_chunk - first_chunk + 1))
+
+    # Durations
+    _, p, _ = boxes.get(b"stts") or _require(data, start, end, b"stts")
+    count = struct.unpack_from(">I", data, p + 4)[0]
+    durations = []
+    for i in range(count):
+        run, delta = struct.unpack_from(">II", data, p + 8 + i * 8)
+        durations.extend([delta] * run)
+
+    # Composition offsets (B-frames)
+    ctts = [0] * sample_count
+    if b"ctts" in boxes:
+        p = boxes[b"ctts"][1]
+        signed = data[p] == 1
+        count = struct.unpack_from(">I", data, p + 4)[0]
+        ctts = []
+        for i in range(count):
+            run, offset = struct.unpack_from(">Ii" if signed else ">II", data, p + 8 + i * 8)
+            ctts.extend([offset] * run)
+        track.has_cto = True
+        track.negative_cto = any(offset < 0 for offset in ctts)
+
+    # Sync samples (absent = every sample is a sync sample)
+    sync = None
+    if b"stss" in boxes:
+        p = boxes[b"stss"][1]
+        count = struct.unpack_from(">I", data, p + 4)[0]
+        sync = set(struct.unpack_from(f">{count}I", data, p + 8))
+
+    if not (len(sizes) == len(durations) == len(ctts) == sum(samples_per_chunk[:len(chunk_offsets)])):
+        raise AssemblyNotPossible("Inconsistent sample tables")
+
+    # Expand into contiguous runs (adjacent chunks of the same track are merged)
+    index = 0
+    for chunk_offset, per_chunk in zip(chunk_offsets, samples_per_chunk):
+        samples = []
+        for _ in range(per_chunk):
+            samples.append((
+                sizes[index],
+                durations[index],
+                ctts[index],
+                sync is None or (index + 1) in sync,
+            ))
+            index += 1
+
+        if track.runs:
+            previous_offset, previous_samples = track.runs[-1]
+            if previous_offset + sum(s[0] for s in previous_samples) == chunk_offset:
+                previous_samples.extend(samples)
+                continue
+        track.runs.append((chunk_offset, samples))
+
+    track.duration = sum(durations)
+
+
+# ===========================
+# Piece builders
+# ===========================
+
+def _set_duration(box, version_offset, duration_offset_v0, duration_offset_v1, duration):
+    """Return a copy of a header box with its duration field replaced"""
+    box = bytearray(box)
+    if box[version_offset] == 1:
+        struct.pack_into(">Q", box, duration_offset_v1, duration)
+    else:
+        struct.pack_into(">I", box, duration_offset_v0, min(duration, 0xFFFFFFFF))
+    return bytes(box)
+
+
+def build_init(segments, prefixes):
+    """ftyp + moov (descriptions only, mvex) + sidx indexing every segment"""
+    first = segments[0]
+    movie_timescale = first.movie_timescale
+
+    track_totals = [sum(seg.tracks[i].duration for seg in segments) for i in range(len(first.tracks))]
+    movie_duration = max(
+        total * movie_timescale // track.timescale
+        for total, track in zip(track_totals, first.tracks)
+    )
+
+    ftyp = _box(b"ftyp", b"isom" + struct.pack(">I", 0x200) + b"isomiso6mp41")
+
+    # Box header (8) + version/flags (4): durations sit at fixed offsets after that
+    mvhd = _set_duration(first.mvhd, 8, 8 + 4 + 12, 8 + 4 + 20, movie_duration)
+
+    traks = []
+    trexs = []
+    for track in first.tracks:
+        tkhd = _set_duration(track.tkhd, 8, 8 + 4 + 16, 8 + 4 + 24, movie_duration)
+        mdhd = _set_duration(track.mdhd, 8, 8 + 4 + 12, 8 + 4 + 20, 0)
+
+        stbl = _box(b"stbl", b"".join([
+            track.stsd,
+            _full_box(b"stts", 0, 0, struct.pack(">I", 0)),
+            _full_box(b"stsc", 0, 0, struct.pack(">I", 0)),
+            _full_box(b"stsz", 0, 0, struct.pack(">II", 0, 0)),
+            _full_box(b"stco", 0, 0, struct.pack(">I", 0)),
+        ]))
+        minf = _box(b"minf", b"".join(track.minf_boxes) + stbl)
+        mdia = _box(b"mdia", mdhd + track.hdlr + minf)
+        # The first segment's start offset applies to the whole timeline: later segments
+        # continue from its decode times, so their own (identical) offsets line up
+        edts = b""
+        if track.media_time:
+            track_duration = track_totals[len(traks)] - track.media_time
+            edts = _box(b"edts", _full_box(b"elst", 1, 0, struct.pack(
+                ">IQqhh", 1, track_duration * movie_timescale // track.timescale, track.media_time, 1, 0
+            )))
+        traks.append(_box(b"trak", tkhd + edts + mdia))
+
+        trexs.append(_full_box(b"trex", 0, 0, struct.pack(">IIIII", track.track_id, 1, 0, 0, 0)))
+
+    mvex = _box(b"mvex", _full_box(b"mehd", 1, 0, struct.pack(">Q", movie_duration)) + b"".join(trexs))
+    moov = _box(b"moov", mvhd + b"".join(traks) + mvex)
+
+    # Index: one reference per (prefix + segment) pair, timed by the first track
+    reference_track = first.tracks[0]
+    references = b"".join(
+        struct.pack(
+            ">III",
+            len(prefix) + segment.size,
+            segment.tracks[0].duration,
+            0x90000000  # starts_with_SAP = 1, SAP_type = 1
+        )
+        for prefix, segment in zip(prefixes, segments)
+    )
+    sidx = _full_box(b"sidx", 1, 0, struct.pack(
+        ">IIQQHH",
+        reference_track.track_id,
+        reference_track.timescale,
+        0,   # earliest_presentation_time
+        0,   # first_offset: first moof follows immediately
+        0,
+        len(segments)
+    ) + references)
+
+    return ftyp + moov + sidx
+
+
+def build_prefix(sequence_number, segment, decode_times):
+    """moof for one segment + 'skip' header swallowing its ftyp/moov"""
+    moof = _build_moof(sequence_number, segment, decode_times, moof_size=0)
+    moof = _build_moof(sequence_number, segment, decode_times, moof_size=len(moof))
+
+    skip_size = SKIP_HEADER_SIZE + segment.mdat_offset
+    if skip_size > 0xFFFFFFFF:
+        raise AssemblyNotPossible("Segment header too large")
+    return moof + struct.pack(">I4s", skip_size, b"skip")
+
+
+def _build_moof(sequence_number, segment, decode_times, moof_size):
+    """
+    Sample data sits at: moof start + moof_size + skip header + offset in segment,
+    so every trun data_offset is relative to the moof (default-base-is-moof).
+    """
+    trafs = []
+    for track, decode_time in zip(segment.tracks, decode_times):
+        flags = TRUN_DATA_OFFSET | TRUN_DURATION | TRUN_SIZE | TRUN_FLAGS
+        if track.has_cto:
+            flags |= TRUN_CTO
+        version = 1 if track.negative_cto else 0
+
+        truns = []
+        for chunk_offset, samples in track.runs:
+            data_offset = moof_size + SKIP_HEADER_SIZE + chunk_offset
+            entries = []
+            for size, duration, cto, is_sync in samples:
+                sample_flags = SAMPLE_FLAGS_SYNC if is_sync else SAMPLE_FLAGS_NON_SYNC
+                entries.append(struct.pack(">III", duration, size, sample_flags))
+                if track.has_cto:
+                    entries.append(struct.pack(">i" if version else ">I", cto))
+            truns.append(_full_box(
+                b"trun", version, flags,
+                struct.pack(">Ii", len(samples), data_offset) + b"".join(entries)
+            ))
+
+        tfhd = _full_box(b"tfhd", 0, TFHD_DEFAULT_BASE_IS_MOOF, struct.pack(">I", track.track_id))
+        tfdt = _full_box(b"tfdt", 1, 0, struct.pack(">Q", decode_time))
+        trafs.append(_box(b"traf", tfhd + tfdt + b"".join(truns)))
+
+    mfhd = _full_box(b"mfhd", 0, 0, struct.pack(">I", sequence_number))
+    return _box(b"moof", mfhd + b"".join(trafs))
+
+
+# ===========================
+# Orchestration
+# ===========================
+
+def read_segment_layout(gcs_manager, gcs_uri):
+    """Walk top-level boxes with range reads and parse everything before mdat"""
+    size = gcs_manager.get_blob_size(gcs_uri)
+    probe = gcs_manager.read_range(gcs_uri, 0, min(size, GCS_COMPOSE_HEADER_PROBE_BYTES) - 1)
+
+    pos = 0
+    while True:
+        if pos + 8 > size:
+            raise AssemblyNotPossible("Reached end of file without mdat")
+
+        # Make sure the (possibly 64-bit) box header at pos has been fetched
+        needed = min(size, pos + 16)
+        if len(probe) < needed:
+            probe += gcs_manager.read_range(gcs_uri, len(probe), needed - 1)
+
+        box_size, box_type = struct.unpack_from(">I4s", probe, pos)
+        if box_size == 1:
+            box_size = struct.unpack_from(">Q", probe, pos + 8)[0]
+        elif box_size == 0:
+            box_size = size - pos
+
+        if box_type == b"mdat":
+            if pos + box_size != size:
+                raise AssemblyNotPossible("mdat is not the last box (moov at end?)")
+            break
+
+        if box_size < 8:
+            raise AssemblyNotPossible("Malformed top-level box")
+        pos += box_size
+
+    if len(probe) < pos:
+        probe += gcs_manager.read_range(gcs_uri, len(probe), pos - 1)
+
+    return SegmentLayout(gcs_uri, size, pos, probe[:pos])
+
+
+def check_compatible(segments):
+    """Every segment must share timescales and sample descriptions"""
+    first = segments[0]
+    for segment in segments[1:]:
+        if segment.movie_timescale != first.movie_timescale:
+            raise AssemblyNotPossible("Movie timescales differ")
+        if len(segment.tracks) != len(first.tracks):
+            raise AssemblyNotPossible("Track counts differ")
+        for track, reference in zip(segment.tracks, first.tracks):
+            if (track.track_id, track.handler, track.timescale, track.media_time) != \
+                    (reference.track_id, reference.handler, reference.timescale, reference.media_time):
+                raise AssemblyNotPossible("Track layout differs")
+            if _codec_parameters(track) != _codec_parameters(reference):
+                raise AssemblyNotPossible("Sample descriptions (codec parameters) differ")
+
+
+def _codec_parameters(track):
+    """
+    A track's stsd with the informational bitrate fields zeroed
+
+    btrt and the esds DecoderConfigDescriptor carry each encode's own
+    buffer size and bitrates, which differ between any two segments and
+    play no part in decoding.
+    """
+    stsd = bytearray(track.stsd)
+    children = SAMPLE_ENTRY_CHILDREN.get(track.handler)
+    if children is None:
+        return bytes(stsd)
+    # Box header (8) + version/flags (4) + entry_count (4)
+    for _, entry_start, _, entry_end in _children(stsd, 16, len(stsd)):
+        for box_type, _, payload_start, box_end in _children(stsd, entry_start + children, entry_end):
+            if box_type == b"btrt":
+                stsd[payload_start:box_end] = bytes(box_end - payload_start)
+            elif box_type == b"esds":
+                _zero_esds_bitrates(stsd, payload_start + 4, box_end)
+    return bytes(stsd)
+
+
+def _zero_esds_bitrates(data, pos, end):
+    """Zero bufferSizeDB/maxBitrate/avgBitrate in an ES_Descriptor's DecoderConfigDescriptor"""
+    def descriptor_header(pos):
+        tag, length = data[pos], 0
+        pos += 1
+        for _ in range(4):
+            byte = data[pos]
+            pos += 1
+            length = (length << 7) | (byte & 0x7F)
+            if not byte & 0x80:
+                break
+        return tag, pos
+
+    tag, pos = descriptor_header(pos)
+    if tag != 0x03:
+        return
+    flags = data[pos + 2]
+    pos += 3  # ES_ID + flags
+    if flags & 0x80:
+        pos += 2  # dependsOn_ES_ID
+    if flags & 0x40:
+        pos += 1 + data[pos]  # URL
+    if flags & 0x20:
+        pos += 2  # OCR_ES_ID
+    tag, pos = descriptor_header(pos)
+    if tag == 0x04 and pos + 13 <= end:
+        data[pos + 2:pos + 13] = bytes(11)  # After objectTypeIndication and streamType
+
+
+def assemble_with_compose(gcs_manager, video_gcs_uris):
+    """
+    Produce final_merged_video.mp4 by server-side compose
+
+    Returns:
+        Same dict as GCSManager.upload_final_video, or None when the
+        segments are not eligible (caller should merge locally)
+    """
+    print(f"\n{'=' * 70}")
+    print(f"🧩 SERVER-SIDE ASSEMBLY ({len(video_gcs_uris)} segments)")
+    print(f"{'=' * 70}")
+
+    try:
+        for uri in video_gcs_uris:
+            if not uri.startswith(f"gs://{gcs_manager.bucket_name}/"):
+                raise AssemblyNotPossible(f"Segment outside bucket {gcs_manager.bucket_name}: {uri}")
+
+        segments = [read_segment_layout(gcs_manager, uri) for uri in video_gcs_uris]
+        check_compatible(segments)
+    except AssemblyNotPossible as e:
+        print(f"ℹ️ Compose assembly not possible: {e}")
+        return None
+
+    # Build one prefix per segment; decode times continue across segments
+    prefixes = []
+    decode_times = [0] * len(segments[0].tracks)
+    for sequence_number, segment in enumerate(segments, start=1):
+        prefixes.append(build_prefix(sequence_number, segment, decode_times))
+        decode_times = [t + track.duration for t, track in zip(decode_times, segment.tracks)]
+
+    init = build_init(segments, prefixes)
+    header_bytes = len(init) + sum(len(prefix) for prefix in prefixes)
+    payload_bytes = sum(segment.size for segment in segments)
+    print(f"✓ Built init/index + {len(prefixes)} fragment headers ({header_bytes / 1024:.1f} KB)")
+    print(f"✓ Segment payload left in bucket: {payload_bytes / (1024 * 1024):.1f} MB")
+
+    return gcs_manager.compose_final_video(init, prefixes, video_gcs_uris)
+
+
+if __name__ == "__main__":
+    # Check: compose assembly against the local GCS stand-in - same frames as a local
+    # concat merge, and segments with different AAC settings fall back to the local path
+    import contextlib
+    import io
+    import os
+    import shutil
+    import subprocess
+    import tempfile
+
+    import video_merger
+    from gcs_utils import GCSManager
+    from local_gcs import LocalStorageClient
+
+    SEGMENT_SECONDS = 2
+    work_dir = tempfile.mkdtemp(prefix="compose_check_")
+    ffmpeg = video_merger._ffmpeg_exe()
+
+    def make_segment(name, hue, frequency, sample_rate=44100):
+        path = os.path.join(work_dir, name)
+        subprocess.run(
+            [
+                ffmpeg, "-hide_banner", "-loglevel", "error", "-y",
+                "-f", "lavfi", "-i", f"testsrc2=size=640x360:rate=24:duration={SEGMENT_SECONDS},hue=h={hue}",
+                "-f", "lavfi", "-i", f"sine=frequency={frequency}:sample_rate={sample_rate}:duration={SEGMENT_SECONDS}",
+                "-c:v", "libx264", "-pix_fmt", "yuv420p", "-c:a", "aac", "-shortest",
+                "-movflags", "+faststart", path
+            ],
+            check=True
+        )
+        return path
+
+    def decoded_frames(path):
+        """framemd5 of every decoded frame: (first video pts, video hashes, audio hashes)"""
+        result = subprocess.run(
+            [ffmpeg, "-hide_banner", "-loglevel", "error", "-i", path, "-map", "0", "-f", "framemd5", "-"],
+            capture_output=True, text=True, check=True
+        )
+        rows = [[field.strip() for field in line.split(",")]
+                for line in result.stdout.splitlines() if not line.startswith("#")]
+        video = [row for row in rows if row[0] == "0"]
+        return int(video[0][1]), [row[-1] for row in video], [row[-1] for row in rows if row[0] == "1"]
+
+    def upload(manager, paths):
+        uris = []
+        for i, path in enumerate(paths):
+            uri = manager.get_segment_output_uri(i + 1, i * SEGMENT_SECONDS, (i + 1) * SEGMENT_SECONDS)
+            manager.bucket.blob(uri.split("/", 3)[3]).upload_from_filename(path)
+            uris.append(uri)
+        return uris
+
+    client = LocalStorageClient(os.path.join(work_dir, "gcs"))
+    segments = [make_segment(f"segment_{i + 1}.mp4", hue=i * 120, frequency=440 + i * 110) for i in range(3)]
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        manager = GCSManager(bucket_name="check-bucket", storage_client=client)
+        info = assemble_with_compose(manager, upload(manager, segments))
+        concat_path = os.path.join(work_dir, "concat.mp4")
+        concatenated = video_merger.concat_stream_copy(segments, concat_path, work_dir=work_dir)
+    assert info, "compose assembly declined compatible segments"
+    assert concatenated, "concat merge failed"
+    composed_path = manager.bucket.blob(info["blob_name"]).path
+    composed_start, composed_video, composed_audio = decoded_frames(composed_path)
+    _, concat_video, concat_audio = decoded_frames(concat_path)
+    assert composed_video == concat_video, "composed video frames differ from the concat merge"
+    # The concat merge keeps the first segment's AAC priming frame (and delays video by the
+    # B-frame offset); compose carries the segments' edit list, so it starts like the segment does
+    assert composed_audio == concat_audio[1:], "composed audio frames differ from the concat merge"
+    assert composed_start == decoded_frames(segments[0])[0], "composed video does not start like the segment"
+    leftovers = [blob.name for blob in manager.bucket.list_blobs(prefix=f"{manager.request_folder}/assembly/")]
+    assert not leftovers, f"assembly helpers left in the bucket: {leftovers}"
+
+    # Mixed AAC (48 kHz segment in a 44.1 kHz set): compose declines, VideoMerger merges locally
+    mixed = [segments[0], make_segment("segment_48k.mp4", hue=60, frequency=550, sample_rate=48000), segments[2]]
+    methods = []
+    with contextlib.redirect_stdout(io.StringIO()):
+        manager = GCSManager(bucket_name="check-bucket", storage_client=client)
+        uris = upload(manager, mixed)
+        declined = assemble_with_compose(manager, uris) is None
+        video_merger.VIDEO_COMPOSE_ASSEMBLY = True
+        merger = video_merger.VideoMerger(gcs_manager=manager,
+                                          on_progress=lambda stage, **data: methods.append(data.get("method")))
+        merger.keep_local_copy = False
+        try:
+            fallback = merger.merge_with_transitions(uris, "final_product_video.mp4")
+        finally:
+            merger.cleanup()
+    assert declined, "compose accepted segments with different AAC sample descriptions"
+    assert fallback and "compose" not in methods and {"stream_copy", "reencode"} & set(methods), methods
+
+    print(f"\n{'=' * 70}")
+    print(f"📊 Compose assembly of {len(segments)} x {SEGMENT_SECONDS}s segments on the local GCS stand-in")
+    print(f"   Decoded framemd5 matches the concat merge ({len(composed_video)} video, "
+          f"{len(composed_audio)} audio frames)")
+    print(f"   Mixed AAC sample rates: compose declined, merged locally ({[m for m in methods if m][0]})")
+    print(f"{'=' * 70}")
+
+    shutil.rmtree(work_dir, ignore_errors=True)
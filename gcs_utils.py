@@ -2,21 +2,56 @@
 Google Cloud Storage utility - FIXED for Veo output paths
 """
 import os
+import threading
 import time
 import uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait
 from pathlib import Path
 from google.cloud import storage
-from config import GCS_BUCKET_NAME, GCS_OUTPUT_PREFIX, TESTING_MODE
+from config import (
+    GCS_BUCKET_NAME,
+    GCS_OUTPUT_PREFIX,
+    TESTING_MODE,
+    GCS_EMULATOR_ROOT,
+    GCS_DOWNLOAD_MAX_WORKERS,
+    GCS_RANGED_DOWNLOAD_THRESHOLD_MB,
+    GCS_DOWNLOAD_CHUNK_MB,
+    GCS_COMPOSE_MAX_SOURCES
+)
+from retry_policy import get_retry_policy
+
+MB = 1024 * 1024
+
+# Shared across requests so concurrent jobs stay within one download budget
+_download_executor = ThreadPoolExecutor(
+    max_workers=GCS_DOWNLOAD_MAX_WORKERS,
+    thread_name_prefix="gcs-download"
+)
+
+
+def _default_storage_client():
+    """Real GCS, or the local stand-in when GCS_EMULATOR_ROOT is set"""
+    if GCS_EMULATOR_ROOT:
+        from local_gcs import LocalStorageClient
+        print(f"🧪 Using local GCS emulator: {GCS_EMULATOR_ROOT}")
+        return LocalStorageClient(GCS_EMULATOR_ROOT)
+    return storage.Client()
 
 
 class GCSManager:
     """Manages GCS operations with proper file paths for Veo"""
     
-    def __init__(self, bucket_name=None):
-        self.storage_client = storage.Client()
+    def __init__(self, bucket_name=None, storage_client=None):
+        self.storage_client = storage_client or _default_storage_client()
         self.bucket_name = bucket_name or GCS_BUCKET_NAME
         self.bucket = self.storage_client.bucket(self.bucket_name)
         
+        # Writes go through the shared gcs retry policy; reads (reload, download_*)
+        # are already retried by google-cloud-storage's DEFAULT_RETRY, and stacking
+        # a second retry loop on top would multiply attempts during an outage.
+        self.retry_policy = get_retry_policy("gcs")
+        
         # Generate unique folder for this run
         timestamp = int(time.time())
         unique_id = uuid.uuid4().hex[:8]
@@ -38,7 +73,7 @@ class GCSManager:
         blob = self.bucket.blob(blob_name)
         
         print(f"📤 Uploading {filename}...")
-        blob.upload_from_filename(local_path)
+        self.retry_policy.call(lambda: blob.upload_from_filename(local_path), label=f"GCS upload {filename}")
         
         gcs_uri = f"gs://{self.bucket_name}/{blob_name}"
         return gcs_uri
@@ -60,8 +95,63 @@ class GCSManager:
         blob = self.bucket.blob(f"{self.request_folder}/final_merged_video.mp4")
         
         print(f"📤 Uploading final video...")
-        blob.upload_from_filename(local_path)
+        self.retry_policy.call(lambda: blob.upload_from_filename(local_path), label="GCS upload final video")
+        
+        return self._final_video_info(blob)
+    
+    def compose_final_video(self, init_bytes, prefixes, segment_uris):
+        """
+        Assemble final_merged_video.mp4 server-side with GCS compose
         
+        Uploads the small init piece and one prefix per segment, then
+        composes [init, prefix_1, segment_1, ...] without moving segment bytes.
+        """
+        assembly_folder = f"{self.request_folder}/assembly"
+        helper_blobs = []
+        
+        try:
+            init_blob = self.bucket.blob(f"{assembly_folder}/init.mp4")
+            self.retry_policy.call(lambda: init_blob.upload_from_string(init_bytes, content_type="video/mp4"),
+                                   label="GCS upload init.mp4")
+            helper_blobs.append(init_blob)
+            
+            sources = [init_blob]
+            for i, (prefix, segment_uri) in enumerate(zip(prefixes, segment_uris)):
+                prefix_blob = self.bucket.blob(f"{assembly_folder}/fragment_{i + 1:02d}.bin")
+                self.retry_policy.call(
+                    lambda: prefix_blob.upload_from_string(prefix, content_type="application/octet-stream"),
+                    label=f"GCS upload {prefix_blob.name}"
+                )
+                helper_blobs.append(prefix_blob)
+                
+                segment_name = segment_uri.replace(f"gs://{self.bucket_name}/", "", 1)
+                sources.extend([prefix_blob, self.bucket.blob(segment_name)])
+            
+            print(f"🧩 Composing {len(sources)} objects server-side...")
+            
+            # GCS compose accepts at most 32 sources per call - chain if needed
+            while len(sources) > GCS_COMPOSE_MAX_SOURCES:
+                partial = self.bucket.blob(f"{assembly_folder}/partial_{len(helper_blobs):02d}.bin")
+                batch = sources[:GCS_COMPOSE_MAX_SOURCES]
+                self.retry_policy.call(lambda: partial.compose(batch), label="GCS compose")
+                helper_blobs.append(partial)
+                sources = [partial] + sources[GCS_COMPOSE_MAX_SOURCES:]
+            
+            blob = self.bucket.blob(f"{self.request_folder}/final_merged_video.mp4")
+            blob.content_type = "video/mp4"
+            self.retry_policy.call(lambda: blob.compose(sources), label="GCS compose")
+            
+            return self._final_video_info(blob)
+        
+        finally:
+            for helper in helper_blobs:
+                try:
+                    helper.delete()
+                except Exception as e:
+                    print(f"⚠️ Could not delete {helper.name}: {e}")
+    
+    def _final_video_info(self, blob):
+        """Signed URL + URIs for a finished final video blob"""
         # Make blob publicly readable (if your bucket allows)
         # Uncomment if you want direct public URLs:
         # blob.make_public()
@@ -86,9 +176,25 @@ class GCSManager:
             "public_url": signed_url,  # Use signed URL instead of GCS URI
             "blob_name": blob.name
         }
+    
+    def get_blob_size(self, gcs_uri):
+        """Size in bytes of an object"""
+        blob = self._blob_for_uri(gcs_uri)
+        blob.reload()
+        return blob.size
+    
+    def read_range(self, gcs_uri, start, end):
+        """Read bytes [start, end] (inclusive) of an object"""
+        return self._blob_for_uri(gcs_uri).download_as_bytes(start=start, end=end)
+    
+    def _blob_for_uri(self, gcs_uri):
+        parts = gcs_uri.replace("gs://", "").split("/", 1)
+        bucket_name = parts[0]
+        blob_name = parts[1] if len(parts) > 1 else ""
+        return self.storage_client.bucket(bucket_name).blob(blob_name)
         
     def download_video(self, gcs_uri, local_filename):
-        """Download video from GCS"""
+        """Download video from GCS (ranged, parallel chunks for large blobs)"""
         parts = gcs_uri.replace("gs://", "").split("/", 1)
         bucket_name = parts[0]
         blob_name = parts[1] if len(parts) > 1 else ""
@@ -97,11 +203,81 @@ class GCSManager:
         blob = bucket.blob(blob_name)
         
         display_name = Path(blob_name).name
-        print(f"📥 Downloading {display_name}...")
         
-        blob.download_to_filename(local_filename)
+        blob.reload()  # Fetch size to decide between single and ranged transfer
+        if blob.size and blob.size > GCS_RANGED_DOWNLOAD_THRESHOLD_MB * MB:
+            print(f"📥 Downloading {display_name} ({blob.size / MB:.1f} MB, ranged)...")
+            self._download_ranged(blob, local_filename)
+        else:
+            print(f"📥 Downloading {display_name}...")
+            blob.download_to_filename(local_filename)
+        
         return local_filename
     
+    def download_videos(self, gcs_uris, local_filenames):
+        """
+        Start concurrent downloads on the shared download pool
+        
+        Returns:
+            List of futures (same order as gcs_uris), each resolving to the
+            local filename - callers can start working on early arrivals
+        """
+        return [
+            _download_executor.submit(self.download_video, gcs_uri, local_filename)
+            for gcs_uri, local_filename in zip(gcs_uris, local_filenames)
+        ]
+    
+    def _download_ranged(self, blob, local_filename):
+        """
+        Fetch a large blob as byte ranges in parallel, written in place
+        
+        Ranges run on the shared download pool, so GCS_DOWNLOAD_MAX_WORKERS
+        bounds all download threads in the process. The calling thread
+        takes ranges too: with the pool busy (or this call itself running
+        on it) the download still progresses instead of waiting on a slot.
+        """
+        chunk_size = GCS_DOWNLOAD_CHUNK_MB * MB
+        ranges = [
+            (start, min(start + chunk_size, blob.size) - 1)
+            for start in range(0, blob.size, chunk_size)
+        ]
+        
+        # Preallocate so every chunk can be written at its own offset
+        with open(local_filename, "wb") as f:
+            f.truncate(blob.size)
+        
+        def fetch(byte_range):
+            start, end = byte_range
+            data = blob.download_as_bytes(start=start, end=end)
+            with open(local_filename, "r+b") as f:
+                f.seek(start)
+                f.write(data)
+        
+        pending = deque(ranges)
+        lock = threading.Lock()
+        
+        def drain():
+            while True:
+                with lock:
+                    if not pending:
+                        return
+                    byte_range = pending.popleft()
+                fetch(byte_range)
+        
+        helpers = [_download_executor.submit(drain) for _ in range(min(len(ranges), GCS_DOWNLOAD_MAX_WORKERS) - 1)]
+        try:
+            drain()
+        except Exception:
+            with lock:
+                pending.clear()  # Stop the helpers too
+            raise
+        finally:
+            # Helpers still queued behind other downloads are no longer needed
+            started = [helper for helper in helpers if not helper.cancel()]
+            wait(started)
+        for helper in started:
+            helper.result()  # Re-raise a helper's error
+    
     def list_segment_videos(self):
         """List all MP4 files in segments folder"""
         prefix = f"{self.segments_folder}/"
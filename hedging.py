@@ -0,0 +1,230 @@
+"""
+Hedged requests for Gemini image calls
+A call that is still running after the model's observed p90 latency gets a
+duplicate; whichever returns first wins. SDK calls can't be aborted
+mid-flight, so the slower one is left to finish and its result ignored.
+Hedges draw from a budget earned by ordinary calls (HEDGE_BUDGET_RATIO),
+so the extra cost is bounded even while the whole upstream is slow.
+"""
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from config import (
+    HEDGE_ENABLED,
+    HEDGE_DELAY_QUANTILE,
+    HEDGE_MIN_DELAY_SECONDS,
+    HEDGE_MIN_SAMPLES,
+    HEDGE_BUDGET_RATIO,
+    HEDGE_BUDGET_BURST,
+    HEDGE_LATENCY_WINDOW,
+    HEDGE_MAX_WORKERS
+)
+
+_hedge_executor = ThreadPoolExecutor(max_workers=HEDGE_MAX_WORKERS, thread_name_prefix="hedge")
+
+
+class LatencyWindow:
+    """Sliding window of recent latencies with quantile lookups"""
+
+    def __init__(self, size=HEDGE_LATENCY_WINDOW):
+        self._samples = deque(maxlen=size)
+        self._lock = threading.Lock()
+
+    def record(self, seconds):
+        with self._lock:
+            self._samples.append(seconds)
+
+    def quantile(self, q):
+        """Latency at quantile q (0-1), or None without samples"""
+        with self._lock:
+            samples = sorted(self._samples)
+        if not samples:
+            return None
+        return samples[min(len(samples) - 1, int(q * len(samples)))]
+
+    def __len__(self):
+        return len(self._samples)
+
+
+class HedgePolicy:
+    """Hedging state for one model: latency window, hedge budget and counters"""
+
+    def __init__(self, name, enabled=HEDGE_ENABLED, delay_quantile=HEDGE_DELAY_QUANTILE,
+                 min_delay=HEDGE_MIN_DELAY_SECONDS, min_samples=HEDGE_MIN_SAMPLES,
+                 budget_ratio=HEDGE_BUDGET_RATIO, budget_burst=HEDGE_BUDGET_BURST,
+                 executor=None):
+        self.name = name
+        self.enabled = enabled
+        self.delay_quantile = delay_quantile
+        self.min_delay = min_delay
+        self.min_samples = min_samples
+        self.budget_ratio = budget_ratio
+        self.budget_burst = budget_burst
+        self.latencies = LatencyWindow()
+        self._executor = executor or _hedge_executor
+        self._lock = threading.Lock()
+        self._budget = budget_burst
+        self._stats = {"calls": 0, "hedged": 0, "hedge_wins": 0, "budget_denied": 0}
+
+    def hedge_delay(self):
+        """Seconds before a duplicate is sent, or None while too few samples exist"""
+        if len(self.latencies) < self.min_samples:
+            return None
+        return max(self.min_delay, self.latencies.quantile(self.delay_quantile))
+
+    def call(self, fn):
+        """
+        Run fn(), hedging it with a second fn() if it outlives hedge_delay()
+
+        Args:
+            fn: Zero-argument callable making one upstream request (must be
+                safe to run twice - e.g. an image generation, not a payment)
+
+        Returns:
+            The first successful result
+        """
+        self._count("calls")
+        with self._lock:
+            self._budget = min(self.budget_burst, self._budget + self.budget_ratio)
+
+        delay = self.hedge_delay() if self.enabled else None
+        if delay is None:
+            return self._timed(fn)
+
+        primary = self._executor.submit(self._timed, fn)
+        done, _ = wait([primary], timeout=delay)
+        if done or not self._take_budget():
+            return primary.result()
+
+        print(f"🪃 {self.name}: no answer after {delay:.1f}s, sending a hedge request")
+        self._count("hedged")
+        hedge = self._executor.submit(self._timed, fn)
+        pending = {primary, hedge}
+        first_error = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    if future is hedge:
+                        self._count("hedge_wins")
+                    for loser in pending:
+                        loser.cancel()  # Only helps if it hasn't started; otherwise ignored
+                    return future.result()
+                first_error = first_error or future.exception()
+        raise first_error
+
+    def get_stats(self):
+        """Counters for /api/metrics"""
+        with self._lock:
+            stats = dict(self._stats)
+        stats["hedge_rate"] = round(stats["hedged"] / stats["calls"], 3) if stats["calls"] else None
+        delay = self.hedge_delay()
+        stats["hedge_delay_seconds"] = round(delay, 2) if delay is not None else None
+        for q in (0.5, 0.9, 0.99):
+            latency = self.latencies.quantile(q)
+            stats[f"p{int(q * 100)}_seconds"] = round(latency, 2) if latency is not None else None
+        return stats
+
+    def _timed(self, fn):
+        """Run one attempt and feed its latency (successes only) into the window"""
+        start = time.monotonic()
+        result = fn()
+        self.latencies.record(time.monotonic() - start)
+        return result
+
+    def _take_budget(self):
+        with self._lock:
+            if self._budget >= 1:
+                self._budget -= 1
+                return True
+            self._stats["budget_denied"] += 1
+            return False
+
+    def _count(self, name):
+        with self._lock:
+            self._stats[name] += 1
+
+
+_policies = {}
+_policies_lock = threading.Lock()
+
+
+def get_hedge_policy(model):
+    """Process-wide hedge policy for a model (HEDGE_ENABLED switches them all)"""
+    with _policies_lock:
+        if model not in _policies:
+            _policies[model] = HedgePolicy(model)
+        return _policies[model]
+
+
+def get_hedge_stats():
+    """Stats of every policy in use, keyed by model"""
+    with _policies_lock:
+        policies = dict(_policies)
+    return {model: policy.get_stats() for model, policy in policies.items()}
+
+
+if __name__ == "__main__":
+    # Benchmark: heavy-tailed fake model, latency histogram with and without hedging
+    import bisect
+    import contextlib
+    import io
+    import random
+
+    CALLS = 2000
+    CONCURRENCY = 16
+    MEDIAN = 0.02  # Scaled down: 20 ms stands in for a ~8 s image call
+
+    def fake_model_call():
+        # ~92% log-normal around the median, ~8% stragglers with a Pareto tail (4x-40x)
+        if random.random() < 0.08:
+            time.sleep(MEDIAN * min(40.0, 4 * random.paretovariate(1.5)))
+        else:
+            time.sleep(MEDIAN * random.lognormvariate(0, 0.25))
+        return "image"
+
+    def run(policy):
+        def one(_):
+            start = time.monotonic()
+            policy.call(fake_model_call)
+            return time.monotonic() - start
+
+        with ThreadPoolExecutor(max_workers=CONCURRENCY) as clients, contextlib.redirect_stdout(io.StringIO()):
+            return sorted(clients.map(one, range(CALLS)))
+
+    def percentile(samples, q):
+        return samples[min(len(samples) - 1, int(q * len(samples)))]
+
+    def histogram(samples):
+        edges = [MEDIAN * m for m in (0.5, 1, 1.5, 2, 3, 4, 6, 8, 12, 16, 24, 32, 48)]
+        counts = [0] * (len(edges) + 1)
+        for sample in samples:
+            counts[bisect.bisect_left(edges, sample)] += 1
+        lines = []
+        for i, count in enumerate(counts):
+            upper = f"<= {edges[i] / MEDIAN:4.1f}x" if i < len(edges) else f" > {edges[-1] / MEDIAN:4.1f}x"
+            bar = "#" * (0 if count == 0 else max(1, round(60 * count / len(samples))))
+            lines.append(f"      {upper} median | {count:5d} {bar}")
+        return "\n".join(lines)
+
+    random.seed(7)
+    executor = ThreadPoolExecutor(max_workers=CONCURRENCY * 2)
+    baseline = run(HedgePolicy("fake", enabled=False, executor=executor))
+    hedging = HedgePolicy("fake", enabled=True, min_delay=0, budget_ratio=0.1, executor=executor)
+    run(hedging)  # Warm-up: fill the latency window so the p90 delay is known
+    hedging._stats = {name: 0 for name in hedging._stats}
+    hedged = run(hedging)
+    stats = hedging.get_stats()
+
+    print(f"\n{'=' * 70}")
+    print(f"📊 {CALLS} calls, {CONCURRENCY} concurrent, heavy-tailed fake model (median {MEDIAN * 1000:.0f} ms)")
+    for label, samples in (("No hedging", baseline), ("Hedge at p90, 10% budget", hedged)):
+        print(f"   {label}: p50 {percentile(samples, 0.5) * 1000:.0f} ms | p90 {percentile(samples, 0.9) * 1000:.0f} ms"
+              f" | p99 {percentile(samples, 0.99) * 1000:.0f} ms | p99.9 {percentile(samples, 0.999) * 1000:.0f} ms")
+        print(histogram(samples))
+    print(f"   Hedge rate {stats['hedge_rate']:.1%} (budget 10%), hedge wins {stats['hedge_wins']}, "
+          f"budget denied {stats['budget_denied']}, delay {stats['hedge_delay_seconds'] * 1000:.0f} ms")
+    print(f"{'=' * 70}")
+    executor.shutdown()
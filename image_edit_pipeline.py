@@ -3,39 +3,93 @@ Image Edit Pipeline - Direct Operation Flow
 Simplified: operation_id → template → prompt generation → execution
 Skips operation selection LLM call
 """
-import time
 import json
 import os
-from google import genai
+import threading
+import uuid
 from google.genai import types
 from PIL import Image
 from io import BytesIO
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 import cloudinary.uploader
 
 from operations_config import get_operation_by_id, get_operation_template
+from client_pool import get_client
+from rate_limiter import get_rate_limiter, estimate_tokens
+from hedging import get_hedge_policy
+from retry_policy import get_retry_policy
+from circuit_breaker import get_circuit_breaker
+from config import (
+    EDIT_POOL_MAX_WORKERS,
+    EDIT_BATCH_MAX_CONCURRENCY,
+    EDIT_DEFAULT_PLANNING_MODE,
+    EDIT_MONTAGE_MAX_IMAGES,
+    EDIT_MONTAGE_TILE_PX,
+    RESULT_CACHE_ENABLED,
+    RESULT_CACHE_BACKEND,
+    PLANNER_CACHE_ENABLED
+)
+from result_cache import ResultCache, create_backend, get_planner_cache, normalize_text
+from image_ingest import prepare_image, prepare_pil, ensure_prepared
+from local_engines import local_engine_for, run_local_engine, LocalEngineDeclined
+
+# Shared across requests; each batch is additionally capped at EDIT_BATCH_MAX_CONCURRENCY
+_edit_executor = ThreadPoolExecutor(max_workers=EDIT_POOL_MAX_WORKERS, thread_name_prefix="image-edit")
+
+_edit_cache = None
+_edit_cache_lock = threading.Lock()
+
+
+def get_edit_cache():
+    """Process-wide cache of finished edits (image + operation -> Cloudinary URL)"""
+    global _edit_cache
+    with _edit_cache_lock:
+        if _edit_cache is None:
+            _edit_cache = ResultCache(create_backend(RESULT_CACHE_BACKEND), name="edit cache")
+        return _edit_cache
+
+
+def edit_cache_key(image_bytes, operation_id, operation_details=None, logo=None):
+    """Hash of the image bytes plus everything that shapes the edit"""
+    images = (image_bytes, logo) if logo else (image_bytes,)  # Keys without a logo stay as they were
+    return ResultCache.make_key(*images, {
+        "operation_id": operation_id,
+        "operation_details": operation_details or "",
+        # Template text, so editing an operation's template invalidates its entries
+        "template": get_operation_template(operation_id, operation_details or ""),
+        "models": [ImageEditPipeline.prompt_generator_model, ImageEditPipeline.editor_model],
+        "engine": local_engine_for(operation_id, operation_details),
+    })
 
 
 class ImageEditPipeline:
     """Handles image editing with direct operation selection"""
     
-    def __init__(self):
-        self.client = genai.Client()
-        self.prompt_generator_model = "gemini-2.5-pro"  # For prompt generation
-        self.editor_model = "gemini-2.5-flash-image"     # Nano Banana for editing
+    prompt_generator_model = "gemini-2.5-pro"  # For prompt generation
+    editor_model = "gemini-2.5-flash-image"     # Nano Banana for editing
     
-    def generate_nano_banana_prompt(self, operation_id, user_details, user_image, unique_id):
+    def __init__(self, client=None, uploader=None):
+        self.client = client or get_client()
+        self.uploader = uploader or cloudinary.uploader.upload  # fn(file, folder=, public_id=) -> {"secure_url": ...}
+        self.planned = False  # generate_nano_banana_prompt called the planner model (not a planner-cache hit)
+        self.used_models = False  # run_edit_pipeline took the model path, so the image needed an instruction
+    
+    def generate_nano_banana_prompt(self, operation_id, user_details, user_image, unique_id, batch_size=1,
+                                    force_replan=False):
         """
         Generate hyper-specific Nano Banana prompt using operation template
         
         Args:
             operation_id: ID of the operation (1-38)
             user_details: Optional user specifications
-            user_image: PIL Image object
+            user_image: PreparedImage (a representative image or montage for batches)
             unique_id: Request identifier
+            batch_size: Number of images the instruction will be reused for
+            force_replan: Skip the planner cache (PLANNER_CACHE_ENABLED) and plan afresh
         
         Returns:
-            str: Generated Nano Banana prompt
+            str: Generated Nano Banana prompt (self.planned says whether the model was called)
         """
         print(f"\n--- Step 1: Generating Nano Banana Prompt (ID: {unique_id}) ---")
         
@@ -56,6 +110,28 @@ class ImageEditPipeline:
         else:
             print(f"✓ No user details - using defaults")
         
+        cache_key = None
+        if PLANNER_CACHE_ENABLED:
+            cache_key = get_planner_cache().perceptual_key([user_image.fingerprint], "nano_banana_prompt", {
+                "model": self.prompt_generator_model,
+                "operation_id": operation_id,
+                "template": get_operation_template(operation_id, normalize_text(user_details)),
+                "shared": batch_size > 1,
+            })
+            cached = get_planner_cache().get(cache_key, bypass=force_replan)
+            if cached:
+                print(f"⚡ Planner cache hit - skipping {self.prompt_generator_model} call")
+                return cached["prompt"]
+        
+        batch_note = ""
+        if batch_size > 1:
+            batch_note = f"""
+BATCH NOTE: This instruction will be applied separately to each of {batch_size} product photos.
+The attached image is representative of the batch (possibly a grid of several photos).
+Write an instruction that works for any single photo of the batch - do NOT refer to grid
+positions, a specific photo, or a number of photos.
+"""
+        
         # Build the prompt for Gemini 2.5 Pro
         prompt_instruction = f"""
 You are an expert at creating hyper-specific image editing instructions for Nano Banana AI.
@@ -63,7 +139,7 @@ You are an expert at creating hyper-specific image editing instructions for Nano
 Based on the operation template and guidelines below, generate a SINGLE, DETAILED, DESCRIPTIVE editing instruction.
 
 {instruction_template}
-
+{batch_note}
 IMPORTANT OUTPUT FORMAT:
 - Return ONLY the descriptive editing instruction
 - Do NOT include JSON, markdown, code blocks, or explanations
@@ -75,18 +151,28 @@ Generate the instruction now.
 """
         
         # Multimodal content: instruction + image
-        contents = [prompt_instruction, user_image]
+        contents = [prompt_instruction, user_image.as_part()]
         
         try:
             print(f"📤 Sending to {self.prompt_generator_model}...")
+            self.planned = True
+            
+            estimated_tokens = estimate_tokens(contents)
             
-            response = self.client.models.generate_content(
-                model=self.prompt_generator_model,
-                contents=contents,
-                config=types.GenerateContentConfig(
-                    temperature=0.3,  # Lower for more consistent technical output
+            def plan():
+                get_rate_limiter().acquire(self.prompt_generator_model, estimated_tokens)
+                response = get_circuit_breaker("gemini").call(
+                    self.client.models.generate_content,
+                    model=self.prompt_generator_model,
+                    contents=contents,
+                    config=types.GenerateContentConfig(
+                        temperature=0.3,  # Lower for more consistent technical output
+                    )
                 )
-            )
+                get_rate_limiter().record_usage(self.prompt_generator_model, estimated_tokens, response.usage_metadata)
+                return response
+            
+            response = get_retry_policy("gemini").call(plan, label="Edit prompt generation")
             
             # Extract the generated prompt
             nano_banana_prompt = response.text.strip()
@@ -99,7 +185,8 @@ Generate the instruction now.
             print(f"{nano_banana_prompt[:300]}...")
             print(f"{'='*70}\n")
             
-            time.sleep(1)  # Rate limiting
+            if cache_key:
+                get_planner_cache().set(cache_key, {"prompt": nano_banana_prompt})
             return nano_banana_prompt
             
         except Exception as e:
@@ -112,7 +199,7 @@ Generate the instruction now.
         
         Args:
             nano_banana_prompt: Generated editing instruction
-            user_image: PIL Image object
+            user_image: PreparedImage
             unique_id: Request identifier
         
         Returns:
@@ -125,11 +212,26 @@ Generate the instruction now.
             print(f"   Prompt: {nano_banana_prompt[:150]}...")
             
             # Construct editing request
-            contents = [nano_banana_prompt, user_image]
+            contents = [nano_banana_prompt, user_image.as_part()]
+            
+            estimated_tokens = estimate_tokens(contents)
             
-            response = self.client.models.generate_content(
-                model=self.editor_model,
-                contents=contents
+            def edit():
+                get_rate_limiter().acquire(self.editor_model, estimated_tokens)
+                response = self.client.models.generate_content(
+                    model=self.editor_model,
+                    contents=contents
+                )
+                get_rate_limiter().record_usage(self.editor_model, estimated_tokens, response.usage_metadata)
+                return response
+            
+            # Stragglers get a duplicate request when HEDGE_ENABLED (first answer wins);
+            # the hedged pair counts as one call for the breaker, and transient
+            # failures are retried with backoff
+            breaker = get_circuit_breaker("gemini")
+            hedge = get_hedge_policy(self.editor_model)
+            response = get_retry_policy("gemini").call(
+                lambda: breaker.call(hedge.call, edit), label=f"Edit ({unique_id})"
             )
             
             # Extract edited image bytes
@@ -142,7 +244,6 @@ Generate the instruction now.
                     break
             
             if edited_image_bytes:
-                time.sleep(1)  # Rate limiting
                 return edited_image_bytes
             else:
                 raise ValueError("No image data in Nano Banana response")
@@ -151,15 +252,19 @@ Generate the instruction now.
             print(f"❌ Nano Banana edit error: {e}")
             raise
     
-    def run_edit_pipeline(self, image_bytes, operation_id, user_details, timestamp_str):
+    def run_edit_pipeline(self, image_bytes, operation_id, user_details, timestamp_str, nano_banana_prompt=None,
+                          force_replan=False, logo=None):
         """
         Complete edit pipeline: load operation → generate prompt → execute
         
         Args:
-            image_bytes: Image file bytes
+            image_bytes: Image file bytes (or a PreparedImage from image_ingest)
             operation_id: Operation ID (1-38)
             user_details: Optional user specifications
             timestamp_str: Timestamp for unique IDs
+            nano_banana_prompt: Pre-planned instruction (batch shared planning) - skips Step 1
+            force_replan: Ignore the planner cache for Step 1
+            logo: Optional logo image bytes for the watermark engine (operation 38)
         
         Returns:
             tuple: (cloudinary_url, operation_name) or (None, None) on failure
@@ -171,28 +276,46 @@ Generate the instruction now.
         print(f"{'='*70}")
         
         try:
-            # Load image
-            user_image = Image.open(BytesIO(image_bytes))
-            print(f"✅ Image loaded: {user_image.size[0]}x{user_image.size[1]} px")
-            
             # Get operation info
             operation = get_operation_by_id(operation_id)
             operation_name = operation['name']
             
-            # STEP 1: Generate Nano Banana prompt (using template + Gemini 2.5 Pro)
-            nano_banana_prompt = self.generate_nano_banana_prompt(
-                operation_id=operation_id,
-                user_details=user_details,
-                user_image=user_image,
-                unique_id=pipeline_unique_id
-            )
+            # Classic pixel operations run locally instead of Steps 1-2 (local_engines.py),
+            # on the upload itself rather than the downsized model copy
+            edited_image_bytes = None
+            engine = local_engine_for(operation_id, user_details)
+            if engine:
+                print(f"\n--- Steps 1-2: Local '{engine}' engine - no model calls ---")
+                try:
+                    edited_image_bytes = run_local_engine(engine, image_bytes, user_details, logo=logo)
+                except LocalEngineDeclined as e:
+                    print(f"↩️ Local engine declined ({e}) - using the models")
             
-            # STEP 2: Execute edit with Nano Banana
-            edited_image_bytes = self.execute_edit(
-                nano_banana_prompt=nano_banana_prompt,
-                user_image=user_image,
-                unique_id=pipeline_unique_id
-            )
+            if edited_image_bytes is None:
+                self.used_models = True
+                
+                # Load image (model copy)
+                user_image = ensure_prepared(image_bytes)
+                print(f"✅ Image loaded: {user_image}")
+                
+                # STEP 1: Generate Nano Banana prompt (using template + Gemini 2.5 Pro)
+                if nano_banana_prompt:
+                    print(f"♻️ Using shared batch instruction - skipping planner call")
+                else:
+                    nano_banana_prompt = self.generate_nano_banana_prompt(
+                        operation_id=operation_id,
+                        user_details=user_details,
+                        user_image=user_image,
+                        unique_id=pipeline_unique_id,
+                        force_replan=force_replan
+                    )
+                
+                # STEP 2: Execute edit with Nano Banana
+                edited_image_bytes = self.execute_edit(
+                    nano_banana_prompt=nano_banana_prompt,
+                    user_image=user_image,
+                    unique_id=pipeline_unique_id
+                )
             
             # STEP 3: Upload to Cloudinary
             print(f"\n--- Step 3: Uploading to Cloudinary ---")
@@ -204,12 +327,17 @@ Generate the instruction now.
             operation_slug = re.sub(r'-+', '-', operation_slug)
             operation_slug = operation_slug.strip('-')
             
-            public_id = f"edit_{operation_slug}_{timestamp_str}"
+            # The timestamp is only unique per second and batch index, and Cloudinary overwrites an
+            # existing public_id - the random suffix keeps a cached URL pointing at this edit
+            public_id = f"edit_{operation_slug}_{timestamp_str}_{uuid.uuid4().hex[:12]}"
             
-            upload_result = cloudinary.uploader.upload(
-                BytesIO(edited_image_bytes),
-                folder="product_edits",
-                public_id=public_id
+            upload_result = get_retry_policy("cloudinary").call(
+                lambda: self.uploader(
+                    BytesIO(edited_image_bytes),
+                    folder="product_edits",
+                    public_id=public_id
+                ),
+                label=f"Cloudinary upload {public_id}"
             )
             
             final_url = upload_result['secure_url']
@@ -231,7 +359,9 @@ Generate the instruction now.
             return (None, None)
 
 
-def edit_product_image(image_bytes, operation_id, operation_details=None):
+def edit_product_image(image_bytes, operation_id, operation_details=None, batch_index=None,
+                       nano_banana_prompt=None, bypass_cache=False, force_replan=False, logo=None,
+                       client=None, uploader=None):
     """
     Main entry point for image editing
     
@@ -239,16 +369,53 @@ def edit_product_image(image_bytes, operation_id, operation_details=None):
         image_bytes: Image file bytes
         operation_id: Operation ID (1-38)
         operation_details: Optional user specifications
+        batch_index: Position within a batch (part of the Cloudinary public_id)
+        nano_banana_prompt: Shared batch instruction (skips per-image planning)
+        bypass_cache: Ignore a cached result and recompute (the new result is re-cached)
+        force_replan: Plan afresh, ignoring cached plans (implies bypass_cache)
+        logo: Optional logo image bytes (watermark / branding overlay)
+        client: genai client for the planner and editor (default: the shared pool's)
+        uploader: Cloudinary upload function (default: cloudinary.uploader.upload)
     
     Returns:
         dict: {
             "success": bool,
             "edited_image_url": str,
             "operation_name": str,
+            "cached": bool (True when served from the result cache),
             "error": str (if failed)
         }
     """
+    cache_key = edit_cache_key(image_bytes, operation_id, operation_details, logo)
+    if RESULT_CACHE_ENABLED:
+        cached = get_edit_cache().get(cache_key, bypass=bypass_cache or force_replan)
+        if cached:
+            print(f"⚡ Edit cache hit (op {operation_id}): {cached['edited_image_url']}")
+            return {"success": True, "cached": True, **cached}
+    
+    return _edit_and_store(cache_key, image_bytes, operation_id, operation_details,
+                           batch_index, nano_banana_prompt, force_replan, logo, client, uploader)
+
+
+def _edit_and_store(cache_key, image_bytes, operation_id, operation_details=None,
+                    batch_index=None, nano_banana_prompt=None, force_replan=False, logo=None,
+                    client=None, uploader=None):
+    """Run the edit pipeline and cache a successful result"""
+    result = _run_edit(image_bytes, operation_id, operation_details, batch_index, nano_banana_prompt, force_replan,
+                       logo, client, uploader)
+    if RESULT_CACHE_ENABLED and result["success"]:
+        get_edit_cache().set(cache_key, {
+            "edited_image_url": result["edited_image_url"],
+            "operation_name": result["operation_name"]
+        })
+    return result
+
+
+def _run_edit(image_bytes, operation_id, operation_details=None, batch_index=None,
+              nano_banana_prompt=None, force_replan=False, logo=None, client=None, uploader=None):
     timestamp_str = datetime.now().strftime("%Y%m%d_%H%M%S")
+    if batch_index is not None:
+        timestamp_str = f"{timestamp_str}_{batch_index + 1}"
     
     print(f"\n{'#'*70}")
     print(f"# IMAGE EDIT REQUEST")
@@ -259,25 +426,33 @@ def edit_product_image(image_bytes, operation_id, operation_details=None):
     print(f"{'#'*70}\n")
     
     try:
-        pipeline = ImageEditPipeline()
+        pipeline = ImageEditPipeline(client, uploader)
         
         result_url, operation_name = pipeline.run_edit_pipeline(
             image_bytes=image_bytes,
             operation_id=operation_id,
             user_details=operation_details or "",
-            timestamp_str=timestamp_str
+            timestamp_str=timestamp_str,
+            nano_banana_prompt=nano_banana_prompt,
+            force_replan=force_replan,
+            logo=logo
         )
         
         if result_url:
             return {
                 "success": True,
                 "edited_image_url": result_url,
-                "operation_name": operation_name
+                "operation_name": operation_name,
+                "cached": False,
+                "planned": pipeline.planned,
+                "used_models": pipeline.used_models
             }
         else:
             return {
                 "success": False,
-                "error": "Edit execution failed"
+                "error": "Edit execution failed",
+                "planned": pipeline.planned,
+                "used_models": pipeline.used_models
             }
     
     except Exception as e:
@@ -287,4 +462,258 @@ def edit_product_image(image_bytes, operation_id, operation_details=None):
         return {
             "success": False,
             "error": str(e)
-        }
\ No newline at end of file
+        }
+
+
+def build_montage(images, max_images=EDIT_MONTAGE_MAX_IMAGES, tile_px=EDIT_MONTAGE_TILE_PX):
+    """
+    Tile the first few batch images into one grid for shared planning
+    
+    Args:
+        images: List of PreparedImage
+    
+    Returns:
+        PIL.Image: Grid of up to max_images tiles (letterboxed on white)
+    """
+    images = [prepared.to_pil().convert("RGB") for prepared in images[:max_images]]
+    cols = 1 if len(images) == 1 else 2
+    rows = (len(images) + cols - 1) // cols
+    
+    montage = Image.new("RGB", (cols * tile_px, rows * tile_px), "white")
+    for i, image in enumerate(images):
+        image.thumbnail((tile_px, tile_px))
+        x = (i % cols) * tile_px + (tile_px - image.width) // 2
+        y = (i // cols) * tile_px + (tile_px - image.height) // 2
+        montage.paste(image, (x, y))
+    return montage
+
+
+def plan_shared_prompt(images, operation_id, operation_details=None, planning_mode="shared",
+                       force_replan=False, client=None):
+    """
+    One planner call for a whole batch
+    
+    Args:
+        images: List of PreparedImage
+        operation_id: Operation ID (1-38)
+        operation_details: Optional user specifications
+        planning_mode: "shared" (first image) or "shared_montage" (grid of the batch)
+        force_replan: Ignore the planner cache
+        client: genai client for the planner (default: the shared pool's)
+    
+    Returns:
+        tuple: (Nano Banana instruction reused for every image, whether the planner model was called)
+    """
+    if planning_mode == "shared_montage" and len(images) > 1:
+        planning_image = prepare_pil(build_montage(images))
+    else:
+        planning_image = images[0]
+    
+    timestamp_str = datetime.now().strftime("%Y%m%d_%H%M%S")
+    pipeline = ImageEditPipeline(client)
+    prompt = pipeline.generate_nano_banana_prompt(
+        operation_id=operation_id,
+        user_details=operation_details or "",
+        user_image=planning_image,
+        unique_id=f"{timestamp_str}_op{operation_id}_batch",
+        batch_size=len(images),
+        force_replan=force_replan
+    )
+    return prompt, pipeline.planned
+
+
+def edit_product_images(images_bytes, operation_id, operation_details=None,
+                        max_concurrency=EDIT_BATCH_MAX_CONCURRENCY,
+                        planning_mode=EDIT_DEFAULT_PLANNING_MODE, bypass_cache=False,
+                        force_replan=False, logo=None, client=None, uploader=None):
+    """
+    Edit several images concurrently on the shared edit pool
+    
+    Args:
+        images_bytes: List of image file bytes
+        operation_id: Operation ID (1-38)
+        operation_details: Optional user specifications
+        max_concurrency: Edits of this batch allowed in flight at once
+        planning_mode: "per_image", "shared" or "shared_montage"
+        bypass_cache: Ignore cached results and recompute every image
+        force_replan: Plan afresh, ignoring cached plans (implies bypass_cache)
+        logo: Optional logo image bytes (watermark / branding overlay); the local
+            engine rasterises it once and reuses it for the whole batch
+        client: genai client for the planner and editor (default: the shared pool's)
+        uploader: Cloudinary upload function (default: cloudinary.uploader.upload)
+    
+    Returns:
+        dict: {
+            "results": list of edit_product_image result dicts, in input order,
+            "planning_mode": str (mode actually used; "local" when a local engine runs the operation),
+            "planner_calls": int,
+            "planner_calls_saved": int (images that needed an instruction minus planner_calls;
+                edit-cache hits and local-engine images never needed one),
+            "cache_hits": int
+        }
+    """
+    results = [None] * len(images_bytes)
+    pending = []
+    
+    # Cache hits are answered immediately; only misses are planned and edited
+    for idx, image_bytes in enumerate(images_bytes):
+        cache_key = edit_cache_key(image_bytes, operation_id, operation_details, logo)
+        cached = get_edit_cache().get(cache_key, bypass=bypass_cache or force_replan) if RESULT_CACHE_ENABLED else None
+        if cached:
+            results[idx] = {"success": True, "cached": True, **cached}
+        else:
+            pending.append((idx, image_bytes, cache_key))
+    cache_hits = len(images_bytes) - len(pending)
+    if cache_hits:
+        print(f"⚡ Edit cache: {cache_hits}/{len(images_bytes)} image(s) already edited")
+    
+    shared_prompt = None
+    shared_planned = False
+    if local_engine_for(operation_id, operation_details):
+        planning_mode = "local"  # No planner (an image the engine declines is planned on its own)
+    elif planning_mode != "per_image" and len(pending) > 1:
+        # Decode once here; the planner and every edit worker reuse the prepared images
+        prepared_pending = []
+        for idx, image_bytes, cache_key in pending:
+            try:
+                prepared_pending.append((idx, prepare_image(image_bytes), cache_key))
+            except Exception as e:
+                results[idx] = {"success": False, "error": f"Could not read image: {e}"}
+        pending = prepared_pending
+        
+        try:
+            shared_prompt, shared_planned = plan_shared_prompt(
+                [image for _, image, _ in pending], operation_id, operation_details, planning_mode,
+                force_replan, client
+            )
+        except Exception as e:
+            print(f"⚠️ Shared planning failed, planning per image instead: {e}")
+    if shared_prompt is None and planning_mode != "local":
+        planning_mode = "per_image"
+    
+    planner_calls = int(shared_planned)  # Plus each image whose own planning called the model
+    needed_instruction = 0  # Images that reached the planner step on the model path
+    in_flight = {}
+    
+    print(f"🧵 Editing {len(pending)} image(s), up to {max_concurrency} at a time ({planning_mode} planning)")
+    
+    while pending or in_flight:
+        while pending and len(in_flight) < max_concurrency:
+            idx, image, cache_key = pending.pop(0)
+            future = _edit_executor.submit(
+                _edit_and_store, cache_key, image, operation_id, operation_details, idx, shared_prompt,
+                force_replan, logo, client, uploader
+            )
+            in_flight[future] = idx
+        
+        done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+        for future in done:
+            idx = in_flight.pop(future)
+            try:
+                results[idx] = future.result()
+            except Exception as e:
+                results[idx] = {"success": False, "error": str(e)}
+            planner_calls += results[idx].pop("planned", False)  # Planner-cache hits don't count
+            needed_instruction += results[idx].pop("used_models", False)
+    
+    if shared_prompt:
+        print(f"♻️ Shared planning saved {needed_instruction - planner_calls} planner call(s)")
+    
+    return {
+        "results": results,
+        "planning_mode": planning_mode,
+        "planner_calls": planner_calls,
+        "planner_calls_saved": needed_instruction - planner_calls,  # vs. one call per image that needed one
+        "cache_hits": cache_hits
+    }
+
+
+if __name__ == "__main__":
+    # Benchmark: 10-image batch vs single image against fake models and a fake upload
+    import time
+    from types import SimpleNamespace
+    
+    PLAN_SECONDS, EDIT_SECONDS, UPLOAD_SECONDS = 1.0, 1.5, 0.3
+    BATCH = 10
+    
+    class FakeModels:
+        def generate_content(self, model, contents, config=None):
+            time.sleep(PLAN_SECONDS if model == "gemini-2.5-pro" else EDIT_SECONDS)
+            part = SimpleNamespace(inline_data=SimpleNamespace(data=b"edited"))
+            return SimpleNamespace(
+                text="Fake edit instruction",
+                usage_metadata=SimpleNamespace(total_token_count=1000),
+                candidates=[SimpleNamespace(content=SimpleNamespace(parts=[part]))]
+            )
+    
+    def fake_upload(data, folder, public_id):
+        time.sleep(UPLOAD_SECONDS)
+        return {"secure_url": f"https://example.invalid/{folder}/{public_id}"}
+    
+    fakes = {"client": SimpleNamespace(models=FakeModels()), "uploader": fake_upload}  # Injected per call
+    from result_cache import MemoryCacheBackend
+    _edit_cache = ResultCache(MemoryCacheBackend(), name="edit cache")  # Keep fake URLs out of the real cache
+    
+    buffer = BytesIO()
+    Image.new("RGB", (64, 64), "white").save(buffer, format="PNG")
+    image_bytes = buffer.getvalue()
+    
+    start = time.perf_counter()
+    edit_product_image(image_bytes, operation_id=1, bypass_cache=True, **fakes)
+    single_seconds = time.perf_counter() - start
+    
+    start = time.perf_counter()
+    serial = [edit_product_image(image_bytes, operation_id=1, batch_index=i, bypass_cache=True, **fakes)
+              for i in range(BATCH)]
+    serial_seconds = time.perf_counter() - start
+    
+    start = time.perf_counter()
+    batch = edit_product_images([image_bytes] * BATCH, operation_id=1, max_concurrency=BATCH, bypass_cache=True,
+                                **fakes)
+    batch_seconds = time.perf_counter() - start
+    
+    start = time.perf_counter()
+    capped = edit_product_images([image_bytes] * BATCH, operation_id=1, bypass_cache=True, **fakes)
+    capped_seconds = time.perf_counter() - start
+    
+    start = time.perf_counter()
+    shared = edit_product_images([image_bytes] * BATCH, operation_id=1, planning_mode="shared_montage",
+                                 bypass_cache=True, **fakes)
+    shared_seconds = time.perf_counter() - start
+    
+    start = time.perf_counter()
+    repeat = edit_product_images([image_bytes] * BATCH, operation_id=1, **fakes)
+    repeat_seconds = time.perf_counter() - start
+    
+    urls = [r["edited_image_url"] for r in batch["results"]]
+    print(f"\n{'=' * 70}")
+    print(f"📊 {BATCH}-image edit batch (fake models: {PLAN_SECONDS}s plan, {EDIT_SECONDS}s edit, {UPLOAD_SECONDS}s upload)")
+    print(f"   Single image:                    {single_seconds:.2f}s")
+    print(f"   Serial loop (old endpoint):      {serial_seconds:.2f}s")
+    print(f"   Concurrent, uncapped:            {batch_seconds:.2f}s")
+    print(f"   Concurrent, cap {EDIT_BATCH_MAX_CONCURRENCY} per request:     {capped_seconds:.2f}s")
+    print(f"   ... + shared montage planning:   {shared_seconds:.2f}s "
+          f"({shared['planner_calls']} planner call, {shared['planner_calls_saved']} saved)")
+    print(f"   Repeat request (result cache):   {repeat_seconds * 1000:.1f} ms ({repeat['cache_hits']} hits)")
+    print(f"   Cache: {get_edit_cache().get_stats()}")
+    print(f"   Order preserved: {urls == sorted(urls, key=lambda u: int(u.rsplit('_', 2)[1]))}")
+    
+    # Images a local engine declines go through the planner, and the counts say so
+    import numpy as np
+    studio, noisy = BytesIO(), BytesIO()
+    product = Image.new("RGB", (256, 256), "white")
+    product.paste((40, 60, 160), (64, 64, 192, 192))
+    product.save(studio, format="PNG")
+    Image.fromarray(np.random.default_rng(0).integers(0, 256, (256, 256, 3), dtype=np.uint8)).save(noisy, format="PNG")
+    mixed = edit_product_images([studio.getvalue(), noisy.getvalue(), noisy.getvalue()], operation_id=20,
+                                bypass_cache=True, **fakes)
+    print(f"   Local engine, 1 of 3 kept:       {mixed['planner_calls']} planner calls, "
+          f"{mixed['planner_calls_saved']} saved")
+    print(f"{'=' * 70}")
+    assert mixed["planning_mode"] == "local" and all(r["success"] for r in mixed["results"]), mixed
+    assert (mixed["planner_calls"], mixed["planner_calls_saved"]) == (2, 0), mixed  # The kept image needed none
+    assert (shared["planner_calls"], shared["planner_calls_saved"]) == (1, BATCH - 1), shared
+    assert (repeat["planner_calls"], repeat["planner_calls_saved"]) == (0, 0), repeat  # All edit-cache hits
+    # Same operation, same second, same batch index: every edit still gets its own public_id
+    edited_urls = [r["edited_image_url"] for run in (serial, batch["results"], capped["results"]) for r in run]
+    assert len(set(edited_urls)) == len(edited_urls), "two edits shared a Cloudinary public_id"
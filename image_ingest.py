@@ -0,0 +1,232 @@
+"""
+Image ingest - decode and normalise each upload once per request
+Applies EXIF orientation, settles the colour mode, downsizes to a
+model-friendly size and re-encodes compactly. The resulting PreparedImage
+is read-only and shared by every consumer (planner, executor, montage,
+cache fingerprint) instead of each thread re-decoding the raw upload and
+the SDKs re-encoding full camera resolution on every call.
+
+Local pixel engines don't want the model copy: decode_original gives them
+the upload at full resolution, without the downsize or JPEG round trip.
+"""
+import mmap
+from io import BytesIO
+
+from PIL import Image, ImageOps
+from google.genai import types
+
+from config import (
+    IMAGE_INGEST_MAX_DIMENSION,
+    LOCAL_ENGINE_MAX_DIMENSION,
+    IMAGE_INGEST_JPEG_QUALITY,
+    IMAGE_INGEST_ALPHA_FORMAT
+)
+from result_cache import perceptual_hash
+
+_PASSTHROUGH_FORMATS = {"JPEG": "image/jpeg", "PNG": "image/png", "WEBP": "image/webp"}
+ORIENTATION_TAG = 0x0112
+
+
+class PreparedImage:
+    """Normalised, encoded image ready to send to Gemini"""
+
+    __slots__ = ("data", "mime_type", "width", "height", "original_size", "fingerprint")
+
+    def __init__(self, data, mime_type, width, height, original_size, fingerprint):
+        self.data = data
+        self.mime_type = mime_type
+        self.width = width
+        self.height = height
+        self.original_size = original_size  # (width, height) as uploaded
+        self.fingerprint = fingerprint  # perceptual_hash, for cache keys
+
+    def as_part(self):
+        """Content part for the google-genai SDK"""
+        return types.Part.from_bytes(data=self.data, mime_type=self.mime_type)
+
+    def as_blob(self):
+        """Content blob for the google-generativeai SDK"""
+        return {"mime_type": self.mime_type, "data": self.data}
+
+    def to_pil(self):
+        """Fresh PIL copy for local processing (safe to mutate)"""
+        image = Image.open(BytesIO(self.data))
+        image.load()
+        return image
+
+    def __repr__(self):
+        return (f"PreparedImage({self.width}x{self.height} {self.mime_type}, "
+                f"{len(self.data) // 1024} KB, from {self.original_size[0]}x{self.original_size[1]})")
+
+
+def prepare_image(image_bytes, max_dimension=IMAGE_INGEST_MAX_DIMENSION):
+    """
+    Decode an upload once and normalise it for the models
+
+    Args:
+        image_bytes: Raw uploaded file bytes (or an mmap from upload_ingest)
+        max_dimension: Longest edge after downsizing
+
+    Returns:
+        PreparedImage
+    """
+    try:
+        return _prepare(image_bytes, max_dimension)
+    finally:
+        if isinstance(image_bytes, mmap.mmap) and not image_bytes.closed:
+            # Decoded: let the kernel drop the mapped pages from this worker's RSS
+            image_bytes.madvise(mmap.MADV_DONTNEED)
+
+
+def _prepare(image_bytes, max_dimension):
+    image = Image.open(_reader(image_bytes))
+    source_format = image.format
+    original_size = image.size
+
+    changed = image.getexif().get(ORIENTATION_TAG, 1) != 1
+    if changed:
+        image = ImageOps.exif_transpose(image)
+
+    image, mode_changed = _normalize_mode(image)
+    changed = changed or mode_changed
+
+    if max(image.size) > max_dimension:
+        image = image.copy()
+        image.thumbnail((max_dimension, max_dimension), Image.LANCZOS)
+        changed = True
+
+    # Already small and in a format the models take: keep the original bytes (no generation loss)
+    if not changed and source_format in _PASSTHROUGH_FORMATS:
+        return PreparedImage(bytes(image_bytes), _PASSTHROUGH_FORMATS[source_format],
+                             image.width, image.height, original_size, perceptual_hash(image))
+
+    return prepare_pil(image, original_size=original_size)
+
+
+def prepare_pil(image, original_size=None):
+    """Encode an in-memory PIL image (e.g. a planning montage) as a PreparedImage"""
+    image, _ = _normalize_mode(image)
+    buffer = BytesIO()
+    if image.mode == "RGBA":
+        image.save(buffer, format=IMAGE_INGEST_ALPHA_FORMAT, quality=IMAGE_INGEST_JPEG_QUALITY)
+        mime_type = f"image/{IMAGE_INGEST_ALPHA_FORMAT.lower()}"
+    else:
+        image.save(buffer, format="JPEG", quality=IMAGE_INGEST_JPEG_QUALITY, optimize=True)
+        mime_type = "image/jpeg"
+
+    return PreparedImage(buffer.getvalue(), mime_type, image.width, image.height,
+                         original_size or image.size, perceptual_hash(image))
+
+
+def decode_original(image, max_dimension=LOCAL_ENGINE_MAX_DIMENSION):
+    """
+    Decode an upload at full resolution for local processing
+
+    Same orientation and colour mode as prepare_image, but no downsize to
+    the model size and no re-encode. A PreparedImage has no upload bytes
+    left, so its (model-sized) copy is decoded instead.
+
+    Args:
+        image: Raw uploaded file bytes (or an mmap from upload_ingest), or a PreparedImage
+        max_dimension: Longest edge; only larger uploads are downsized
+
+    Returns:
+        PIL.Image.Image: RGB, or RGBA when the image has transparency (safe to mutate)
+    """
+    if isinstance(image, PreparedImage):
+        return image.to_pil()
+    try:
+        decoded = Image.open(_reader(image))
+        if decoded.getexif().get(ORIENTATION_TAG, 1) != 1:
+            decoded = ImageOps.exif_transpose(decoded)
+        if max(decoded.size) > max_dimension:
+            decoded.thumbnail((max_dimension, max_dimension), Image.LANCZOS)
+        decoded, _ = _normalize_mode(decoded)
+        decoded.load()
+        return decoded
+    finally:
+        if isinstance(image, mmap.mmap) and not image.closed:
+            image.madvise(mmap.MADV_DONTNEED)
+
+
+def prepare_images(images_bytes, max_dimension=IMAGE_INGEST_MAX_DIMENSION):
+    """prepare_image for each upload of a request"""
+    return [prepare_image(image_bytes, max_dimension) for image_bytes in images_bytes]
+
+
+def ensure_prepared(image):
+    """Accept raw bytes (or mmap) or an already-prepared image"""
+    return image if isinstance(image, PreparedImage) else prepare_image(image)
+
+
+def _reader(image_bytes):
+    """File-like over the upload without copying it (mmaps are read in place)"""
+    if isinstance(image_bytes, mmap.mmap):
+        image_bytes.seek(0)
+        return image_bytes
+    return BytesIO(image_bytes)
+
+
+def _normalize_mode(image):
+    """RGB, or RGBA only when the image really has transparency"""
+    if image.mode in ("RGB", "L"):
+        return image, False
+
+    if image.mode in ("RGBA", "LA", "P", "PA"):
+        rgba = image.convert("RGBA")
+        if rgba.getchannel("A").getextrema()[0] < 255:
+            return rgba, image.mode != "RGBA"
+        return rgba.convert("RGB"), True
+
+    return image.convert("RGB"), True
+
+
+if __name__ == "__main__":
+    # Benchmark: per-thread decode + SDK re-encode vs one ingest, over test_images/
+    import glob
+    import os
+    import time
+    from google.generativeai.types import content_types
+
+    CONSUMERS = 3  # solid_background, lifestyle, marketing_creative
+    CALLS_PER_CONSUMER = 2  # planner + executor
+    folder = os.path.join(os.path.dirname(os.path.abspath(__file__)), "test_images")
+    files = sorted(glob.glob(os.path.join(folder, "*")))
+
+    def camera_upload(path):
+        """Same photo as a 12 MP JPEG with a rotate-90 EXIF tag, like a phone upload"""
+        image = Image.open(path).convert("RGB").resize((4032, 3024), Image.LANCZOS)
+        exif = Image.Exif()
+        exif[ORIENTATION_TAG] = 6
+        buffer = BytesIO()
+        image.save(buffer, format="JPEG", quality=92, exif=exif)
+        return buffer.getvalue()
+
+    def run(label, uploads):
+        # Before: each consumer decodes every upload; the SDK re-encodes the PIL image per call
+        start = time.perf_counter()
+        sent_before = 0
+        for _ in range(CONSUMERS):
+            images = [Image.open(BytesIO(upload)) for upload in uploads]
+            for _ in range(CALLS_PER_CONSUMER):
+                sent_before += sum(len(content_types.to_blob(image).data) for image in images)
+        before_seconds = time.perf_counter() - start
+
+        # After: decode + normalise once, every call sends the prepared bytes
+        start = time.perf_counter()
+        prepared = prepare_images(uploads)
+        sent_after = CONSUMERS * CALLS_PER_CONSUMER * sum(len(p.as_blob()["data"]) for p in prepared)
+        after_seconds = time.perf_counter() - start
+
+        print(f"   {label}")
+        print(f"      CPU:   {before_seconds:.2f}s -> {after_seconds:.2f}s ({before_seconds / after_seconds:.1f}x)")
+        print(f"      Bytes sent to model: {sent_before / 1e6:.1f} MB -> {sent_after / 1e6:.1f} MB")
+        print(f"      e.g. {prepared[0]}")
+
+    uploads = [open(path, "rb").read() for path in files]
+    print(f"\n{'=' * 70}")
+    print(f"📊 Image ingest over {len(files)} test_images ({CONSUMERS} pipelines x {CALLS_PER_CONSUMER} model calls)")
+    run("Files as stored", uploads)
+    # The old path's lossless WebP re-encode of 12 MP frames is slow, so a subset shows the gap
+    run("3 photos as 12 MP phone JPEGs (EXIF-rotated)", [camera_upload(path) for path in files[:3]])
+    print(f"{'=' * 70}")
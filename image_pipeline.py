@@ -4,22 +4,49 @@ Image Generation Pipeline - Extracted from app.py for modularity
 Handles solid background, lifestyle, and marketing creative image generation
 """
 import os
-import time
-import google.generativeai as genai
-from PIL import Image
 from io import BytesIO
 from datetime import datetime
 import cloudinary.uploader
 import prompt_instruction_templates
+from client_pool import get_generative_model
+from rate_limiter import get_rate_limiter, estimate_tokens
+from hedging import get_hedge_policy
+from retry_policy import get_retry_policy
+from circuit_breaker import get_circuit_breaker
+from result_cache import get_planner_cache, normalize_text
+from image_ingest import ensure_prepared
+from config import PLANNER_CACHE_ENABLED
 
+PLANNER_MODEL = 'gemini-2.5-pro'
+IMAGE_MODEL = 'gemini-2.5-flash-image'
+JOB_TYPES = ('solid_background', 'lifestyle', 'marketing_creative')
 
-def plan_prompt(instruction_template, user_product_type, unique_id, user_images, user_guidelines=None, user_marketing_copy=None):
+
+def plan_prompt(instruction_template, user_product_type, unique_id, user_images, user_guidelines=None, user_marketing_copy=None, planner_model=None, force_replan=False):
     """
     Generates the meta-prompt for the Planner LLM. This is now a multimodal call
     that includes the user's images for an accurate visual analysis.
+
+    With PLANNER_CACHE_ENABLED, a previous plan for the same template, text
+    fields and (perceptually) same images is reused unless force_replan is set.
+    The unique Request-ID line is deliberately not part of the cache key.
     """
     print(f"--- Step 1: Planning Prompt (ID: {unique_id}) ---")
 
+    cache_key = None
+    if PLANNER_CACHE_ENABLED:
+        cache_key = get_planner_cache().perceptual_key([image.fingerprint for image in user_images], "plan_prompt", {
+            "model": PLANNER_MODEL,
+            "template": instruction_template,
+            "product_type": normalize_text(user_product_type),
+            "guidelines": normalize_text(user_guidelines),
+            "marketing_copy": normalize_text(user_marketing_copy),
+        })
+        cached = get_planner_cache().get(cache_key, bypass=force_replan)
+        if cached:
+            print(f"⚡ Planner cache hit ({unique_id}) - skipping planning call")
+            return cached["prompt"]
+
     # This is the text portion of our prompt.
     prompt_lines = [
         f"Request-ID: {unique_id}",
@@ -34,11 +61,19 @@ def plan_prompt(instruction_template, user_product_type, unique_id, user_images,
     text_prompt = "\n".join(prompt_lines)
 
     # The contents now include both the text instructions AND the images
-    contents = [text_prompt] + user_images
+    contents = [text_prompt] + [image.as_blob() for image in user_images]
 
     try:
-        planner_model = genai.GenerativeModel('gemini-2.5-pro')
-        response = planner_model.generate_content(contents)
+        planner_model = planner_model or get_generative_model(PLANNER_MODEL)
+        estimated_tokens = estimate_tokens(contents)
+        
+        def plan():
+            get_rate_limiter().acquire(PLANNER_MODEL, estimated_tokens)
+            response = get_circuit_breaker("gemini").call(planner_model.generate_content, contents)
+            get_rate_limiter().record_usage(PLANNER_MODEL, estimated_tokens, response.usage_metadata)
+            return response
+        
+        response = get_retry_policy("gemini").call(plan, label=f"Planner ({unique_id})")
 
         cached_tokens = response.usage_metadata.cached_content_token_count
         print(f"Planner ({unique_id}) - Cached Tokens: {cached_tokens}")
@@ -47,27 +82,43 @@ def plan_prompt(instruction_template, user_product_type, unique_id, user_images,
 
         planned_prompt_text = response.text.strip()
         print(f"Successfully planned prompt for '{unique_id}'.")
+        if cache_key:
+            get_planner_cache().set(cache_key, {"prompt": planned_prompt_text})
         
-        time.sleep(1)
         return planned_prompt_text
     except Exception as e:
         print(f"Error during prompt planning (ID: {unique_id}): {e}")
         raise
 
 
-def execute_generation(planned_prompt, user_images, unique_id):
+def execute_generation(planned_prompt, user_images, unique_id, model=None):
     """
     Uses the image generation model with the high-quality, visually-aware prompt.
     """
     print(f"--- Step 2: Executing Image Generation (ID: {unique_id}) ---")
     
     try:
-        model = genai.GenerativeModel('gemini-2.5-flash-image')
+        model = model or get_generative_model(IMAGE_MODEL)
         
         prompt_with_id = f"{planned_prompt}\n\nExecution-ID: {unique_id}"
-        contents = [prompt_with_id] + user_images
+        contents = [prompt_with_id] + [image.as_blob() for image in user_images]
         
-        response = model.generate_content(contents)
+        estimated_tokens = estimate_tokens(contents)
+        
+        def generate():
+            get_rate_limiter().acquire(IMAGE_MODEL, estimated_tokens)
+            response = model.generate_content(contents)
+            get_rate_limiter().record_usage(IMAGE_MODEL, estimated_tokens, response.usage_metadata)
+            return response
+        
+        # Stragglers get a duplicate request when HEDGE_ENABLED (first answer wins);
+        # the hedged pair counts as one call for the breaker, and transient
+        # failures are retried with backoff
+        breaker = get_circuit_breaker("gemini")
+        hedge = get_hedge_policy(IMAGE_MODEL)
+        response = get_retry_policy("gemini").call(
+            lambda: breaker.call(hedge.call, generate), label=f"Executor ({unique_id})"
+        )
 
         cached_tokens = response.usage_metadata.cached_content_token_count
         print(f"Executor ({unique_id}) - Cached Tokens: {cached_tokens}")
@@ -83,7 +134,6 @@ def execute_generation(planned_prompt, user_images, unique_id):
                 break
 
         if generated_image_bytes:
-            time.sleep(1)
             return generated_image_bytes
         else:
             print("--- FAILED TO FIND IMAGE DATA IN RESPONSE ---")
@@ -97,21 +147,21 @@ def execute_generation(planned_prompt, user_images, unique_id):
         raise
 
 
-def run_generation_pipeline(job_type, user_product_type, user_guidelines, user_marketing_copy, user_images_bytes, timestamp_str):
+def run_generation_pipeline(job_type, user_product_type, user_guidelines, user_marketing_copy, user_images, timestamp_str, force_replan=False):
     """
     Orchestrates a single, isolated generation pipeline from planning to execution.
+    user_images are PreparedImages shared (read-only) by all pipelines of the request.
     """
     pipeline_unique_id = f"{timestamp_str}_{job_type}"
     print(f"\n--- Starting Generation Pipeline for Job: {job_type.upper()} (ID: {pipeline_unique_id}) ---")
     
     planned_prompt = None
     try:
-        user_images = [Image.open(BytesIO(img_bytes)) for img_bytes in user_images_bytes]
-
         common_args = {
             "user_product_type": user_product_type,
             "unique_id": pipeline_unique_id,
-            "user_images": user_images
+            "user_images": user_images,
+            "force_replan": force_replan
         }
 
         if job_type == 'solid_background':
@@ -132,7 +182,10 @@ def run_generation_pipeline(job_type, user_product_type, user_guidelines, user_m
         product_slug = user_product_type.replace(" ", "-").lower()
         public_id = f"{product_slug}_{job_type}_{timestamp_str}"
         
-        upload_result = cloudinary.uploader.upload(BytesIO(generated_image_bytes), folder="test_version_2/outputs", public_id=public_id)
+        upload_result = get_retry_policy("cloudinary").call(
+            lambda: cloudinary.uploader.upload(BytesIO(generated_image_bytes), folder="test_version_2/outputs", public_id=public_id),
+            label=f"Cloudinary upload {public_id}"
+        )
         final_url = upload_result['secure_url']
         print(f"Successfully uploaded. Final URL: {final_url}")
         
@@ -144,50 +197,82 @@ def run_generation_pipeline(job_type, user_product_type, user_guidelines, user_m
         return (None, planned_prompt)
 
 
-def generate_images(product_type, guidelines, marketing_copy, user_images_bytes_list):
+def iter_generated_images(product_type, guidelines, marketing_copy, user_images, force_replan=False):
     """
-    Main entry point for image generation pipeline.
-    Runs three generation pipelines in parallel.
+    Runs the three generation pipelines in parallel and yields each result as
+    soon as its pipeline finishes, instead of waiting for the slowest one.
     
-    Returns:
+    Args:
+        user_images: PreparedImages (see image_ingest.prepare_images)
+    
+    Yields:
         dict: {
+            "job_type": str,
+            "index": int (position in JOB_TYPES - stable across requests),
+            "sequence": int (1 = first to finish),
+            "total": int,
             "success": bool,
-            "generated_image_urls": list,
-            "prompts": list (optional)
+            "url": str or None
         }
     """
     import concurrent.futures
     
     timestamp_str = datetime.now().strftime("%Y%m%d_%H%M%S")
+    print(f"--- Preparing to run {len(JOB_TYPES)} pipelines in parallel (Request ID: {timestamp_str}) ---")
     
-    job_types = ['solid_background', 'lifestyle', 'marketing_creative']
-    job_args = [
-        (job_type, product_type, guidelines, marketing_copy, user_images_bytes_list, timestamp_str)
-        for job_type in job_types
-    ]
-        
-    print(f"--- Preparing to run {len(job_types)} pipelines in parallel (Request ID: {timestamp_str}) ---")
-    
-    generated_urls, logged_prompts = [], []
+    logged_prompts = []
     with concurrent.futures.ThreadPoolExecutor() as executor:
-        futures = [executor.submit(run_generation_pipeline, *args) for args in job_args]
-        for future in concurrent.futures.as_completed(futures):
+        futures = {
+            executor.submit(run_generation_pipeline, job_type, product_type, guidelines, marketing_copy,
+                            user_images, timestamp_str, force_replan): (index, job_type)
+            for index, job_type in enumerate(JOB_TYPES)
+        }
+        for sequence, future in enumerate(concurrent.futures.as_completed(futures), start=1):
+            index, job_type = futures[future]
             result_url, planned_prompt = future.result()
-            if result_url: 
-                generated_urls.append(result_url)
             if planned_prompt: 
                 logged_prompts.append(planned_prompt)
+            yield {
+                "job_type": job_type,
+                "index": index,
+                "sequence": sequence,
+                "total": len(JOB_TYPES),
+                "success": result_url is not None,
+                "url": result_url
+            }
+    
+    _log_prompts(logged_prompts, timestamp_str)
+
+
+def generate_images(product_type, guidelines, marketing_copy, user_images_bytes_list, force_replan=False):
+    """
+    Main entry point for image generation pipeline.
+    Runs three generation pipelines in parallel.
+    force_replan skips the planner cache (when enabled) and plans afresh.
+    
+    Returns:
+        dict: {
+            "success": bool,
+            "generated_image_urls": list,
+            "prompts": list (optional)
+        }
+    """
+    # Decode, orient and downsize once - all three pipelines share the result
+    try:
+        user_images = [ensure_prepared(image) for image in user_images_bytes_list]
+    except Exception as e:
+        print(f"Could not read uploaded images: {e}")
+        return {
+            "success": False,
+            "generated_image_urls": [],
+            "message": f"Could not read uploaded images: {e}"
+        }
     
-    # Save prompts to log file
-    if logged_prompts:
-        try:
-            with open("generated_prompts_log.txt", "w", encoding="utf-8") as f:
-                f.write(f"--- LOG FOR GENERATION REQUEST {timestamp_str} ---\n\n")
-                for i, prompt_text in enumerate(logged_prompts):
-                    f.write(f"--- PROMPT {i+1} ---\n{prompt_text}\n\n---------------------------------------\n\n")
-            print("Successfully wrote generated prompts to log file.")
-        except Exception as e:
-            print(f"Failed to write to log file: {e}")
+    generated_urls = [
+        result["url"]
+        for result in iter_generated_images(product_type, guidelines, marketing_copy, user_images, force_replan)
+        if result["success"]
+    ]
     
     print(f"--- All pipelines finished. Successfully generated {len(generated_urls)} images. ---")
     
@@ -195,4 +280,18 @@ def generate_images(product_type, guidelines, marketing_copy, user_images_bytes_
         "success": len(generated_urls) > 0,
         "generated_image_urls": generated_urls,
         "message": f"Successfully generated {len(generated_urls)} images."
-    }
\ No newline at end of file
+    }
+
+
+def _log_prompts(logged_prompts, timestamp_str):
+    """Save the request's planned prompts to the log file"""
+    if not logged_prompts:
+        return
+    try:
+        with open("generated_prompts_log.txt", "w", encoding="utf-8") as f:
+            f.write(f"--- LOG FOR GENERATION REQUEST {timestamp_str} ---\n\n")
+            for i, prompt_text in enumerate(logged_prompts):
+                f.write(f"--- PROMPT {i+1} ---\n{prompt_text}\n\n---------------------------------------\n\n")
+        print("Successfully wrote generated prompts to log file.")
+    except Exception as e:
+        print(f"Failed to write to log file: {e}")
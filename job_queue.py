@@ -0,0 +1,242 @@
+"""
+Background Job Queue - SQLite-backed job store with a bounded worker pool
+Runs long pipelines (video generation) off the request thread so Flask
+workers stay free for /health and /api/edit-image
+"""
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from config import JOB_QUEUE_DB_PATH, JOB_MAX_WORKERS, JOB_MAX_PENDING
+from progress_events import get_event_bus
+from workspace import pid_alive
+
+# Job states
+JOB_QUEUED = "queued"
+JOB_RUNNING = "running"
+JOB_SUCCEEDED = "succeeded"
+JOB_FAILED = "failed"
+
+ACTIVE_STATES = (JOB_QUEUED, JOB_RUNNING)
+
+
+class JobQueueFull(Exception):
+    """Raised when the queue already holds JOB_MAX_PENDING active jobs"""
+
+
+class JobQueue:
+    """
+    Local job queue: job state lives in SQLite, execution happens on a
+    ThreadPoolExecutor inside this process. No outside services needed.
+    """
+
+    def __init__(self, db_path=JOB_QUEUE_DB_PATH, max_workers=JOB_MAX_WORKERS,
+                 max_pending=JOB_MAX_PENDING, events=None):
+        self.db_path = db_path
+        self.max_pending = max_pending
+        self.events = events or get_event_bus()
+        self._handlers = {}
+        self._lock = threading.Lock()
+
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS jobs (
+                    job_id      TEXT PRIMARY KEY,
+                    job_type    TEXT NOT NULL,
+                    status      TEXT NOT NULL,
+                    owner_pid   INTEGER NOT NULL,
+                    created_at  REAL NOT NULL,
+                    started_at  REAL,
+                    finished_at REAL,
+                    result      TEXT,
+                    error       TEXT
+                )
+            """)
+
+        self._recover_orphaned_jobs()
+
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers,
+            thread_name_prefix="job-worker"
+        )
+        print(f"🗂️ Job queue ready: {max_workers} worker(s), db={db_path}")
+
+    def register(self, job_type, handler):
+        """
+        Register the callable that executes a job type.
+
+        handler(payload, progress) -> result dict. A result with "success": False
+        marks the job failed; raising marks it failed with the exception text.
+        progress(stage, **data) publishes a progress event for the job;
+        progress.partial(stage, **data) also keeps data as a partial result
+        that get() returns while the job is still running.
+        """
+        self._handlers[job_type] = handler
+
+    def submit(self, job_type, payload):
+        """Persist a new job and hand it to the worker pool. Returns job_id."""
+        if job_type not in self._handlers:
+            raise ValueError(f"No handler registered for job type: {job_type}")
+
+        job_id = uuid.uuid4().hex
+
+        with self._lock, self._conn:
+            pending = self._conn.execute(
+                "SELECT COUNT(*) FROM jobs WHERE status IN (?, ?) AND owner_pid = ?",
+                (*ACTIVE_STATES, os.getpid())
+            ).fetchone()[0]
+            if pending >= self.max_pending:
+                raise JobQueueFull(f"{pending} jobs already pending")
+
+            self._conn.execute(
+                "INSERT INTO jobs (job_id, job_type, status, owner_pid, created_at) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (job_id, job_type, JOB_QUEUED, os.getpid(), time.time())
+            )
+
+        self.events.publish(job_id, JOB_QUEUED, job_type=job_type)
+        self._executor.submit(self._run, job_id, job_type, payload)
+        print(f"📥 Job queued: {job_type} ({job_id})")
+        return job_id
+
+    def get(self, job_id):
+        """Return the job record as a dict, or None if unknown"""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT * FROM jobs WHERE job_id = ?", (job_id,)
+            ).fetchone()
+
+        if row is None:
+            return None
+
+        job = dict(row)
+        job.pop("owner_pid", None)
+        job["result"] = json.loads(job["result"]) if job["result"] else None
+        return job
+
+    def _run(self, job_id, job_type, payload):
+        """Worker entry point - never raises"""
+        self._update(job_id, status=JOB_RUNNING, started_at=time.time())
+        self.events.publish(job_id, JOB_RUNNING)
+        print(f"▶️ Job started: {job_type} ({job_id})")
+
+        try:
+            result = self._handlers[job_type](payload, _JobProgress(self, job_id))
+        except Exception as e:
+            print(f"❌ Job {job_id} raised: {e}")
+            import traceback
+            traceback.print_exc()
+            self._update(job_id, status=JOB_FAILED, finished_at=time.time(), error=str(e))
+            self._finish_events(job_id, JOB_FAILED, str(e))
+            return
+
+        succeeded = not isinstance(result, dict) or result.get("success", True)
+        error = None if succeeded else result.get("error", "Job failed")
+
+        self._update(
+            job_id,
+            status=JOB_SUCCEEDED if succeeded else JOB_FAILED,
+            finished_at=time.time(),
+            result=json.dumps(result, default=str),
+            error=error
+        )
+        self._finish_events(job_id, JOB_SUCCEEDED if succeeded else JOB_FAILED, error)
+        print(f"{'✅' if succeeded else '❌'} Job finished: {job_type} ({job_id})")
+
+    def _finish_events(self, job_id, status, error):
+        """Terminal event; subscribers disconnect once they have it"""
+        self.events.publish(job_id, status, error=error)
+        self.events.close(job_id)
+
+    def _update(self, job_id, **fields):
+        columns = ", ".join(f"{name} = ?" for name in fields)
+        with self._lock, self._conn:
+            self._conn.execute(
+                f"UPDATE jobs SET {columns} WHERE job_id = ?",
+                (*fields.values(), job_id)
+            )
+
+    def _recover_orphaned_jobs(self):
+        """Fail active jobs whose owning process is gone (crash/restart)"""
+        with self._lock, self._conn:
+            rows = self._conn.execute(
+                "SELECT job_id, owner_pid FROM jobs WHERE status IN (?, ?)",
+                ACTIVE_STATES
+            ).fetchall()
+
+            # A fresh queue in this process has nothing running yet, so its own pid counts as gone
+            orphaned = [row["job_id"] for row in rows
+                        if row["owner_pid"] == os.getpid() or not pid_alive(row["owner_pid"])]
+            for job_id in orphaned:
+                self._conn.execute(
+                    "UPDATE jobs SET status = ?, finished_at = ?, error = ? WHERE job_id = ?",
+                    (JOB_FAILED, time.time(), "Interrupted by server restart", job_id)
+                )
+
+        if orphaned:
+            print(f"🧹 Marked {len(orphaned)} interrupted job(s) as failed")
+
+    def shutdown(self, wait=True):
+        """Stop the worker pool; queued jobs are cancelled when not waiting"""
+        self._executor.shutdown(wait=wait, cancel_futures=not wait)
+        if wait:
+            self._conn.close()
+
+
+class _JobProgress:
+    """progress callable handed to job handlers"""
+
+    def __init__(self, queue, job_id):
+        self._queue = queue
+        self._job_id = job_id
+        self._partial = []
+        self._lock = threading.Lock()
+
+    def __call__(self, stage, **data):
+        return self._queue.events.publish(self._job_id, stage, **data)
+
+    def partial(self, stage, **data):
+        """Persist data as a partial result, then publish it as an event"""
+        with self._lock:
+            self._partial.append(data)
+            self._queue._update(self._job_id, result=json.dumps({"partial": self._partial}, default=str))
+        return self(stage, **data)
+
+
+if __name__ == "__main__":
+    # Benchmark: 50 concurrent submissions against a fake 2s pipeline
+    import tempfile
+    from concurrent.futures import ThreadPoolExecutor as Clients
+
+    SUBMISSIONS = 50
+    db_path = os.path.join(tempfile.mkdtemp(prefix="job_bench_"), "jobs.sqlite3")
+    queue = JobQueue(db_path=db_path, max_workers=JOB_MAX_WORKERS, max_pending=SUBMISSIONS)
+    queue.register("fake_video", lambda payload, progress: (time.sleep(2), {"success": True})[1])
+
+    def submit_one(i):
+        start = time.perf_counter()
+        job_id = queue.submit("fake_video", {"index": i})
+        return job_id, time.perf_counter() - start
+
+    bench_start = time.perf_counter()
+    with Clients(max_workers=SUBMISSIONS) as clients:
+        results = list(clients.map(submit_one, range(SUBMISSIONS)))
+    elapsed = time.perf_counter() - bench_start
+
+    latencies = sorted(latency for _, latency in results)
+    print(f"\n{'=' * 70}")
+    print(f"📊 {SUBMISSIONS} concurrent submissions in {elapsed * 1000:.1f} ms")
+    print(f"   Throughput: {SUBMISSIONS / elapsed:.0f} submissions/s")
+    print(f"   p50 latency: {latencies[len(latencies) // 2] * 1000:.2f} ms")
+    print(f"   p99 latency: {latencies[int(len(latencies) * 0.99) - 1] * 1000:.2f} ms")
+    print(f"   (Synchronous endpoint: each request would hold a worker for the full pipeline)")
+    print(f"{'=' * 70}")
+
+    queue.shutdown(wait=False)
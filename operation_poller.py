@@ -0,0 +1,232 @@
+"""
+Shared poller for long-running Veo operations
+One background thread owns every outstanding operation and polls it with
+adaptive intervals (fast early, exponential later, jittered) until it is
+done or its deadline passes. Waiters get a Future instead of a sleep loop.
+"""
+import heapq
+import itertools
+import random
+import threading
+import time
+from concurrent.futures import Future, InvalidStateError
+
+from config import (
+    VEO_POLL_INITIAL_INTERVAL,
+    VEO_POLL_MAX_INTERVAL,
+    VEO_POLL_BACKOFF,
+    VEO_POLL_JITTER,
+    VEO_OPERATION_TIMEOUT
+)
+
+
+class OperationTimeout(TimeoutError):
+    """Raised into a waiter's Future when an operation misses its deadline (retryable)"""
+
+
+class _TrackedOperation:
+    """Bookkeeping for one outstanding operation"""
+
+    def __init__(self, client, operation, deadline, label, on_poll=None):
+        self.client = client
+        self.operation = operation
+        self.deadline = deadline
+        self.label = label
+        self.interval = VEO_POLL_INITIAL_INTERVAL
+        self.polls = 0
+        self.started_at = time.monotonic()
+        self.on_poll = on_poll
+        self.future = Future()
+
+
+class OperationPoller:
+    """Polls all tracked operations from a single daemon thread"""
+
+    def __init__(self, initial_interval=VEO_POLL_INITIAL_INTERVAL,
+                 max_interval=VEO_POLL_MAX_INTERVAL, backoff=VEO_POLL_BACKOFF,
+                 jitter=VEO_POLL_JITTER, default_timeout=VEO_OPERATION_TIMEOUT):
+        self.initial_interval = initial_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.jitter = jitter
+        self.default_timeout = default_timeout
+
+        self._schedule = []  # heap of (next_poll_at, seq, tracked)
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._thread = None
+        self._polling = 0  # Popped from the schedule, poll in progress
+
+        # Counters
+        self._polls_issued = 0
+        self._poll_errors = 0
+        self._completed = 0
+        self._timed_out = 0
+        self._polls_for_completed = 0
+
+    def track(self, client, operation, timeout=None, label=None, callback=None, on_poll=None):
+        """
+        Start tracking an operation returned by client.models.generate_videos
+
+        Args:
+            client: genai.Client used to refresh the operation
+            operation: Submitted operation
+            timeout: Seconds until OperationTimeout (default VEO_OPERATION_TIMEOUT)
+            label: Name for logging (e.g. "Segment 2")
+            callback: Optional fn(future) called when the operation resolves
+            on_poll: Optional fn(polls, elapsed_seconds) called after each unfinished poll
+
+        Returns:
+            Future resolving to the finished operation
+        """
+        timeout = self.default_timeout if timeout is None else timeout
+        tracked = _TrackedOperation(
+            client, operation, time.monotonic() + timeout, label or operation.name, on_poll
+        )
+        tracked.interval = self.initial_interval
+
+        if callback:
+            tracked.future.add_done_callback(callback)
+
+        if operation.done:
+            self._resolve(tracked)
+            return tracked.future
+
+        with self._cond:
+            self._push(tracked, time.monotonic() + self._jittered(tracked.interval))
+            self._ensure_thread()
+            self._cond.notify()
+
+        return tracked.future
+
+    def get_stats(self):
+        """Counters for /api/metrics"""
+        with self._cond:
+            completed = self._completed
+            return {
+                "in_flight": len(self._schedule) + self._polling,
+                "polls_issued": self._polls_issued,
+                "poll_errors": self._poll_errors,
+                "operations_completed": completed,
+                "operations_timed_out": self._timed_out,
+                "polls_per_completed_operation": (
+                    round(self._polls_for_completed / completed, 2) if completed else None
+                ),
+            }
+
+    # ------------------------------------------------------------------
+    # Poll loop
+    # ------------------------------------------------------------------
+
+    def _ensure_thread(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(
+                target=self._run, name="veo-operation-poller", daemon=True
+            )
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._schedule:
+                    self._cond.wait()
+
+                next_poll_at, _, tracked = self._schedule[0]
+                delay = next_poll_at - time.monotonic()
+                if delay > 0:
+                    # Woken early if a new operation is scheduled sooner
+                    self._cond.wait(timeout=delay)
+                    continue
+
+                heapq.heappop(self._schedule)
+                if tracked.future.done():
+                    continue  # Cancelled by its waiter - stop polling it
+                self._polling += 1
+
+            try:
+                self._poll(tracked)
+            except Exception as e:
+                # Never let one operation kill the thread every other waiter depends on
+                print(f"⚠️ Poller error ({tracked.label}): {e}")
+                with self._cond:
+                    self._poll_errors += 1
+                self._settle(tracked, exception=e)
+            finally:
+                with self._cond:
+                    self._polling -= 1
+
+    def _poll(self, tracked):
+        tracked.polls += 1
+        with self._cond:
+            self._polls_issued += 1
+
+        try:
+            tracked.operation = tracked.client.operations.get(tracked.operation)
+        except Exception as e:
+            print(f"⚠️ Polling error ({tracked.label}): {e}")
+            with self._cond:
+                self._poll_errors += 1
+
+        if tracked.operation.done:
+            self._resolve(tracked)
+            return
+
+        now = time.monotonic()
+        elapsed = int(now - tracked.started_at)
+        if now >= tracked.deadline:
+            print(f"⏱️ {tracked.label}: timeout after {elapsed}s ({tracked.polls} polls)")
+            with self._cond:
+                self._timed_out += 1
+            self._settle(tracked, exception=OperationTimeout(
+                f"{tracked.label} did not finish within {elapsed}s"
+            ))
+            return
+
+        if tracked.polls % 4 == 0:
+            print(f"   {tracked.label}: {elapsed}s elapsed...")
+
+        if tracked.on_poll:
+            try:
+                tracked.on_poll(tracked.polls, elapsed)
+            except Exception as e:
+                print(f"⚠️ Poll callback failed ({tracked.label}): {e}")
+
+        tracked.interval = min(self.max_interval, tracked.interval * self.backoff)
+        next_poll_at = min(now + self._jittered(tracked.interval), tracked.deadline)
+        with self._cond:
+            self._push(tracked, next_poll_at)
+
+    def _resolve(self, tracked):
+        with self._cond:
+            self._completed += 1
+            self._polls_for_completed += tracked.polls
+        self._settle(tracked, result=tracked.operation)
+
+    def _settle(self, tracked, result=None, exception=None):
+        """Resolve the waiter's Future unless it was cancelled meanwhile"""
+        try:
+            if exception is not None:
+                tracked.future.set_exception(exception)
+            else:
+                tracked.future.set_result(result)
+        except InvalidStateError:
+            pass  # Cancelled between the done() check and now
+
+    def _push(self, tracked, next_poll_at):
+        heapq.heappush(self._schedule, (next_poll_at, next(self._seq), tracked))
+
+    def _jittered(self, interval):
+        return interval * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+
+_poller = None
+_poller_lock = threading.Lock()
+
+
+def get_operation_poller():
+    """Process-wide poller shared by every VeoVideoGenerator"""
+    global _poller
+    with _poller_lock:
+        if _poller is None:
+            _poller = OperationPoller()
+        return _poller
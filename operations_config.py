@@ -1858,6 +1858,7 @@ Generate a hyper-specific instruction for Nano Banana to create a creative featu
         "name": "Lighting & Exposure Correction",
         "category": "All",
         "test_image_type": "product_snowblower",
+        "local_engine": "exposure",  # Runs in local_engines.py, no model calls
         "instruction_template": """
 OPERATION: Lighting and Exposure Optimization
 
@@ -1900,6 +1901,7 @@ Generate the instruction.
         "name": "White Balance Adjustment",
         "category": "All",
         "test_image_type": "product_tool",
+        "local_engine": "white_balance",  # Runs in local_engines.py, no model calls
         "instruction_template": """
 OPERATION: White Balance and Color Temperature Correction
 
@@ -1942,6 +1944,7 @@ Generate the instruction.
         "name": "Color Correction (Hue/Saturation/Vibrance)",
         "category": "All",
         "test_image_type": "product_snowblower",
+        "local_engine": "color",  # Runs in local_engines.py, no model calls
         "instruction_template": """
 OPERATION: Precise Color Matching and Correction
 
@@ -1983,6 +1986,7 @@ Generate the instruction.
     "name": "Background Removal / Isolation",
     "category": "All",
     "test_image_type": "product_tool",
+    "local_engine": "background_removal",  # Studio shots run in local_engines.py; scenes fall back to the models
     "instruction_template": """You are an expert in AI image editing, specifically using a model that understands natural language commands to perform edits. Your task is to generate a detailed, hyper-specific prompt for an AI image editing model, 'nano banana', to achieve a desired image manipulation. The generated prompt should be clear, concise, and provide all the necessary information for the AI to produce a high-quality result.
 
     **Analysis of the Request:**
@@ -2231,6 +2235,7 @@ Generate the instruction.
         "name": "Noise Reduction / Image Clean-up",
         "category": "All",
         "test_image_type": "product_tool",
+        "local_engine": "denoise",  # Runs in local_engines.py (tiled, worker processes), no model calls
         "instruction_template": """
 OPERATION: Noise Reduction and Image Quality Cleanup
 
@@ -2273,6 +2278,7 @@ Generate the instruction.
         "name": "Image Upscaling / Super Resolution",
         "category": "All",
         "test_image_type": "product_tool",
+        "local_engine": "upscale",  # Runs in local_engines.py (tiled, worker processes), no model calls
         "instruction_template": """
 OPERATION: AI Upscaling to Higher Resolution
 
@@ -2315,6 +2321,7 @@ Generate the instruction.
         "name": "Perspective Correction",
         "category": "All",
         "test_image_type": "furniture_chair",
+        "local_engine": "perspective",  # Line-based homography in local_engines.py; lens distortion goes to the models
         "instruction_template": """
 OPERATION: Perspective and Distortion Correction
 
@@ -2812,6 +2819,7 @@ Generate the instruction.
         "name": "Watermark / Branding Overlay",
         "category": "All",
         "test_image_type": "beauty_bottle",
+        "local_engine": "watermark",  # Uploaded logo or quoted text composited in local_engines.py, no model calls
         "instruction_template": """
 OPERATION: Add Watermark or Branding
 
@@ -2879,6 +2887,11 @@ def get_operation_template(operation_id, user_details=""):
     
     return template
 
+def get_local_engine(operation_id):
+    """Name of the local engine for this operation, or None if it needs the models"""
+    op = get_operation_by_id(operation_id)
+    return op.get("local_engine") if op else None
+
 def get_test_image_type(operation_id):
     """Get the image type needed for testing this operation"""
     op = get_operation_by_id(operation_id)
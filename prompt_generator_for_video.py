@@ -3,11 +3,8 @@ Simplified Veo Prompt Generator
 Generates prompts via Gemini, extracts veo_prompt strings, logs what Veo will receive
 """
 import json
-import time
 import re
 import math
-from google import genai
-from google.genai import types
 from config import (
     TEXT_MODEL, 
     ALLOW_PEOPLE_IN_VIDEO, 
@@ -15,6 +12,11 @@ from config import (
     DEFAULT_TOTAL_DURATION, 
     DEFAULT_SEGMENT_DURATION
 )
+from client_pool import get_client
+from rate_limiter import get_rate_limiter, estimate_tokens
+from image_ingest import prepare_image
+from retry_policy import get_retry_policy, RetryableError
+from circuit_breaker import get_circuit_breaker
 total_duration = DEFAULT_TOTAL_DURATION
 segment_duration = DEFAULT_SEGMENT_DURATION
 num_segments = total_duration/segment_duration
@@ -22,8 +24,8 @@ num_segments = total_duration/segment_duration
 class VeoPromptGenerator:
     """Generates Veo prompts via Gemini with verification logging"""
     
-    def __init__(self, model=TEXT_MODEL):
-        self.client = genai.Client()
+    def __init__(self, model=TEXT_MODEL, client=None):
+        self.client = client or get_client(model)
         self.model = model
     
     def generate_simple_prompts(self, image_paths, product_overview, brand_guidelines, 
@@ -40,60 +42,53 @@ class VeoPromptGenerator:
             num_segments, product_overview, brand_guidelines, segment_duration
         )
         
-        # Read image
+        # Read image (oriented + downsized once, reused across retries)
         with open(primary_image_path, "rb") as f:
-            image_data = f.read()
-        mime = self._guess_mime(primary_image_path)
+            primary_image = prepare_image(f.read())
         
-        # Call Gemini with retry
-        for attempt in range(5):
-            try:
-                print(f"🎬 Generating {num_segments} segment prompts... (attempt {attempt + 1}/5)")
-                
-                response = self.client.models.generate_content(
-                    model=self.model,
-                    contents=[
-                        instruction,
-                        types.Part.from_bytes(data=image_data, mime_type=mime)
-                    ],
-                )
-                
-                raw_text = (response.text or "").strip()
-                if not raw_text:
-                    print("⚠️ Empty response from LLM")
-                    time.sleep((attempt + 1) * 10)
-                    continue
-                
-                # Parse (JSON or text)
-                prompts = self._parse_any_format(raw_text, num_segments, segment_duration)
-                
-                if not prompts:
-                    print("⚠️ No valid prompts extracted")
-                    time.sleep((attempt + 1) * 10)
-                    continue
-                
-                # Display and verify
-                self._display_prompts(prompts)
-                self._verify_veo_prompts(prompts)
-                
-                if SAVE_PROMPTS_TO_FILE:
-                    self._save_prompts(prompts)
-                
-                return prompts
-                
-            except Exception as e:
-                error_msg = str(e)
-                if "503" in error_msg or "UNAVAILABLE" in error_msg:
-                    print(f"⚠️ API error, retrying in {(attempt + 1) * 10}s...")
-                    time.sleep((attempt + 1) * 10)
-                else:
-                    print(f"❌ Error: {e}")
-                    import traceback
-                    traceback.print_exc()
-                    return None
-        
-        print("❌ Failed after 5 attempts")
-        return None
+        contents = [
+            instruction,
+            primary_image.as_part()
+        ]
+        estimated_tokens = estimate_tokens(contents)
+
+        def attempt():
+            print(f"🎬 Generating {num_segments} segment prompts...")
+            get_rate_limiter().acquire(self.model, estimated_tokens)
+            response = get_circuit_breaker("gemini").call(
+                self.client.models.generate_content,
+                model=self.model,
+                contents=contents,
+            )
+            get_rate_limiter().record_usage(self.model, estimated_tokens, response.usage_metadata)
+
+            raw_text = (response.text or "").strip()
+            if not raw_text:
+                raise RetryableError("Empty response from LLM")
+
+            # Parse (JSON or text)
+            prompts = self._parse_any_format(raw_text, num_segments, segment_duration)
+            if not prompts:
+                raise RetryableError("No valid prompts extracted")
+            return prompts
+
+        # Call Gemini with retry (backoff, transient errors only - see retry_policy.py)
+        try:
+            prompts = get_retry_policy("gemini").call(attempt, label="Veo prompt generation")
+        except Exception as e:
+            print(f"❌ Error: {e}")
+            import traceback
+            traceback.print_exc()
+            return None
+
+        # Display and verify
+        self._display_prompts(prompts)
+        self._verify_veo_prompts(prompts)
+
+        if SAVE_PROMPTS_TO_FILE:
+            self._save_prompts(prompts)
+
+        return prompts
     
     def _parse_any_format(self, text, num_segments, segment_duration):
         """Parse JSON array/object or raw text; always return list of dicts with veo_prompt"""
@@ -212,14 +207,6 @@ class VeoPromptGenerator:
         except Exception as e:
             print(f"❌ Error saving: {e}")
     
-    def _guess_mime(self, path):
-        """Guess MIME from extension"""
-        p = path.lower()
-        if p.endswith(".png"): return "image/png"
-        if p.endswith((".jpg", ".jpeg")): return "image/jpeg"
-        if p.endswith(".webp"): return "image/webp"
-        return "image/png"
-    
     def _build_instruction(self, num_segments, product_overview, brand_guidelines, segment_duration):
       with open('templates/veo_master_instruction.txt', 'r') as f:
           template = f.read()
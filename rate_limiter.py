@@ -0,0 +1,180 @@
+"""
+Per-model token-bucket rate limiter for Gemini calls
+Replaces the fixed time.sleep(1) after every call: a request only waits
+when its model's RPM/TPM budget is actually close to exhausted. Waiters
+reserve capacity in arrival order, so busy threads cannot starve others.
+"""
+import threading
+import time
+
+from config import MODEL_RATE_LIMITS, RATE_LIMIT_BURST_SECONDS
+
+IMAGE_TOKEN_ESTIMATE = 258  # Gemini's token cost for a (small) image part
+
+
+class TokenBucket:
+    """
+    Bucket refilled continuously at rate_per_minute, holding at most capacity.
+
+    take() always succeeds and may drive the level negative; the deficit is
+    the queue of earlier reservations, so the returned wait is FIFO-fair.
+    """
+
+    def __init__(self, rate_per_minute, capacity=None):
+        self.rate_per_second = rate_per_minute / 60
+        self.capacity = capacity or max(1.0, self.rate_per_second * RATE_LIMIT_BURST_SECONDS)
+        self.level = self.capacity
+        self.updated_at = time.monotonic()
+
+    def take(self, amount, now):
+        """Reserve amount and return the seconds until it is covered"""
+        self._refill(now)
+        self.level -= amount
+        return 0.0 if self.level >= 0 else -self.level / self.rate_per_second
+
+    def give_back(self, amount, now):
+        """Adjust for over/under-estimated reservations (amount may be negative)"""
+        self._refill(now)
+        self.level = min(self.capacity, self.level + amount)
+
+    def _refill(self, now):
+        self.level = min(self.capacity, self.level + (now - self.updated_at) * self.rate_per_second)
+        self.updated_at = now
+
+
+class _ModelLimit:
+    def __init__(self, rpm=None, tpm=None):
+        self.requests = TokenBucket(rpm) if rpm else None
+        self.tokens = TokenBucket(tpm) if tpm else None
+        self.acquired = 0
+        self.delayed = 0
+        self.wait_seconds = 0.0
+
+
+class RateLimiter:
+    """Shared limiter holding one request bucket and one token bucket per model"""
+
+    def __init__(self, limits=None):
+        """
+        Args:
+            limits: {model: {"rpm": int, "tpm": int}} (default MODEL_RATE_LIMITS)
+        """
+        limits = MODEL_RATE_LIMITS if limits is None else limits
+        self._models = {model: _ModelLimit(**budget) for model, budget in limits.items()}
+        self._lock = threading.Lock()
+
+    def acquire(self, model, tokens=0):
+        """
+        Block until model has budget for one request of ~tokens tokens
+
+        Args:
+            model: Model name (unlisted models return immediately)
+            tokens: Estimated tokens for the call (see estimate_tokens)
+
+        Returns:
+            float: Seconds spent waiting
+        """
+        limit = self._models.get(model)
+        if limit is None:
+            return 0.0
+
+        with self._lock:
+            now = time.monotonic()
+            wait = 0.0
+            if limit.requests:
+                wait = max(wait, limit.requests.take(1, now))
+            if limit.tokens and tokens:
+                wait = max(wait, limit.tokens.take(tokens, now))
+            limit.acquired += 1
+            if wait > 0:
+                limit.delayed += 1
+                limit.wait_seconds += wait
+
+        if wait > 0:
+            print(f"⏳ {model}: quota nearly spent, waiting {wait:.2f}s")
+            time.sleep(wait)
+        return wait
+
+    def record_usage(self, model, estimated_tokens, usage_metadata):
+        """Correct the token bucket with the usage the API actually reported"""
+        limit = self._models.get(model)
+        actual = getattr(usage_metadata, "total_token_count", None)
+        if limit is None or limit.tokens is None or actual is None:
+            return
+
+        with self._lock:
+            limit.tokens.give_back(estimated_tokens - actual, time.monotonic())
+
+    def get_stats(self):
+        """Counters for /api/metrics"""
+        with self._lock:
+            return {
+                model: {
+                    "acquired": limit.acquired,
+                    "delayed": limit.delayed,
+                    "wait_seconds": round(limit.wait_seconds, 2),
+                }
+                for model, limit in self._models.items()
+            }
+
+
+def estimate_tokens(contents):
+    """Rough pre-call token estimate: ~4 chars per token plus a flat cost per image"""
+    total = 0
+    for item in contents:
+        if isinstance(item, str):
+            total += len(item) // 4 + 1
+        else:
+            total += IMAGE_TOKEN_ESTIMATE
+    return total
+
+
+_limiter = None
+_limiter_lock = threading.Lock()
+
+
+def get_rate_limiter():
+    """Process-wide limiter shared by every pipeline"""
+    global _limiter
+    with _limiter_lock:
+        if _limiter is None:
+            _limiter = RateLimiter()
+        return _limiter
+
+
+if __name__ == "__main__":
+    # Check: 16 threads hammering a 120 RPM model must not exceed the budget
+    from concurrent.futures import ThreadPoolExecutor
+
+    RPM = 120
+    THREADS = 16
+    CALLS = 60
+    limiter = RateLimiter({"bench-model": {"rpm": RPM}})
+    capacity = limiter._models["bench-model"].requests.capacity
+
+    start = time.monotonic()
+    with ThreadPoolExecutor(max_workers=THREADS) as pool:
+        granted = sorted(pool.map(
+            lambda _: (limiter.acquire("bench-model"), time.monotonic() - start)[1],
+            range(CALLS)
+        ))
+    elapsed = granted[-1]
+
+    # Any window of t seconds may hold at most burst + t * rate calls
+    rate = RPM / 60
+    worst = max(
+        j - i + 1 - (granted[j] - granted[i]) * rate
+        for i in range(len(granted)) for j in range(i, len(granted))
+    )
+    expected = (CALLS - capacity) / rate
+
+    print(f"\n{'=' * 70}")
+    print(f"📊 {CALLS} calls from {THREADS} threads at {RPM} RPM (burst {capacity:.0f})")
+    print(f"   Finished in {elapsed:.2f}s (ideal {expected:.2f}s)")
+    print(f"   Worst window excess over rate: {worst:.2f} calls (must be <= burst)")
+    print(f"   Idle call wait: {RateLimiter({'m': {'rpm': RPM}}).acquire('m') * 1000:.1f} ms")
+    print(f"   Stats: {limiter.get_stats()}")
+    print(f"{'=' * 70}")
+
+    assert worst <= capacity + 0.5, "rate exceeded"
+    assert elapsed >= expected - 0.1, "finished faster than the configured rate allows"
@@ -0,0 +1,362 @@
+"""
+Content-addressed result cache
+Keys are SHA-256 digests of the request inputs (image bytes + parameters),
+values are small JSON-serialisable dicts (e.g. a Cloudinary URL). Entries
+expire after a TTL and the store is bounded with LRU eviction.
+
+Backends are pluggable: SQLiteCacheBackend for a single node (default),
+MemoryCacheBackend for in-process use. A shared store (Redis, Memcached,
+Firestore...) only has to implement CacheBackend.get/set/delete.
+
+The planner cache reuses the same machinery but keys on a perceptual image
+hash. ResultCache.perceptual_key maps a fingerprint to one seen before within
+PLANNER_CACHE_HASH_DISTANCE bits, so a re-encoded or resized copy of the same
+photo resolves to the same key and still hits.
+"""
+import hashlib
+import json
+import mmap
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from PIL import Image
+
+from config import (
+    RESULT_CACHE_BACKEND,
+    RESULT_CACHE_DB_PATH,
+    RESULT_CACHE_TTL_SECONDS,
+    RESULT_CACHE_MAX_ENTRIES,
+    PLANNER_CACHE_BACKEND,
+    PLANNER_CACHE_DB_PATH,
+    PLANNER_CACHE_TTL_SECONDS,
+    PLANNER_CACHE_MAX_ENTRIES,
+    PLANNER_CACHE_HASH_DISTANCE
+)
+
+_BYTES_LIKE = (bytes, bytearray, memoryview, mmap.mmap)
+
+
+class CacheBackend:
+    """Storage interface - implement these three methods for a shared store"""
+
+    def get(self, key):
+        """Return the stored value, or None if missing/expired"""
+        raise NotImplementedError
+
+    def set(self, key, value):
+        """Store value; returns the number of entries evicted to make room"""
+        raise NotImplementedError
+
+    def delete(self, key):
+        raise NotImplementedError
+
+
+class MemoryCacheBackend(CacheBackend):
+    """In-process LRU dict with TTL"""
+
+    def __init__(self, ttl_seconds=RESULT_CACHE_TTL_SECONDS, max_entries=RESULT_CACHE_MAX_ENTRIES):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # key -> (expires_at, value)
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] < time.time():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.time() + self.ttl_seconds, value)
+            self._entries.move_to_end(key)
+            evicted = 0
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                evicted += 1
+            return evicted
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+
+class SQLiteCacheBackend(CacheBackend):
+    """Single-node persistent cache; survives restarts"""
+
+    def __init__(self, db_path=RESULT_CACHE_DB_PATH, ttl_seconds=RESULT_CACHE_TTL_SECONDS,
+                 max_entries=RESULT_CACHE_MAX_ENTRIES):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS cache (
+                    key           TEXT PRIMARY KEY,
+                    value         TEXT NOT NULL,
+                    expires_at    REAL NOT NULL,
+                    last_accessed REAL NOT NULL
+                )
+            """)
+            self._conn.execute(
+                "CREATE INDEX IF NOT EXISTS cache_lru ON cache (last_accessed)"
+            )
+
+    def get(self, key):
+        now = time.time()
+        with self._lock, self._conn:
+            row = self._conn.execute(
+                "SELECT value, expires_at FROM cache WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            if row[1] < now:
+                self._conn.execute("DELETE FROM cache WHERE key = ?", (key,))
+                return None
+            self._conn.execute(
+                "UPDATE cache SET last_accessed = ? WHERE key = ?", (now, key)
+            )
+        return json.loads(row[0])
+
+    def set(self, key, value):
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO cache (key, value, expires_at, last_accessed) "
+                "VALUES (?, ?, ?, ?)",
+                (key, json.dumps(value), now + self.ttl_seconds, now)
+            )
+            # Expired entries go first, then least recently used beyond the bound
+            evicted = self._conn.execute(
+                "DELETE FROM cache WHERE expires_at < ?", (now,)
+            ).rowcount
+            overflow = self._conn.execute("SELECT COUNT(*) FROM cache").fetchone()[0] - self.max_entries
+            if overflow > 0:
+                evicted += self._conn.execute(
+                    "DELETE FROM cache WHERE key IN "
+                    "(SELECT key FROM cache ORDER BY last_accessed LIMIT ?)",
+                    (overflow,)
+                ).rowcount
+        return evicted
+
+    def delete(self, key):
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM cache WHERE key = ?", (key,))
+
+
+class ResultCache:
+    """Cache front-end: key derivation plus hit/miss counters"""
+
+    def __init__(self, backend, name="cache", max_distance=PLANNER_CACHE_HASH_DISTANCE,
+                 max_fingerprints=PLANNER_CACHE_MAX_ENTRIES):
+        self.backend = backend
+        self.name = name
+        self.max_distance = max_distance
+        self.max_fingerprints = max_fingerprints
+        self._lock = threading.Lock()
+        self._fingerprints = OrderedDict()  # make_key(*parts) -> [fingerprint tuples seen], LRU
+        self._stats = {"hits": 0, "misses": 0, "stores": 0, "evictions": 0, "bypassed": 0, "errors": 0,
+                       "near_matches": 0}
+
+    @staticmethod
+    def make_key(*parts):
+        """
+        SHA-256 over the given parts (bytes-like parts - bytes, mmap - are hashed
+        as-is, anything else as JSON)
+
+        Returns:
+            str: Hex digest
+        """
+        digest = hashlib.sha256()
+        for part in parts:
+            data = part if isinstance(part, _BYTES_LIKE) else json.dumps(part, sort_keys=True).encode("utf-8")
+            digest.update(len(data).to_bytes(8, "big"))
+            digest.update(data)
+        return digest.hexdigest()
+
+    def perceptual_key(self, fingerprints, *parts):
+        """
+        make_key(*parts, fingerprints) with each fingerprint snapped to a near one seen before
+
+        A re-encoded or slightly resized photo flips a few dHash bits, so an
+        exact key would miss. If every fingerprint is within max_distance of
+        those of an earlier lookup with the same parts, that earlier tuple is
+        used instead. Fingerprints are remembered per process (after a restart
+        only exact matches hit until they are seen again).
+
+        Args:
+            fingerprints: perceptual_hash strings, one per image
+            parts: Everything else that shapes the cached value (as for make_key)
+
+        Returns:
+            str: Hex digest
+        """
+        fingerprints = tuple(fingerprints)
+        group = self.make_key(*parts)
+        with self._lock:
+            seen = self._fingerprints.setdefault(group, [])
+            self._fingerprints.move_to_end(group)
+            for known in seen:
+                if len(known) == len(fingerprints) and all(
+                        fingerprint_distance(a, b) <= self.max_distance for a, b in zip(known, fingerprints)):
+                    if known != fingerprints:
+                        self._stats["near_matches"] += 1
+                    fingerprints = known
+                    break
+            else:
+                seen.append(fingerprints)
+                del seen[:-64]  # Variants kept per parts
+                while len(self._fingerprints) > self.max_fingerprints:
+                    self._fingerprints.popitem(last=False)
+        return self.make_key(*parts, list(fingerprints))
+
+    def get(self, key, bypass=False):
+        """Look up key; bypass=True skips the read (the caller recomputes and re-stores)"""
+        if bypass:
+            self._count("bypassed")
+            return None
+        try:
+            value = self.backend.get(key)
+        except Exception as e:
+            print(f"⚠️ {self.name} read failed: {e}")
+            self._count("errors")
+            return None
+        self._count("hits" if value is not None else "misses")
+        return value
+
+    def set(self, key, value):
+        try:
+            evicted = self.backend.set(key, value)
+        except Exception as e:
+            print(f"⚠️ {self.name} write failed: {e}")
+            self._count("errors")
+            return
+        self._count("stores")
+        if evicted:
+            self._count("evictions", evicted)
+
+    def get_stats(self):
+        """Counters for /api/metrics"""
+        with self._lock:
+            stats = dict(self._stats)
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = round(stats["hits"] / lookups, 3) if lookups else None
+        return stats
+
+    def _count(self, name, amount=1):
+        with self._lock:
+            self._stats[name] += amount
+
+
+def create_backend(kind=RESULT_CACHE_BACKEND, db_path=RESULT_CACHE_DB_PATH,
+                   ttl_seconds=RESULT_CACHE_TTL_SECONDS, max_entries=RESULT_CACHE_MAX_ENTRIES):
+    """Backend named in config: "sqlite" or "memory" """
+    if kind == "memory":
+        return MemoryCacheBackend(ttl_seconds, max_entries)
+    if kind == "sqlite":
+        return SQLiteCacheBackend(db_path, ttl_seconds, max_entries)
+    raise ValueError(f"Unknown cache backend: {kind}")
+
+
+def perceptual_hash(image):
+    """
+    Fingerprint that survives re-encoding and resizing of the same photo
+
+    64-bit difference hash (gradient structure) plus a coarse 2x2 colour
+    grid, so colour variants of one product don't share a planned prompt.
+
+    Args:
+        image: PIL Image
+
+    Returns:
+        str: Hex fingerprint
+    """
+    gray = image.convert("L").resize((9, 8), Image.LANCZOS)
+    pixels = list(gray.getdata())
+    bits = 0
+    for row in range(8):
+        for col in range(8):
+            bits = (bits << 1) | (pixels[row * 9 + col] > pixels[row * 9 + col + 1])
+
+    colours = image.convert("RGB").resize((2, 2), Image.BOX).getdata()
+    colour_code = "".join(f"{channel >> 3:02x}" for pixel in colours for channel in pixel)
+    return f"{bits:016x}-{colour_code}"
+
+
+def fingerprint_distance(a, b):
+    """
+    Differing dHash bits between two perceptual_hash fingerprints
+
+    Returns 65 (more than any hash distance) when a colour cell differs by
+    more than one quantisation step, so colour variants never match.
+    """
+    hash_a, colours_a = a.split("-")
+    hash_b, colours_b = b.split("-")
+    if len(colours_a) != len(colours_b) or any(
+            abs(int(colours_a[i:i + 2], 16) - int(colours_b[i:i + 2], 16)) > 1
+            for i in range(0, len(colours_a), 2)):
+        return 65
+    return bin(int(hash_a, 16) ^ int(hash_b, 16)).count("1")
+
+
+def normalize_text(text):
+    """Collapse whitespace so cosmetic edits to user text still hit"""
+    return " ".join((text or "").split())
+
+
+_planner_cache = None
+_planner_cache_lock = threading.Lock()
+
+
+def get_planner_cache():
+    """Process-wide cache of planned prompts (see PLANNER_CACHE_ENABLED)"""
+    global _planner_cache
+    with _planner_cache_lock:
+        if _planner_cache is None:
+            _planner_cache = ResultCache(
+                create_backend(PLANNER_CACHE_BACKEND, PLANNER_CACHE_DB_PATH,
+                               PLANNER_CACHE_TTL_SECONDS, PLANNER_CACHE_MAX_ENTRIES),
+                name="planner cache"
+            )
+        return _planner_cache
+
+
+if __name__ == "__main__":
+    import glob
+    from io import BytesIO
+
+    def _reencode(image, scale, quality):
+        size = (round(image.width * scale), round(image.height * scale))
+        buffer = BytesIO()
+        image.convert("RGB").resize(size, Image.LANCZOS).save(buffer, "JPEG", quality=quality)
+        return Image.open(BytesIO(buffer.getvalue()))
+
+    paths = sorted(glob.glob("test_images/*"))
+    originals = [perceptual_hash(Image.open(path)) for path in paths]
+    cache = ResultCache(MemoryCacheBackend(), name="check")
+    keys = [cache.perceptual_key([fingerprint], "plan", {"op": 1}) for fingerprint in originals]
+    assert len(set(keys)) == len(set(originals)), "distinct photos must not share a key"
+
+    for path, fingerprint, key in zip(paths, originals, keys):
+        image = Image.open(path)
+        for scale, quality in ((1.0, 70), (0.8, 85), (0.5, 60)):
+            variant = perceptual_hash(_reencode(image, scale, quality))
+            distance = fingerprint_distance(fingerprint, variant)
+            assert cache.perceptual_key([variant], "plan", {"op": 1}) == key, (path, scale, quality, distance)
+            print(f"{path}: x{scale} q{quality} -> {distance} bits")
+        assert cache.perceptual_key([fingerprint], "plan", {"op": 2}) != key, "other parts must not match"
+
+    nearest = min(fingerprint_distance(a, b) for i, a in enumerate(originals) for b in originals[i + 1:])
+    stats = cache.get_stats()
+    assert stats["near_matches"] > 0 and nearest > cache.max_distance, (nearest, stats)
+    print(f"closest distinct photos: {nearest} bits; stats: {stats}")
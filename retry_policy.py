@@ -0,0 +1,297 @@
+"""
+Shared retry policy for external calls (Gemini, Veo, GCS, Cloudinary)
+Exponential backoff with full jitter, retryable errors classified by
+exception type and HTTP status (not by matching "503" in the message), a
+per-call deadline, and a per-upstream retry budget: retries may add at most
+RETRY_BUDGET_RATIO on top of first attempts, so during an outage callers
+fail fast instead of multiplying the load on a struggling upstream.
+"""
+import importlib
+import random
+import threading
+import time
+
+from config import RETRY_POLICIES, RETRY_BUDGET_RATIO, RETRY_BUDGET_BURST
+
+RETRYABLE_STATUS = {408, 429, 500, 502, 503, 504}
+
+# google.rpc.Code of a failed long-running operation -> HTTP status
+GRPC_TO_HTTP = {
+    1: 499,  # CANCELLED
+    3: 400,  # INVALID_ARGUMENT (e.g. prompt rejected by safety filters)
+    4: 504,  # DEADLINE_EXCEEDED
+    5: 404,  # NOT_FOUND
+    7: 403,  # PERMISSION_DENIED
+    8: 429,  # RESOURCE_EXHAUSTED
+    9: 400,  # FAILED_PRECONDITION
+    13: 500,  # INTERNAL
+    14: 503,  # UNAVAILABLE
+}
+
+
+class RetryableError(Exception):
+    """Raise for transient conditions an SDK doesn't flag (e.g. an empty model response)"""
+
+
+class UpstreamError(Exception):
+    """Failure reported in a response body rather than raised (e.g. a Veo operation error)"""
+
+    def __init__(self, message, status_code=None):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+def _optional_types(*paths):
+    """Exception classes from SDKs that may not be installed"""
+    found = []
+    for path in paths:
+        module_name, _, name = path.rpartition(".")
+        try:
+            found.append(getattr(importlib.import_module(module_name), name))
+        except (ImportError, AttributeError):
+            pass
+    return tuple(found)
+
+
+TRANSIENT_ERRORS = (ConnectionError, TimeoutError, RetryableError) + _optional_types(
+    "httpx.TransportError",
+    "requests.exceptions.ConnectionError",
+    "requests.exceptions.Timeout",
+    "urllib3.exceptions.ProtocolError",
+    "urllib3.exceptions.TimeoutError",
+    "google.auth.exceptions.TransportError",
+    "cloudinary.exceptions.RateLimited",
+    "cloudinary.exceptions.GeneralError",
+)
+# Cloudinary raises its bare base class for network failures and unmapped 5xx responses
+_CLOUDINARY_BASE_ERROR = _optional_types("cloudinary.exceptions.Error")
+
+
+def status_code(exc):
+    """HTTP status carried by an SDK exception, or None"""
+    for attr in ("status_code", "code", "http_status"):
+        value = getattr(exc, attr, None)
+        if isinstance(value, int) and 100 <= value < 600:
+            return value
+    response = getattr(exc, "response", None)
+    value = getattr(response, "status_code", None)
+    return value if isinstance(value, int) else None
+
+
+def is_retryable(exc):
+    """Transient failure worth another attempt?"""
+    if isinstance(exc, TRANSIENT_ERRORS):
+        return True
+    if _CLOUDINARY_BASE_ERROR and type(exc) is _CLOUDINARY_BASE_ERROR[0]:
+        return True
+    status = status_code(exc)
+    return status in RETRYABLE_STATUS if status is not None else False
+
+
+class RetryBudget:
+    """Every call earns ratio of a retry (up to burst); every retry spends one"""
+
+    def __init__(self, ratio=RETRY_BUDGET_RATIO, burst=RETRY_BUDGET_BURST):
+        self.ratio = ratio
+        self.burst = burst
+        self.balance = burst
+        self._lock = threading.Lock()
+
+    def deposit(self):
+        with self._lock:
+            self.balance = min(self.burst, self.balance + self.ratio)
+
+    def withdraw(self):
+        with self._lock:
+            if self.balance >= 1:
+                self.balance -= 1
+                return True
+            return False
+
+
+class RetryPolicy:
+    """Backoff, classification, deadline and budget for one upstream"""
+
+    def __init__(self, name, max_attempts=4, base_delay=1.0, max_delay=30.0, deadline=None,
+                 classify=is_retryable, budget=None, sleep=time.sleep):
+        self.name = name
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.deadline = deadline
+        self.classify = classify
+        self.budget = budget or RetryBudget()
+        self._sleep = sleep
+        self._lock = threading.Lock()
+        self._stats = {
+            "calls": 0, "retries": 0, "recovered": 0, "non_retryable": 0,
+            "exhausted": 0, "deadline_exceeded": 0, "budget_exhausted": 0,
+        }
+
+    def call(self, fn, label=None, deadline=None):
+        """
+        Run fn() until it succeeds or the policy gives up
+
+        Args:
+            fn: Zero-argument callable making the external call
+            label: Name for logging (default: policy name)
+            deadline: Seconds for all attempts together (default: policy deadline)
+
+        Returns:
+            fn's result; the last exception is re-raised when retries stop
+        """
+        label = label or self.name
+        deadline = self.deadline if deadline is None else deadline
+        deadline_at = time.monotonic() + deadline if deadline else None
+        self.record_call()
+
+        attempt = 1
+        while True:
+            try:
+                result = fn()
+            except Exception as e:
+                delay = self.next_delay(e, attempt, deadline_at)
+                if delay is None:
+                    raise
+                print(f"🔁 {label}: {type(e).__name__} ({str(e)[:120]}) - "
+                      f"retry {attempt}/{self.max_attempts - 1} in {delay:.1f}s")
+                self._sleep(delay)
+                attempt += 1
+                continue
+
+            if attempt > 1:
+                self._count("recovered")
+            return result
+
+    def record_call(self):
+        """Count a first attempt (earns retry budget); call() does this itself"""
+        self._count("calls")
+        self.budget.deposit()
+
+    def next_delay(self, exc, attempts_made, deadline_at=None):
+        """
+        Decide whether a failed call gets another attempt
+
+        Args:
+            exc: The failure
+            attempts_made: Attempts so far, including the failed one
+            deadline_at: time.monotonic() by which the call must be finished
+
+        Returns:
+            float seconds to wait before retrying, or None to give up
+        """
+        if not self.classify(exc):
+            self._count("non_retryable")
+            return None
+        if attempts_made >= self.max_attempts:
+            self._count("exhausted")
+            return None
+
+        # Full jitter: uniform over [0, min(cap, base * 2^n)] spreads synchronized clients apart
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempts_made - 1)))
+        if deadline_at is not None and time.monotonic() + delay >= deadline_at:
+            self._count("deadline_exceeded")
+            return None
+        if not self.budget.withdraw():
+            print(f"🛑 {self.name}: retry budget spent, failing fast")
+            self._count("budget_exhausted")
+            return None
+
+        self._count("retries")
+        return delay
+
+    def get_stats(self):
+        """Counters for /api/metrics"""
+        with self._lock:
+            stats = dict(self._stats)
+        stats["budget_balance"] = round(self.budget.balance, 2)
+        return stats
+
+    def _count(self, name):
+        with self._lock:
+            self._stats[name] += 1
+
+
+_policies = {}
+_policies_lock = threading.Lock()
+
+
+def get_retry_policy(upstream):
+    """Process-wide policy for "gemini", "veo", "gcs" or "cloudinary" (see RETRY_POLICIES)"""
+    with _policies_lock:
+        if upstream not in _policies:
+            _policies[upstream] = RetryPolicy(upstream, **RETRY_POLICIES.get(upstream, {}))
+        return _policies[upstream]
+
+
+def get_retry_stats():
+    """Stats of every policy in use, keyed by upstream"""
+    with _policies_lock:
+        policies = dict(_policies)
+    return {upstream: policy.get_stats() for upstream, policy in policies.items()}
+
+
+if __name__ == "__main__":
+    # Check: a 2s outage hit by 50 concurrent callers - upstream load with and without the budget
+    import contextlib
+    import io
+    from concurrent.futures import ThreadPoolExecutor
+
+    CALLERS = 50
+    OUTAGE_SECONDS = 2.0
+
+    class FakeUpstream:
+        def __init__(self):
+            self.attempts = 0
+            self.lock = threading.Lock()
+            self.outage_until = time.monotonic() + OUTAGE_SECONDS
+
+        def __call__(self):
+            with self.lock:
+                self.attempts += 1
+            time.sleep(0.01)
+            if time.monotonic() < self.outage_until:
+                raise UpstreamError("Service unavailable", status_code=503)
+            return "ok"
+
+    def naive(upstream):
+        # The old pattern: 5 attempts, linear sleeps, no jitter, no budget
+        for attempt in range(5):
+            try:
+                return upstream()
+            except UpstreamError:
+                time.sleep((attempt + 1) * 0.1)
+        return None
+
+    def run(call):
+        upstream = FakeUpstream()
+        with ThreadPoolExecutor(max_workers=CALLERS) as pool, contextlib.redirect_stdout(io.StringIO()):
+            outcomes = list(pool.map(lambda _: call(upstream), range(CALLERS)))
+        return upstream.attempts, sum(outcome == "ok" for outcome in outcomes)
+
+    def budgeted(policy):
+        def call(upstream):
+            try:
+                return policy.call(upstream)
+            except UpstreamError:
+                return None
+        return call
+
+    naive_attempts, naive_ok = run(naive)
+    unbudgeted = RetryPolicy("fake", max_attempts=5, base_delay=0.1, max_delay=1.0,
+                             budget=RetryBudget(ratio=1000, burst=1000))
+    policy = RetryPolicy("fake", max_attempts=5, base_delay=0.1, max_delay=1.0,
+                         budget=RetryBudget(ratio=0.2, burst=10))
+    unbudgeted_attempts, unbudgeted_ok = run(budgeted(unbudgeted))
+    budget_attempts, budget_ok = run(budgeted(policy))
+
+    print(f"\n{'=' * 70}")
+    print(f"📊 {CALLERS} callers during a {OUTAGE_SECONDS:.0f}s upstream outage (503)")
+    print(f"   Linear sleeps, 5 attempts:      {naive_attempts} upstream calls "
+          f"({naive_attempts / CALLERS:.1f}x), {naive_ok} succeeded")
+    print(f"   Backoff + jitter, no budget:   {unbudgeted_attempts} upstream calls "
+          f"({unbudgeted_attempts / CALLERS:.1f}x), {unbudgeted_ok} succeeded")
+    print(f"   Backoff + jitter + 20% budget: {budget_attempts} upstream calls "
+          f"({budget_attempts / CALLERS:.1f}x), {budget_ok} succeeded")
+    print(f"   Stats: {policy.get_stats()}")
+    print(f"{'=' * 70}")
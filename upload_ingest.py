@@ -0,0 +1,220 @@
+"""
+Upload ingestion - keep multipart uploads out of worker memory
+Files above UPLOAD_SPOOL_THRESHOLD_KB are spooled to temp files while the
+request is parsed, size limits are enforced per file and per request, and
+downstream code reads large files through a read-only mmap instead of
+copying them into bytes with .read().
+"""
+import mmap
+import os
+import shutil
+import tempfile
+
+from flask import Request
+
+from config import (
+    UPLOAD_MAX_FILE_MB,
+    UPLOAD_MAX_REQUEST_MB,
+    UPLOAD_SPOOL_THRESHOLD_KB,
+    UPLOAD_SPOOL_DIR
+)
+
+MB = 1024 * 1024
+
+
+class UploadTooLarge(Exception):
+    """Raised when an uploaded file exceeds UPLOAD_MAX_FILE_MB"""
+
+
+class SpoolingRequest(Request):
+    """Flask request whose file parts spill to disk above the spool threshold"""
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return tempfile.SpooledTemporaryFile(
+            max_size=UPLOAD_SPOOL_THRESHOLD_KB * 1024,
+            dir=UPLOAD_SPOOL_DIR
+        )
+
+
+class UploadedFile:
+    """One uploaded file, readable without buffering it in memory"""
+
+    def __init__(self, file_storage):
+        self.filename = file_storage.filename
+        self.stream = file_storage.stream
+        self.stream.seek(0, os.SEEK_END)
+        self.size = self.stream.tell()
+        self.stream.seek(0)
+        self._map = None
+
+    def view(self):
+        """
+        Contents as a bytes-like object
+
+        Returns:
+            bytes for small (in-memory) files, a read-only mmap for spooled ones
+        """
+        if self.size <= UPLOAD_SPOOL_THRESHOLD_KB * 1024 or not hasattr(self.stream, "fileno"):
+            self.stream.seek(0)
+            return self.stream.read()
+
+        if self._map is None:
+            self._map = mmap.mmap(self.stream.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._map
+
+    def save(self, path):
+        """Copy the upload to path in chunks (no full read into memory)"""
+        self.stream.seek(0)
+        with open(path, "wb") as f:
+            shutil.copyfileobj(self.stream, f)
+
+    def close(self):
+        if self._map is not None:
+            try:
+                self._map.close()
+            except BufferError:
+                pass  # A consumer still holds a memoryview; the GC releases it
+            self._map = None
+        self.stream.close()
+
+
+class UploadBatch(list):
+    """UploadedFiles of one request; use as a context manager to release them"""
+
+    def views(self):
+        return [upload.view() for upload in self]
+
+    def close(self):
+        for upload in self:
+            upload.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def ingest_uploads(file_storages, max_file_mb=UPLOAD_MAX_FILE_MB):
+    """
+    Wrap a request's uploads and enforce the per-file limit
+
+    Args:
+        file_storages: request.files.getlist(...) entries
+        max_file_mb: Largest accepted file
+
+    Returns:
+        UploadBatch
+
+    Raises:
+        UploadTooLarge: a file exceeds max_file_mb (the request limit is
+        enforced earlier through MAX_CONTENT_LENGTH)
+    """
+    batch = UploadBatch(UploadedFile(file_storage) for file_storage in file_storages)
+    for upload in batch:
+        if upload.size > max_file_mb * MB:
+            batch.close()
+            raise UploadTooLarge(
+                f"{upload.filename} is {upload.size / MB:.1f} MB (limit {max_file_mb} MB per file)"
+            )
+    return batch
+
+
+if __name__ == "__main__":
+    # Benchmark: peak worker RSS for a 20-image /api/generate-style request, before vs after
+    import glob
+    import socket
+    import subprocess
+    import sys
+    import time
+    from io import BytesIO
+
+    IMAGES = 20
+    mode = os.getenv("UPLOAD_BENCH_MODE")
+
+    if mode:
+        # Child: a minimal server running the old (read everything) or new (spool + mmap) path
+        from flask import Flask, jsonify, request
+        from image_ingest import prepare_images
+
+        bench_app = Flask(__name__)
+        if mode == "after":
+            bench_app.request_class = SpoolingRequest
+            bench_app.config["MAX_CONTENT_LENGTH"] = UPLOAD_MAX_REQUEST_MB * MB
+
+        @bench_app.route("/upload", methods=["POST"])
+        def upload():
+            files = request.files.getlist("images")
+            if mode == "before":
+                prepared = prepare_images([f.read() for f in files])
+            else:
+                with ingest_uploads(files) as uploads:
+                    prepared = prepare_images(uploads.views())
+            return jsonify({"prepared": len(prepared)})
+
+        @bench_app.route("/reset", methods=["POST"])
+        def reset():
+            # Linux: restart the peak (VmHWM) so import-time spikes don't mask the request
+            with open("/proc/self/clear_refs", "w") as f:
+                f.write("5")
+            return rss()
+
+        @bench_app.route("/rss")
+        def rss():
+            with open("/proc/self/status") as f:
+                fields = dict(line.split(":", 1) for line in f)
+            return jsonify({"peak_rss_mb": int(fields["VmHWM"].split()[0]) / 1024})
+
+        bench_app.run(port=int(os.environ["UPLOAD_BENCH_PORT"]), threaded=False)
+        sys.exit(0)
+
+    import requests
+    from PIL import Image, ImageChops
+
+    folder = os.path.join(os.path.dirname(os.path.abspath(__file__)), "test_images")
+    sources = sorted(glob.glob(os.path.join(folder, "*")))
+    payloads = []
+    for i in range(IMAGES):
+        # 12 MP, high-quality JPEGs with sensor noise - typical phone/DSLR product shots
+        image = Image.open(sources[i % len(sources)]).convert("RGB").resize((4032, 3024), Image.LANCZOS)
+        noise = Image.merge("RGB", [Image.effect_noise((4032, 3024), 24)] * 3)
+        image = ImageChops.add(image, noise, scale=1.0, offset=-128)
+        buffer = BytesIO()
+        image.save(buffer, format="JPEG", quality=97)
+        payloads.append(buffer.getvalue())
+    total_mb = sum(len(p) for p in payloads) / MB
+
+    def free_port():
+        with socket.socket() as s:
+            s.bind(("127.0.0.1", 0))
+            return s.getsockname()[1]
+
+    def measure(bench_mode):
+        port = free_port()
+        env = dict(os.environ, UPLOAD_BENCH_MODE=bench_mode, UPLOAD_BENCH_PORT=str(port))
+        server = subprocess.Popen([sys.executable, __file__], env=env,
+                                  stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            for _ in range(100):
+                try:
+                    requests.get(f"http://127.0.0.1:{port}/rss")
+                    break
+                except requests.ConnectionError:
+                    time.sleep(0.1)
+            idle = requests.post(f"http://127.0.0.1:{port}/reset").json()["peak_rss_mb"]
+            files = [("images", (f"product_{i}.jpg", p, "image/jpeg")) for i, p in enumerate(payloads)]
+            requests.post(f"http://127.0.0.1:{port}/upload", files=files).raise_for_status()
+            peak = requests.get(f"http://127.0.0.1:{port}/rss").json()["peak_rss_mb"]
+        finally:
+            server.terminate()
+            server.wait()
+        return idle, peak
+
+    before_idle, before_peak = measure("before")
+    after_idle, after_peak = measure("after")
+
+    print(f"\n{'=' * 70}")
+    print(f"📊 Peak worker RSS for one request with {IMAGES} images ({total_mb:.0f} MB upload)")
+    print(f"   Before (.read() every file): {before_peak:.0f} MB peak (+{before_peak - before_idle:.0f} MB over idle)")
+    print(f"   After (spool + mmap):        {after_peak:.0f} MB peak (+{after_peak - after_idle:.0f} MB over idle)")
+    print(f"{'=' * 70}")
@@ -4,18 +4,33 @@ Passes LLM-generated prompts to Veo API without assumptions about structure
 """
 import time
 import json
-from google import genai
+from collections import deque
+from concurrent.futures import wait, FIRST_COMPLETED
 from google.genai import types
-from config import VIDEO_MODEL, ALLOW_PEOPLE_IN_VIDEO, GENERATE_AUDIO, VIDEO_RESOLUTION
+from config import (
+    VIDEO_MODEL,
+    ALLOW_PEOPLE_IN_VIDEO,
+    GENERATE_AUDIO,
+    VIDEO_RESOLUTION,
+    VEO_CONCURRENT_SEGMENTS,
+    VEO_MAX_IN_FLIGHT
+)
+from operation_poller import get_operation_poller
+from client_pool import get_client
+from progress_events import noop_progress
+from retry_policy import get_retry_policy, RetryableError, UpstreamError, GRPC_TO_HTTP
+from circuit_breaker import get_circuit_breaker
 
 
 class VeoVideoGenerator:
     """Generates videos using LLM prompts (any format)"""
     
-    def __init__(self, model=VIDEO_MODEL, gcs_manager=None):
-        self.client = genai.Client()
+    def __init__(self, model=VIDEO_MODEL, gcs_manager=None, client=None, on_progress=None):
+        self.client = client or get_client(model)
         self.model = model
         self.gcs_manager = gcs_manager
+        self.poller = get_operation_poller()
+        self.on_progress = on_progress or noop_progress  # fn(stage, **data), see progress_events
     
     def _prepare_prompt_for_veo(self, prompt_obj, context=""):
         """
@@ -89,120 +104,208 @@ class VeoVideoGenerator:
         
         return veo_prompt
     
-    def generate_segments(self, prompts, image_gcs_uris):
+    def generate_segments(self, prompts, image_gcs_uris, concurrent=VEO_CONCURRENT_SEGMENTS,
+                          max_in_flight=VEO_MAX_IN_FLIGHT):
         """
         Generate video segments from LLM prompts (any format)
         
+        All operations are tracked by the shared OperationPoller, so this
+        thread only submits work and waits on futures - no per-segment threads.
+        
         Args:
             prompts: List of LLM prompt objects (any structure)
             image_gcs_uris: List of uploaded image URIs
+            concurrent: Submit all segments up front instead of one after another
+            max_in_flight: Max Veo operations running at once (quota guard)
         
         Returns:
-            List of generated video URIs
+            List of generated video URIs (in segment order)
         """
         if not prompts:
             print("❌ No prompts provided")
             return None
         
-        video_gcs_uris = []
-        primary_image_uri = image_gcs_uris[0]
+        total = len(prompts)
+        limit = max(1, min(max_in_flight, total)) if concurrent else 1
+        if limit > 1:
+            print(f"⚡ Concurrent mode: {total} segments, {limit} in flight")
         
+        segments = []
         for idx, prompt_obj in enumerate(prompts):
-            # Extract metadata if present (for logging/organization)
-            if isinstance(prompt_obj, dict):
-                seg_num = prompt_obj.get('segment_number', idx + 1)
-                duration = prompt_obj.get('duration', 8)
-            else:
-                seg_num = idx + 1
-                duration = 8
-            
-            start_time = (seg_num - 1) * duration
-            end_time = start_time + duration
-            
-            print(f"\n{'=' * 70}")
-            print(f"🎬 SEGMENT {seg_num}/{len(prompts)}: {start_time}-{end_time}s")
-            print(f"{'=' * 70}")
-            
-            # Prepare prompt (generic - no assumptions)
-            veo_prompt_string = self._prepare_prompt_for_veo(
-                prompt_obj, 
-                context=f"Segment {seg_num}"
-            )
+            segment = self._build_segment(idx, prompt_obj, total, image_gcs_uris)
+            if segment:
+                segments.append(segment)
+        
+        retry_policy = get_retry_policy("veo")
+        breaker = get_circuit_breaker("veo")  # Probes resolve on submit; finished operations feed the window
+        results = {}
+        pending = deque((segment, 0, 0.0) for segment in segments)  # (segment, attempt, not_before)
+        in_flight = {}
+        
+        while pending or in_flight:
+            # Submit while under the in-flight limit (in segment order)
+            deferred = []
+            while pending and len(in_flight) < limit:
+                segment, attempt, not_before = pending.popleft()
+                if time.monotonic() < not_before:
+                    deferred.append((segment, attempt, not_before))
+                    continue
+                
+                if attempt == 0:
+                    retry_policy.record_call()
+                try:
+                    breaker.before_call()
+                    try:
+                        future = self._submit_segment(segment, attempt)
+                    except Exception as e:
+                        breaker.record(e)
+                        raise
+                    breaker.accepted()
+                    in_flight[future] = (segment, attempt)
+                except Exception as e:
+                    print(f"❌ Segment {segment['seg_num']} attempt {attempt + 1} error: {e}")
+                    self._schedule_retry(pending, segment, attempt, e)
+            pending.extendleft(reversed(deferred))
             
-            if not veo_prompt_string:
-                print(f"❌ Invalid prompt for segment {seg_num}, skipping")
+            if not in_flight:
+                # Only retries waiting out their backoff remain
+                if pending:
+                    time.sleep(max(0.0, min(item[2] for item in pending) - time.monotonic()))
                 continue
             
-            # Retry logic
-            max_retries = 3
-            for attempt in range(max_retries):
+            next_retry_at = min((item[2] for item in pending), default=None)
+            timeout = None if next_retry_at is None else max(0.0, next_retry_at - time.monotonic())
+            done, _ = wait(list(in_flight), timeout=timeout, return_when=FIRST_COMPLETED)
+            
+            for future in done:
+                segment, attempt = in_flight.pop(future)
+                seg_num = segment['seg_num']
+                
                 try:
-                    output_gcs_uri = self.gcs_manager.get_segment_output_uri(
-                        seg_num, start_time, end_time
-                    )
-                    
-                    print(f"📍 Output URI: {output_gcs_uri}")
-                    
-                    # Select image
-                    image_uri = (
-                        image_gcs_uris[seg_num % len(image_gcs_uris)] 
-                        if len(image_gcs_uris) > 1 
-                        else primary_image_uri
-                    )
-                    
-                    if attempt > 0:
-                        print(f"🔄 Retry {attempt}/{max_retries - 1}...")
-                    
-                    print(f"🎥 Calling Veo API...")
-                    
-                    # VEO API CALL
-                    person_gen = "disabled" if not ALLOW_PEOPLE_IN_VIDEO else "allow_adult"
-                    
-                    operation = self.client.models.generate_videos(
-                        model=self.model,
-                        prompt=veo_prompt_string,  # ← Generic prompt
-                        image=types.Image(
-                            gcs_uri=image_uri,
-                            mime_type="image/png",
-                        ),
-                        config=types.GenerateVideosConfig(
-                            aspect_ratio="16:9",
-                            duration_seconds=duration,
-                            resolution=VIDEO_RESOLUTION,
-                            person_generation=person_gen,
-                            generate_audio=GENERATE_AUDIO,
-                            output_gcs_uri=output_gcs_uri,
-                        ),
-                    )
-                    
-                    print(f"✓ Operation submitted: {operation.name}")
-                    
-                    video_uri = self._wait_for_completion(operation, seg_num, len(prompts))
-                    
-                    if video_uri:
-                        video_gcs_uris.append(video_uri)
-                        print(f"✅ Segment {seg_num} succeeded")
-                        break
-                    else:
-                        if attempt < max_retries - 1:
-                            wait_time = (attempt + 1) * 10
-                            print(f"⏰ Waiting {wait_time}s before retry...")
-                            time.sleep(wait_time)
-                        else:
-                            print(f"❌ Segment {seg_num} failed after {max_retries} attempts")
-                        
+                    video_uri = self._extract_video_uri(future.result(), seg_num, total)
+                    error = None if video_uri else RetryableError("No video in the Veo response")
                 except Exception as e:
-                    error_msg = str(e)
-                    print(f"❌ Attempt {attempt + 1} error: {error_msg}")
-                    
-                    if attempt < max_retries - 1:
-                        time.sleep(10)
-                    else:
-                        import traceback
-                        traceback.print_exc()
-                        break
+                    print(f"❌ Segment {seg_num} attempt {attempt + 1} error: {e}")
+                    video_uri, error = None, e
+                breaker.record_outcome(error)
+                
+                if video_uri:
+                    results[segment['idx']] = video_uri
+                    print(f"✅ Segment {seg_num} succeeded")
+                    self.on_progress("segment_done", segment=seg_num, total=total,
+                                     completed=len(results))
+                else:
+                    self._schedule_retry(pending, segment, attempt, error)
         
+        video_gcs_uris = [results[idx] for idx in sorted(results)]
         return video_gcs_uris if len(video_gcs_uris) > 0 else None
+    
+    def _build_segment(self, idx, prompt_obj, total_segments, image_gcs_uris):
+        """Resolve timing, output image and Veo prompt for one segment (None if invalid)"""
+        primary_image_uri = image_gcs_uris[0]
+        
+        # Extract metadata if present (for logging/organization)
+        if isinstance(prompt_obj, dict):
+            seg_num = prompt_obj.get('segment_number', idx + 1)
+            duration = prompt_obj.get('duration', 8)
+        else:
+            seg_num = idx + 1
+            duration = 8
+        
+        start_time = (seg_num - 1) * duration
+        end_time = start_time + duration
+        
+        print(f"\n{'=' * 70}")
+        print(f"🎬 SEGMENT {seg_num}/{total_segments}: {start_time}-{end_time}s")
+        print(f"{'=' * 70}")
+        
+        # Prepare prompt (generic - no assumptions)
+        veo_prompt_string = self._prepare_prompt_for_veo(
+            prompt_obj, 
+            context=f"Segment {seg_num}"
+        )
+        
+        if not veo_prompt_string:
+            print(f"❌ Invalid prompt for segment {seg_num}, skipping")
+            return None
+        
+        # Select image
+        image_uri = (
+            image_gcs_uris[seg_num % len(image_gcs_uris)] 
+            if len(image_gcs_uris) > 1 
+            else primary_image_uri
+        )
+        
+        return {
+            "idx": idx,
+            "seg_num": seg_num,
+            "duration": duration,
+            "start_time": start_time,
+            "end_time": end_time,
+            "image_uri": image_uri,
+            "veo_prompt": veo_prompt_string,
+        }
+    
+    def _submit_segment(self, segment, attempt):
+        """Submit one Veo operation and hand it to the shared poller"""
+        seg_num = segment['seg_num']
+        output_gcs_uri = self.gcs_manager.get_segment_output_uri(
+            seg_num, segment['start_time'], segment['end_time']
+        )
+        
+        print(f"📍 Output URI: {output_gcs_uri}")
+        
+        if attempt > 0:
+            print(f"🔄 Segment {seg_num} retry {attempt}/{get_retry_policy('veo').max_attempts - 1}...")
+        
+        print(f"🎥 Calling Veo API (segment {seg_num})...")
+        
+        # VEO API CALL
+        person_gen = "disabled" if not ALLOW_PEOPLE_IN_VIDEO else "allow_adult"
+        
+        operation = self.client.models.generate_videos(
+            model=self.model,
+            prompt=segment['veo_prompt'],  # ← Generic prompt
+            image=types.Image(
+                gcs_uri=segment['image_uri'],
+                mime_type="image/png",
+            ),
+            config=types.GenerateVideosConfig(
+                aspect_ratio="16:9",
+                duration_seconds=segment['duration'],
+                resolution=VIDEO_RESOLUTION,
+                person_generation=person_gen,
+                generate_audio=GENERATE_AUDIO,
+                output_gcs_uri=output_gcs_uri,
+            ),
+        )
+        
+        print(f"✓ Operation submitted (segment {seg_num}): {operation.name}")
+        print(f"⏳ Waiting for Veo generation...")
+        self.on_progress("segment_submitted", segment=seg_num, attempt=attempt + 1)
+        
+        return self._track(operation, seg_num, f"Segment {seg_num}")
+    
+    def _track(self, operation, seg_num, label):
+        """Hand an operation to the shared poller, reporting each poll as progress"""
+        return self.poller.track(
+            self.client, operation, label=label,
+            on_poll=lambda polls, elapsed: self.on_progress(
+                "segment_polled", segment=seg_num, label=label, polls=polls, elapsed=elapsed
+            )
+        )
+    
+    def _schedule_retry(self, pending, segment, attempt, error):
+        """Queue another attempt after the veo policy's backoff, or give up on the segment"""
+        seg_num = segment['seg_num']
+        delay = get_retry_policy("veo").next_delay(error, attempt + 1)
+        if delay is not None:
+            print(f"⏰ Segment {seg_num}: retrying in {delay:.1f}s...")
+            self.on_progress("segment_retry", segment=seg_num, attempt=attempt + 1, delay=round(delay, 1))
+            pending.append((segment, attempt + 1, time.monotonic() + delay))
+        else:
+            print(f"❌ Segment {seg_num} failed after {attempt + 1} attempt(s): {error}")
+            self.on_progress("segment_failed", segment=seg_num, attempts=attempt + 1)
 
     def generate_with_extension(self, prompt_obj, image_gcs_uri, base_duration, extension_count, extension_increment):
         """
@@ -248,7 +351,8 @@ class VeoVideoGenerator:
             print(f"📍 Using config (normal generation)")
             
             # Base generation DOES use config (normal API)
-            base_operation = self.client.models.generate_videos(
+            base_operation = get_retry_policy("veo").call(lambda: get_circuit_breaker("veo").call(
+                self.client.models.generate_videos,
                 model=model,
                 prompt=veo_prompt_string,
                 image=types.Image(
@@ -262,15 +366,14 @@ class VeoVideoGenerator:
                     person_generation=person_gen,
                     generate_audio=GENERATE_AUDIO,
                 ),
-            )
+            ), label="Base video submit")
             
             print(f"✓ Base operation submitted: {base_operation.name}")
+            self.on_progress("segment_submitted", segment=1, label="Base video", attempt=1)
             
-            # Wait using Reddit's polling pattern
-            print(f"⏳ Polling for completion (Reddit method)...")
-            while not base_operation.done:
-                time.sleep(10)  # Reddit uses 10s intervals
-                base_operation = self.client.operations.get(base_operation)
+            # Wait on the shared poller (adaptive interval, deadline enforced)
+            print(f"⏳ Polling for completion...")
+            base_operation = self._track(base_operation, 1, "Base video").result()
             
             print(f"✅ Base operation complete!")
             
@@ -295,6 +398,7 @@ class VeoVideoGenerator:
             
             base_video_uri = base_video.video.uri
             print(f"✅ Base video: {base_video_uri}")
+            self.on_progress("segment_done", segment=1, label="Base video", total=extension_count + 1)
             
         except Exception as e:
             print(f"❌ Base generation error: {e}")
@@ -321,18 +425,20 @@ class VeoVideoGenerator:
                 print(f"{'='*70}\n")
                 
                 # THIS IS THE KEY: Minimal extension call, just like Reddit
-                extension_operation = self.client.models.generate_videos(
+                extension_operation = get_retry_policy("veo").call(lambda: get_circuit_breaker("veo").call(
+                    self.client.models.generate_videos,
                     model=model,
                     source=current_video,  # Just source, NOTHING ELSE!
-                )
+                ), label=f"Extension {ext_num} submit")
                 
                 print(f"✓ Extension submitted: {extension_operation.name}")
+                self.on_progress("segment_submitted", segment=ext_num + 1,
+                                 label=f"Extension {ext_num}", attempt=1)
                 
-                # Poll using Reddit method
                 print(f"⏳ Polling for completion...")
-                while not extension_operation.done:
-                    time.sleep(10)
-                    extension_operation = self.client.operations.get(extension_operation)
+                extension_operation = self._track(
+                    extension_operation, ext_num + 1, f"Extension {ext_num}"
+                ).result()
                 
                 print(f"✅ Extension {ext_num} complete!")
                 
@@ -359,6 +465,8 @@ class VeoVideoGenerator:
                 new_duration = current_duration + extension_increment
                 
                 print(f"✅ Extended to ~{new_duration}s: {extended_video_uri}")
+                self.on_progress("segment_done", segment=ext_num + 1, label=f"Extension {ext_num}",
+                                 total=extension_count + 1)
                 
                 # Update for next iteration
                 current_video = extended_video
@@ -381,39 +489,15 @@ class VeoVideoGenerator:
         
         return final_uri
     
-    def _wait_for_completion(self, operation, segment_num, total_segments):
-        """Poll operation until complete"""
-        print(f"⏳ Waiting for Veo generation...")
-        
-        poll_count = 0
-        max_polls = 60
-        
-        while not operation.done and poll_count < max_polls:
-            time.sleep(15)
-            poll_count += 1
-            
-            if poll_count % 4 == 0:
-                elapsed = poll_count * 15
-                print(f"   {elapsed}s elapsed...")
-            
-            try:
-                operation = self.client.operations.get(operation)
-            except Exception as e:
-                print(f"⚠️ Polling error: {e}")
-                time.sleep(5)
-                continue
-        
-        if poll_count >= max_polls:
-            print(f"⏱️ Timeout after {max_polls * 15}s")
-            return None
-        
+    def _extract_video_uri(self, operation, segment_num, total_segments):
+        """Pull the video URI out of a finished segment operation"""
         print(f"✅ Segment {segment_num}/{total_segments} complete!")
         
         if operation.error:
             error_code = operation.error.get('code', 'Unknown')
             error_msg = operation.error.get('message', 'No message')
             print(f"❌ Veo error {error_code}: {error_msg}")
-            return None
+            raise UpstreamError(f"Veo error {error_code}: {error_msg}", GRPC_TO_HTTP.get(error_code))
         
         try:
             if operation.response:
@@ -427,4 +511,77 @@ class VeoVideoGenerator:
             print(f"❌ URI extraction error: {e}")
             import traceback
             traceback.print_exc()
-            return None
\ No newline at end of file
+            return None
+
+
+if __name__ == "__main__":
+    # Check: 5 segments against a fake Veo client with per-segment latencies - sequential vs concurrent
+    import contextlib
+    import io
+    import threading
+    from types import SimpleNamespace
+
+    from operation_poller import OperationPoller
+
+    LATENCIES = [0.6, 0.3, 0.5, 0.2, 0.4]  # Seconds per segment: the first finishes last
+    MAX_IN_FLIGHT = 3
+
+    class FakeVeoClient:
+        def __init__(self):
+            self.lock = threading.Lock()
+            self.running = 0
+            self.peak = 0
+            self.models = SimpleNamespace(generate_videos=self.generate_videos)
+            self.operations = SimpleNamespace(get=self.get)
+
+        def generate_videos(self, model, prompt, image, config):
+            seg_num = int(config.output_gcs_uri.rsplit("_", 1)[1])
+            with self.lock:
+                self.running += 1
+                self.peak = max(self.peak, self.running)
+            return SimpleNamespace(name=f"operations/segment-{seg_num}", done=False, error=None,
+                                   response=None, seg_num=seg_num,
+                                   ready_at=time.monotonic() + LATENCIES[seg_num - 1])
+
+        def get(self, operation):
+            if time.monotonic() < operation.ready_at:
+                return operation
+            with self.lock:
+                self.running -= 1
+            video = SimpleNamespace(video=SimpleNamespace(uri=f"gs://fake/segment_{operation.seg_num}.mp4"))
+            operation.done, operation.response = True, True
+            operation.result = SimpleNamespace(generated_videos=[video])
+            return operation
+
+    class FakeGCS:
+        def get_segment_output_uri(self, seg_num, start_time, end_time):
+            return f"gs://fake/out/segment_{seg_num}"
+
+    def run(concurrent):
+        client = FakeVeoClient()
+        generator = VeoVideoGenerator(gcs_manager=FakeGCS(), client=client)
+        generator.poller = OperationPoller(initial_interval=0.02, max_interval=0.05, jitter=0.0)
+        prompts = [{"segment_number": i + 1, "duration": 8, "scene": f"Shot {i + 1} of the product"}
+                   for i in range(len(LATENCIES))]
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            uris = generator.generate_segments(prompts, ["gs://fake/product.png"], concurrent=concurrent,
+                                               max_in_flight=MAX_IN_FLIGHT)
+        return uris, time.perf_counter() - start, client.peak
+
+    sequential_uris, sequential_seconds, sequential_peak = run(concurrent=False)
+    concurrent_uris, concurrent_seconds, concurrent_peak = run(concurrent=True)
+
+    expected = [f"gs://fake/segment_{i + 1}.mp4" for i in range(len(LATENCIES))]
+    assert sequential_uris == expected, sequential_uris
+    assert concurrent_uris == expected, f"segments out of order: {concurrent_uris}"
+    assert sequential_peak == 1, sequential_peak
+    assert concurrent_peak == MAX_IN_FLIGHT, f"{concurrent_peak} operations in flight (limit {MAX_IN_FLIGHT})"
+    assert concurrent_seconds < sequential_seconds / 1.5, (sequential_seconds, concurrent_seconds)
+
+    print(f"\n{'=' * 70}")
+    print(f"📊 {len(LATENCIES)} segments, fake Veo latencies {LATENCIES}s, limit {MAX_IN_FLIGHT} in flight")
+    print(f"   Sequential: {sequential_seconds:.2f}s")
+    print(f"   Concurrent: {concurrent_seconds:.2f}s ({sequential_seconds / concurrent_seconds:.1f}x), "
+          f"peak {concurrent_peak} in flight, results in segment order")
+    print(f"{'=' * 70}")
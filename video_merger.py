@@ -1,18 +1,169 @@
 """
 Video merging with MoviePy - OPTIMIZED FOR RENDER FREE TIER
+- Optional server-side assembly (GCS compose), no local bytes at all
+- Stream-copy concat when all segments share codec/resolution/timebase
+- MoviePy re-encode only when streams differ
+- Per-request workspace: concurrent merges never touch each other's files
 - Forces temp file deletion regardless of TESTING_MODE
 - Minimized memory footprint
 - Immediate cleanup after use
 """
 import os
 import gc
-from config import VIDEO_FPS, VIDEO_CODEC, VIDEO_PRESET, TESTING_MODE
+import re
+import subprocess
+import tempfile
+from concurrent.futures import wait
+from config import (
+    VIDEO_FPS,
+    VIDEO_CODEC,
+    VIDEO_PRESET,
+    TESTING_MODE,
+    VIDEO_STREAM_COPY_MERGE,
+    VIDEO_COMPOSE_ASSEMBLY
+)
+from fmp4_assembly import assemble_with_compose
+from workspace import create_workspace, remove_workspace
+from progress_events import noop_progress
+
+
+def _ffmpeg_exe():
+    """ffmpeg binary bundled with imageio-ffmpeg (same one MoviePy uses)"""
+    import imageio_ffmpeg
+    return imageio_ffmpeg.get_ffmpeg_exe()
+
+
+def probe_streams(path):
+    """
+    Read codec parameters for the first video and audio stream of a file
+    
+    Returns:
+        dict with 'video' and 'audio' signature strings (audio may be None),
+        or None if the file could not be probed
+    """
+    result = subprocess.run(
+        [_ffmpeg_exe(), "-hide_banner", "-i", path],
+        capture_output=True, text=True
+    )
+    # ffmpeg exits non-zero without an output file; the stream info is on stderr
+    info = result.stderr
+    
+    video = re.search(r"Stream #\d+:\d+.*?: Video: (.+)", info)
+    if not video:
+        return None
+    
+    audio = re.search(r"Stream #\d+:\d+.*?: Audio: (.+)", info)
+    
+    return {
+        "video": _video_signature(video.group(1)),
+        "audio": _audio_signature(audio.group(1)) if audio else None,
+    }
+
+
+def _video_signature(stream_line):
+    """codec/profile, pixel format, resolution, frame rate and timebase"""
+    codec = stream_line.split(",")[0].split("(")[0].strip()
+    profile = re.search(r"^\w+ \(([^)]+)\)", stream_line)
+    pix_fmt = re.search(r", (yuv\w+|rgb\w+|nv12)", stream_line)
+    size = re.search(r"(\d{2,5}x\d{2,5})", stream_line)
+    fps = re.search(r"([\d.]+) fps", stream_line)
+    tbn = re.search(r"([\d.]+k?) tbn", stream_line)
+    
+    return "|".join([
+        codec,
+        profile.group(1) if profile else "",
+        pix_fmt.group(1) if pix_fmt else "",
+        size.group(1) if size else "",
+        fps.group(1) if fps else "",
+        tbn.group(1) if tbn else "",
+    ])
+
+
+def _audio_signature(stream_line):
+    """codec, sample rate and channel layout"""
+    codec = stream_line.split(",")[0].split("(")[0].strip()
+    rate = re.search(r"(\d+) Hz", stream_line)
+    layout = re.search(r"Hz, ([^,]+)", stream_line)
+    
+    return "|".join([
+        codec,
+        rate.group(1) if rate else "",
+        layout.group(1).strip() if layout else "",
+    ])
+
+
+def streams_compatible(paths):
+    """True when every file has identical stream parameters (safe to stream-copy)"""
+    return signatures_match(paths, [probe_streams(path) for path in paths])
+
+
+def signatures_match(paths, signatures):
+    """Compare probe_streams() results for a list of files"""
+    for path, signature in zip(paths, signatures):
+        if signature is None:
+            print(f"⚠️ Could not probe {path} - using re-encode merge")
+            return False
+    
+    if any(sig != signatures[0] for sig in signatures[1:]):
+        print(f"ℹ️ Segment streams differ - using re-encode merge")
+        for path, sig in zip(paths, signatures):
+            print(f"   {os.path.basename(path)}: {sig}")
+        return False
+    
+    print(f"✓ All {len(paths)} segments share codec/resolution/timebase")
+    return True
+
+
+def concat_stream_copy(paths, output_filename, work_dir=None):
+    """
+    Join compatible segments with the ffmpeg concat demuxer (no re-encode)
+    
+    Returns:
+        True on success, False if ffmpeg failed (caller falls back to re-encode)
+    """
+    print(f"\n⚡ Stream-copy concat → {output_filename}")
+    
+    fd, list_path = tempfile.mkstemp(prefix="concat_", suffix=".txt", dir=work_dir)
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            for path in paths:
+                escaped = os.path.abspath(path).replace("'", "'\\''")
+                f.write(f"file '{escaped}'\n")
+        
+        result = subprocess.run(
+            [
+                _ffmpeg_exe(), "-hide_banner", "-loglevel", "error", "-y",
+                "-f", "concat", "-safe", "0", "-i", list_path,
+                "-c", "copy", "-movflags", "+faststart",
+                output_filename
+            ],
+            capture_output=True, text=True
+        )
+    finally:
+        os.remove(list_path)
+    
+    if result.returncode != 0:
+        print(f"⚠️ Stream copy failed, falling back to re-encode: {result.stderr.strip()[-300:]}")
+        if os.path.exists(output_filename):
+            os.remove(output_filename)
+        return False
+    
+    return True
+
 
 class VideoMerger:
     """Merges video segments with aggressive resource cleanup"""
     
-    def __init__(self, gcs_manager=None):
+    def __init__(self, gcs_manager=None, work_dir=None, on_progress=None):
         self.gcs_manager = gcs_manager
+        # Private scratch directory: concurrent merges never share file names
+        self.work_dir = work_dir or create_workspace("merge")
+        self.on_progress = on_progress or noop_progress  # fn(stage, **data), see progress_events
+        self.keep_local_copy = TESTING_MODE  # Keep the final video in the CWD after upload
+    
+    def _path(self, filename):
+        """Location of a scratch file inside this merger's workspace"""
+        return os.path.join(self.work_dir, filename)
     
     def merge_with_transitions(self, video_gcs_uris, output_filename, 
                            transition_duration=None):
@@ -21,76 +172,60 @@ class VideoMerger:
             print("⚠️ No videos to merge")
             return None
         
+        self.on_progress("merge_started", segments=len(video_gcs_uris))
+        
         if len(video_gcs_uris) == 1:
             return self._handle_single_video(video_gcs_uris[0])
         
-        from moviepy.editor import VideoFileClip, concatenate_videoclips
+        # FASTEST PATH: assemble in the bucket, segment bytes never leave GCS
+        if VIDEO_COMPOSE_ASSEMBLY:
+            final_video_info = assemble_with_compose(self.gcs_manager, video_gcs_uris)
+            if final_video_info:
+                self.on_progress("merge_done", method="compose")
+                self.on_progress("upload_done", url=final_video_info.get("public_url"))
+                return final_video_info
         
         print(f"\n{'=' * 70}")
         print(f"🎬 MERGING {len(video_gcs_uris)} SEGMENTS")
         print(f"{'=' * 70}")
         
-        temp_files = []
-        clips = []
-        final_video = None
+        temp_files = [self._path(f"temp_segment_{i+1}.mp4") for i in range(len(video_gcs_uris))]
+        output_path = self._path(output_filename)
+        downloads = []
         
         try:
-            # Download and load clips
-            for i, video_uri in enumerate(video_gcs_uris):
-                temp_file = f"temp_segment_{i+1}.mp4"
-                self.gcs_manager.download_video(video_uri, temp_file)
-                temp_files.append(temp_file)
-                
-                print(f"   Loading segment {i+1}/{len(video_gcs_uris)}...")
-                clip = VideoFileClip(temp_file, audio=True, target_resolution=None)
-                clips.append(clip)
+            # Download all segments concurrently; probe each one as it lands
+            downloads = self.gcs_manager.download_videos(video_gcs_uris, temp_files)
             
-            print(f"\n🔗 Concatenating segments...")
+            signatures = []
+            for i, download in enumerate(downloads):
+                download.result()
+                print(f"   Segment {i+1}/{len(downloads)} ready")
+                self.on_progress("segment_downloaded", segment=i + 1, total=len(downloads))
+                if VIDEO_STREAM_COPY_MERGE:
+                    signatures.append(probe_streams(temp_files[i]))
             
-            # Simple concatenation without transitions (saves memory)
-            final_video = concatenate_videoclips(clips, method="compose")
+            # FAST PATH: identical streams → lossless concat without decoding
+            merged = False
+            if VIDEO_STREAM_COPY_MERGE and signatures_match(temp_files, signatures):
+                merged = concat_stream_copy(temp_files, output_path, work_dir=self.work_dir)
             
-            print(f"\n💾 Rendering: {output_filename}")
-            print(f"   Codec: {VIDEO_CODEC} | FPS: {VIDEO_FPS}")
-            
-            # Write with optimized settings for low memory
-            final_video.write_videofile(
-                output_filename,
-                codec=VIDEO_CODEC,
-                audio_codec='aac',
-                fps=VIDEO_FPS,
-                preset=VIDEO_PRESET,
-                threads=2,
-                bitrate="2000k",
-                logger=None,
-                temp_audiofile='temp_audio.m4a',
-                remove_temp=True
-            )
+            if not merged:
+                self._merge_reencode(temp_files, output_path)
             
             print(f"✅ Merge complete!")
-            
-            # CRITICAL: Close and cleanup MoviePy resources
-            self._cleanup_clips(clips, final_video)
+            self.on_progress("merge_done", method="stream_copy" if merged else "reencode")
             
             # Delete segment temp files IMMEDIATELY (always delete these)
             self._delete_temp_files(temp_files)
             
             # Upload final video to GCS
             print(f"\n📤 Uploading final video to GCS...")
-            final_video_info = self.gcs_manager.upload_final_video(output_filename)
-            
-            # ========== RESPECT TESTING_MODE FOR FINAL VIDEO ==========
-            if TESTING_MODE:
-                print(f"🧪 TESTING_MODE: Keeping local file: {output_filename}")
-            else:
-                # Production: delete local copy after GCS upload
-                if os.path.exists(output_filename):
-                    os.remove(output_filename)
-                    print(f"🗑️ Production mode: Deleted local file: {output_filename}")
-            # ===========================================================
+            final_video_info = self._upload_final(output_path)
+            
+            self._finalize_local_copy(output_path)
             
             # Force garbage collection
-            import gc
             gc.collect()
             
             return final_video_info
@@ -100,23 +235,64 @@ class VideoMerger:
             import traceback
             traceback.print_exc()
             
+            # Let in-flight downloads settle before deleting their files
+            for download in downloads:
+                download.cancel()
+            wait(downloads)
+            
             # Ensure cleanup even on error
-            self._cleanup_clips(clips, final_video)
             self._delete_temp_files(temp_files)
             
             # Delete partial output if exists (regardless of mode - it's broken)
-            if os.path.exists(output_filename):
-                os.remove(output_filename)
-                print(f"🗑️ Deleted partial/corrupted file: {output_filename}")
+            if os.path.exists(output_path):
+                os.remove(output_path)
+                print(f"🗑️ Deleted partial/corrupted file: {output_path}")
             
-            import gc
             gc.collect()
             return None
     
+    def _merge_reencode(self, temp_files, output_filename):
+        """SLOW PATH: decode every segment with MoviePy and re-encode"""
+        from moviepy.editor import VideoFileClip, concatenate_videoclips
+        
+        clips = []
+        final_video = None
+        
+        try:
+            for i, temp_file in enumerate(temp_files):
+                print(f"   Loading segment {i+1}/{len(temp_files)}...")
+                clip = VideoFileClip(temp_file, audio=True, target_resolution=None)
+                clips.append(clip)
+            
+            print(f"\n🔗 Concatenating segments...")
+            
+            # Simple concatenation without transitions (saves memory)
+            final_video = concatenate_videoclips(clips, method="compose")
+            
+            print(f"\n💾 Rendering: {output_filename}")
+            print(f"   Codec: {VIDEO_CODEC} | FPS: {VIDEO_FPS}")
+            
+            # Write with optimized settings for low memory
+            final_video.write_videofile(
+                output_filename,
+                codec=VIDEO_CODEC,
+                audio_codec='aac',
+                fps=VIDEO_FPS,
+                preset=VIDEO_PRESET,
+                threads=2,
+                bitrate="2000k",
+                logger=None,
+                temp_audiofile=self._path('temp_audio.m4a'),
+                remove_temp=True
+            )
+        finally:
+            # CRITICAL: Close and cleanup MoviePy resources
+            self._cleanup_clips(clips, final_video)
+    
     def _handle_single_video(self, video_uri):
         """Download single video and upload as final"""
-        temp_file = "temp_single_video.mp4"
-        final_file = "final_product_video_single.mp4"
+        temp_file = self._path("temp_single_video.mp4")
+        final_file = self._path("final_product_video_single.mp4")
         
         try:
             # Download from GCS
@@ -127,15 +303,9 @@ class VideoMerger:
             shutil.move(temp_file, final_file)
             
             # Upload to GCS
-            result = self.gcs_manager.upload_final_video(final_file)
+            result = self._upload_final(final_file)
             
-            # Respect TESTING_MODE
-            if TESTING_MODE:
-                print(f"🧪 TESTING_MODE: Keeping local file: {final_file}")
-            else:
-                if os.path.exists(final_file):
-                    os.remove(final_file)
-                    print(f"🗑️ Production mode: Deleted local file: {final_file}")
+            self._finalize_local_copy(final_file)
             
             return result
             
@@ -147,6 +317,36 @@ class VideoMerger:
             if os.path.exists(temp_file):
                 os.remove(temp_file)
     
+    def _upload_final(self, local_path):
+        """Upload the finished video, reporting progress around it"""
+        self.on_progress("upload_started")
+        final_video_info = self.gcs_manager.upload_final_video(local_path)
+        self.on_progress("upload_done", url=final_video_info.get("public_url") if final_video_info else None)
+        return final_video_info
+    
+    def _finalize_local_copy(self, local_path):
+        """Respect TESTING_MODE: keep the final video in CWD, otherwise delete it"""
+        if not os.path.exists(local_path):
+            return
+        
+        if self.keep_local_copy:
+            # Suffix with the request id so concurrent jobs never collide
+            stem, ext = os.path.splitext(os.path.basename(local_path))
+            request_id = getattr(self.gcs_manager, "request_id", None) or os.path.basename(self.work_dir)
+            kept_path = f"{stem}_{request_id}{ext}"
+            
+            import shutil
+            shutil.move(local_path, kept_path)
+            print(f"🧪 TESTING_MODE: Keeping local file: {kept_path}")
+        else:
+            # Production: delete local copy after GCS upload
+            os.remove(local_path)
+            print(f"🗑️ Production mode: Deleted local file: {local_path}")
+    
+    def cleanup(self):
+        """Remove this merger's workspace (only files this request created)"""
+        remove_workspace(self.work_dir)
+    
     def _cleanup_clips(self, clips, final_video):
         """Aggressively close all MoviePy clips to free memory"""
         try:
@@ -176,24 +376,126 @@ class VideoMerger:
         
         if deleted_count > 0:
             print(f"🗑️ Deleted {deleted_count} temp segment(s)")
-        
-        # Also check for any orphaned temp files
-        self._cleanup_orphaned_temps()
+
+
+if __name__ == "__main__":
+    # Benchmark: stream-copy concat vs MoviePy re-encode on synthetic clips
+    import time
     
-    def _cleanup_orphaned_temps(self):
-        """Remove any leftover temp files from failed runs"""
-        orphans = []
-        
-        # Check for common temp file patterns
-        for filename in os.listdir('.'):
-            if (filename.startswith('temp_segment_') or 
-                filename.startswith('temp_single_') or
-                filename.startswith('temp_audio')):
-                orphans.append(filename)
-        
-        for orphan in orphans:
-            try:
-                os.remove(orphan)
-                print(f"🗑️ Cleaned orphan: {orphan}")
-            except:
-                pass
\ No newline at end of file
+    SEGMENTS = 3
+    SEGMENT_SECONDS = 8
+    bench_dir = tempfile.mkdtemp(prefix="merge_bench_")
+    
+    print(f"🧪 Generating {SEGMENTS} x {SEGMENT_SECONDS}s synthetic 720p clips...")
+    clips = []
+    for i in range(SEGMENTS):
+        path = os.path.join(bench_dir, f"segment_{i + 1}.mp4")
+        subprocess.run(
+            [
+                _ffmpeg_exe(), "-hide_banner", "-loglevel", "error", "-y",
+                "-f", "lavfi", "-i", f"testsrc2=size=1280x720:rate={VIDEO_FPS}:duration={SEGMENT_SECONDS}",
+                "-f", "lavfi", "-i", f"sine=frequency={440 + i * 110}:duration={SEGMENT_SECONDS}",
+                "-c:v", "libx264", "-pix_fmt", "yuv420p", "-c:a", "aac", "-shortest", path
+            ],
+            check=True
+        )
+        clips.append(path)
+    
+    merger = VideoMerger(work_dir=bench_dir)
+    
+    start = time.perf_counter()
+    compatible = streams_compatible(clips)
+    copied = compatible and concat_stream_copy(clips, os.path.join(bench_dir, "stream_copy.mp4"))
+    copy_seconds = time.perf_counter() - start
+    
+    start = time.perf_counter()
+    merger._merge_reencode(clips, os.path.join(bench_dir, "reencode.mp4"))
+    reencode_seconds = time.perf_counter() - start
+    
+    print(f"\n{'=' * 70}")
+    print(f"📊 Merge of {SEGMENTS} x {SEGMENT_SECONDS}s segments")
+    print(f"   Stream copy (incl. probe): {copy_seconds:.2f}s {'✅' if copied else '❌'}")
+    print(f"   MoviePy re-encode:         {reencode_seconds:.2f}s")
+    if copied:
+        print(f"   Speedup: {reencode_seconds / copy_seconds:.1f}x")
+    print(f"{'=' * 70}")
+    
+    merger.cleanup()
+    
+    # Stress check: concurrent merges in one process (8 stream copies, 3 re-encodes)
+    # against the local GCS stand-in - every merge must succeed in its own workspace
+    # and leave nothing behind
+    import contextlib
+    import glob
+    import io
+    import shutil
+    from concurrent.futures import ThreadPoolExecutor
+    
+    from gcs_utils import GCSManager
+    from local_gcs import LocalStorageClient
+    from workspace import workspace_root, WORKSPACE_PREFIX
+    
+    STREAM_COPY_MERGES = 8
+    REENCODE_MERGES = 3
+    STRESS_SECONDS = 2
+    
+    stress_dir = tempfile.mkdtemp(prefix="merge_stress_")
+    client = LocalStorageClient(os.path.join(stress_dir, "gcs"))
+    sources = {}
+    for name, size in (("a", "640x360"), ("b", "640x360"), ("c", "640x360"), ("odd", "480x360")):
+        path = os.path.join(stress_dir, f"{name}.mp4")
+        subprocess.run(
+            [
+                _ffmpeg_exe(), "-hide_banner", "-loglevel", "error", "-y",
+                "-f", "lavfi", "-i", f"testsrc2=size={size}:rate={VIDEO_FPS}:duration={STRESS_SECONDS}",
+                "-f", "lavfi", "-i", f"sine=frequency=440:duration={STRESS_SECONDS}",
+                "-c:v", "libx264", "-pix_fmt", "yuv420p", "-c:a", "aac", "-shortest", path
+            ],
+            check=True
+        )
+        sources[name] = path
+    
+    def duration(path):
+        info = subprocess.run([_ffmpeg_exe(), "-hide_banner", "-i", path], capture_output=True, text=True).stderr
+        hours, minutes, seconds = re.search(r"Duration: (\d+):(\d+):([\d.]+)", info).groups()
+        return int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+    
+    def merge_job(names):
+        manager = GCSManager(bucket_name="stress-bucket", storage_client=client)
+        uris = []
+        for i, name in enumerate(names):
+            uri = manager.get_segment_output_uri(i + 1, i * STRESS_SECONDS, (i + 1) * STRESS_SECONDS)
+            manager.bucket.blob(uri.split("/", 3)[3]).upload_from_filename(sources[name])
+            uris.append(uri)
+        methods = []
+        merger = VideoMerger(gcs_manager=manager, on_progress=lambda stage, **data: methods.append(data.get("method")))
+        merger.keep_local_copy = False  # Don't keep the stress run's final videos in the CWD
+        try:
+            info = merger.merge_with_transitions(uris, "final_product_video.mp4")
+        finally:
+            merger.cleanup()
+        final = manager.bucket.blob(f"{manager.request_folder}/final_merged_video.mp4")
+        return info, final.path if final.exists() else None, [m for m in methods if m], merger.work_dir
+    
+    jobs = [("a", "b", "c")] * STREAM_COPY_MERGES + [("a", "odd", "c")] * REENCODE_MERGES
+    cwd_before = set(os.listdir("."))
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=len(jobs)) as pool, contextlib.redirect_stdout(io.StringIO()):
+        outcomes = list(pool.map(merge_job, jobs))
+    stress_seconds = time.perf_counter() - start
+    
+    methods = [method for _, _, used, _ in outcomes for method in used]
+    assert all(info and path for info, path, _, _ in outcomes), "a concurrent merge failed"
+    assert methods.count("stream_copy") == STREAM_COPY_MERGES and methods.count("reencode") == REENCODE_MERGES, methods
+    for _, path, _, _ in outcomes:
+        assert abs(duration(path) - 3 * STRESS_SECONDS) < 0.2, f"{path}: {duration(path):.2f}s"
+    assert len({work_dir for _, _, _, work_dir in outcomes}) == len(jobs), "merges shared a workspace"
+    assert not any(os.path.exists(work_dir) for _, _, _, work_dir in outcomes), "workspace left behind"
+    assert not glob.glob(os.path.join(workspace_root(), f"{WORKSPACE_PREFIX}{os.getpid()}_*")), "stray workspace"
+    assert set(os.listdir(".")) == cwd_before, f"files left in the CWD: {set(os.listdir('.')) - cwd_before}"
+    
+    print(f"📊 Concurrent merges: {STREAM_COPY_MERGES} stream copies + {REENCODE_MERGES} re-encodes in "
+          f"{stress_seconds:.1f}s, all correct, no workspace or CWD files left")
+    print(f"{'=' * 70}")
+    
+    shutil.rmtree(stress_dir, ignore_errors=True)
@@ -0,0 +1,96 @@
+"""
+Per-request scratch directories for video work
+Each merge gets its own directory (on tmpfs when there is room), so
+concurrent jobs never share temp file names and cleanup only ever
+touches directories this process owns.
+"""
+import os
+import shutil
+import tempfile
+import time
+
+from config import (
+    VIDEO_WORKSPACE_ROOT,
+    VIDEO_WORKSPACE_USE_TMPFS,
+    VIDEO_WORKSPACE_TMPFS_MIN_FREE_MB,
+    VIDEO_WORKSPACE_STALE_SECONDS
+)
+
+WORKSPACE_PREFIX = "video_ws_"
+TMPFS_PATH = "/dev/shm"
+
+
+def workspace_root():
+    """Pick where workspaces live: configured root > tmpfs (if roomy) > system temp"""
+    if VIDEO_WORKSPACE_ROOT:
+        os.makedirs(VIDEO_WORKSPACE_ROOT, exist_ok=True)
+        return VIDEO_WORKSPACE_ROOT
+
+    if VIDEO_WORKSPACE_USE_TMPFS and os.path.isdir(TMPFS_PATH) and os.access(TMPFS_PATH, os.W_OK):
+        free_mb = shutil.disk_usage(TMPFS_PATH).free // (1024 * 1024)
+        if free_mb >= VIDEO_WORKSPACE_TMPFS_MIN_FREE_MB:
+            return TMPFS_PATH
+
+    return tempfile.gettempdir()
+
+
+def create_workspace(label="merge"):
+    """Create a private directory tagged with this process id"""
+    root = workspace_root()
+    sweep_stale_workspaces(root)
+
+    path = tempfile.mkdtemp(prefix=f"{WORKSPACE_PREFIX}{os.getpid()}_{label}_", dir=root)
+    print(f"📂 Workspace: {path}")
+    return path
+
+
+def remove_workspace(path):
+    """Delete a workspace and everything in it"""
+    if path and os.path.isdir(path):
+        shutil.rmtree(path, ignore_errors=True)
+        print(f"🗑️ Removed workspace: {path}")
+
+
+def sweep_stale_workspaces(root=None):
+    """
+    Remove workspaces left behind by processes that no longer exist
+
+    Only directories whose owning pid is dead AND that are older than
+    VIDEO_WORKSPACE_STALE_SECONDS are touched - never a live job's files.
+    """
+    root = root or workspace_root()
+    try:
+        entries = os.listdir(root)
+    except OSError:
+        return
+
+    now = time.time()
+    for name in entries:
+        if not name.startswith(WORKSPACE_PREFIX):
+            continue
+
+        try:
+            pid = int(name[len(WORKSPACE_PREFIX):].split("_", 1)[0])
+        except ValueError:
+            continue
+
+        path = os.path.join(root, name)
+        try:
+            age = now - os.path.getmtime(path)
+        except OSError:
+            continue
+
+        if pid != os.getpid() and not pid_alive(pid) and age > VIDEO_WORKSPACE_STALE_SECONDS:
+            shutil.rmtree(path, ignore_errors=True)
+            print(f"🗑️ Cleaned stale workspace: {name}")
+
+
+def pid_alive(pid):
+    """Whether a process with this pid exists (one owned by another user counts as alive)"""
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True